@@ -0,0 +1,238 @@
+# Batch runner for many input files.
+#
+# Schedules input files across one shared pool of worker processes, runs
+# each with its own time or sample budget, and writes a result row to a
+# csv or JSON lines sink as each file finishes. Prints a report of the
+# total throughput and the slowest files once every file is done.
+#
+# Usage: python BatchRunner.py [--seconds 30] [--samples N] [--workers N]
+#                              [--seed 1] [--output results.jsonl]
+#                              [--manifest budgets.jsonl] [FILE ...]
+#
+# Files may be four-row csv or record input files, given as globs.
+# Purely boolean files run on the pure Python engine of BooleanPrior.py,
+# and a worker only loads z3 once it meets a file which needs it. A
+# manifest has one JSON object per line, {"file": ..., "seconds": ...,
+# "samples": ...}, where the budgets override those given on the
+# command line for that file. Files with no budget on either run for 30
+# seconds.
+
+import argparse
+import csv
+import glob
+import json
+import multiprocessing
+import os
+import sys
+import time
+
+import BooleanPrior as BP
+from RandomStreams import RandomStream
+
+
+# Columns of the result sink, in order
+resultFields = ['file', 'status', 'error', 'secondsBudget', 'samplesBudget', 'numModels',
+                'probability', 'numUpdatedModels', 'updatedProbability', 'seconds',
+                'samplesPerSecond', 'worker']
+
+
+# Writes one row per finished file, flushing as it goes so a long batch
+# can be watched or resumed from the rows already written
+class resultSink(object) :
+
+	# @fileName : a .jsonl name writes JSON lines, anything else a csv
+	#             with a header. None writes nothing
+	def __init__(self, fileName) :
+		self.fileName = fileName
+		self.outputFile = None
+		self.writer = None
+		if fileName is None :
+			return
+		if fileName.endswith('.jsonl') :
+			self.outputFile = open(fileName, 'w')
+		else :
+			if sys.version_info[0] < 3 :
+				self.outputFile = open(fileName, 'wb')
+			else :
+				self.outputFile = open(fileName, 'w', newline = '')
+			self.writer = csv.DictWriter(self.outputFile, resultFields)
+			self.writer.writeheader()
+
+	def write(self, result) :
+		if self.outputFile is None :
+			return
+		if self.writer is None :
+			self.outputFile.write(json.dumps(result, sort_keys = True) + '\n')
+		else :
+			self.writer.writerow(dict((field, '' if result.get(field) is None else result[field])
+			                          for field in resultFields))
+		self.outputFile.flush()
+
+	def close(self) :
+		if self.outputFile is not None :
+			self.outputFile.close()
+			self.outputFile = None
+
+
+# Workers print nothing unless asked to, the library's progress messages
+# from hundreds of files would only interleave
+def _batchWorkerStart(quiet) :
+	if quiet :
+		sys.stdout = open(os.devnull, 'w')
+
+# Runs one input file in a worker process. Parse errors and inconsistent
+# knowledge bases exit in the library, so they are caught and reported
+# as failed rows instead of taking the pool down.
+# @task   : a tuple of the file name, its seconds and samples budgets,
+#           the batch seed and further sampler options
+# @return : a result dictionary with the resultFields keys
+def _batchWorker(task) :
+	fileName, secondsToRun, numSamples, seed, samplerOptions = task
+	result = {'file' : fileName, 'status' : 'ok', 'error' : None,
+	          'secondsBudget' : secondsToRun, 'samplesBudget' : numSamples,
+	          'worker' : os.getpid()}
+	samplerOptions = dict(samplerOptions)
+	if seed is not None :
+		samplerOptions['rng'] = RandomStream(seed, fileName)
+	start = time.time()
+	try :
+		consistentPaths, numModels, initialSOICount, updatedSOICount, numUpdatedModels = \
+			BP.PriorInputFile(fileName, secondsToRun, numSamples, **samplerOptions)
+		result['numModels'] = numModels
+		result['numUpdatedModels'] = numUpdatedModels
+		result['probability'] = float(initialSOICount) / numModels if numModels else None
+		result['updatedProbability'] = None
+		if numUpdatedModels :
+			result['updatedProbability'] = float(updatedSOICount) / numUpdatedModels
+	except SystemExit as error :
+		result['status'], result['error'] = 'failed', str(error)
+	except Exception as error :
+		result['status'], result['error'] = 'failed', repr(error)
+	result['seconds'] = time.time() - start
+	result['samplesPerSecond'] = (result.get('numModels') or 0) / max(result['seconds'], 1e-9)
+	return(result)
+
+
+# Runs every input file on a shared pool of workers
+# @tasks          : a list of (file name, seconds, samples) triples, where
+#                   either budget may be None to use the batch's own.
+#                   Files left with neither budget get a failed row
+# @secondsToRun   : the default time budget for each file
+# @numSamples     : the default sample budget for each file
+# @numWorkers     : how many worker processes to use, defaults to the
+#                   number of cores
+# @outputFileName : optional csv or .jsonl file to write each result to
+# @seed           : optional seed. Each file samples from its own stream
+#                   of it, so its result doesn't depend on scheduling
+# @numSlowest     : how many of the slowest files to report
+# @filesPerWorker : files a worker runs before it is replaced, which
+#                   bounds how much z3 state a worker accumulates
+# @quiet          : if true the workers' printed output is discarded
+# @samplerOptions : further keyword arguments for DemskiPrior
+# @return         : a report dictionary of totals, throughput and the
+#                   slowest files
+def RunBatch(tasks, secondsToRun=None, numSamples=None, numWorkers=None, outputFileName=None,
+             seed=None, numSlowest=10, filesPerWorker=25, quiet=True, **samplerOptions) :
+	if numWorkers is None :
+		numWorkers = multiprocessing.cpu_count()
+	sink = resultSink(outputFileName)
+	results = []
+	start = time.time()
+
+	# Files without any budget are reported as failed, the rest still run
+	workerTasks = []
+	for fileName, fileSeconds, fileSamples in tasks :
+		fileSeconds = secondsToRun if fileSeconds is None else fileSeconds
+		fileSamples = numSamples if fileSamples is None else fileSamples
+		if fileSeconds is None and fileSamples is None :
+			result = {'file' : fileName, 'status' : 'failed',
+			          'error' : "neither a time nor a sample budget", 'seconds' : 0.0,
+			          'samplesPerSecond' : 0.0}
+			sink.write(result)
+			results.append(result)
+			print(result['file'] + ': failed, ' + result['error'])
+			continue
+		workerTasks.append((fileName, fileSeconds, fileSamples, seed, samplerOptions))
+
+	if hasattr(multiprocessing, 'get_context') :
+		pool = multiprocessing.get_context('fork').Pool(numWorkers, _batchWorkerStart, (quiet,),
+		                                                filesPerWorker)
+	else :
+		pool = multiprocessing.Pool(numWorkers, _batchWorkerStart, (quiet,), filesPerWorker)
+	try :
+		for result in pool.imap_unordered(_batchWorker, workerTasks) :
+			sink.write(result)
+			results.append(result)
+			print(result['file'] + ': ' + result['status'] + ' in ' +
+			      str(round(result['seconds'], 2)) + ' seconds')
+		pool.close()
+	except :
+		pool.terminate()
+		raise
+	finally :
+		pool.join()
+		sink.close()
+	seconds = time.time() - start
+
+	succeeded = [result for result in results if result['status'] == 'ok']
+	totalModels = sum(result['numModels'] for result in succeeded)
+	slowest = sorted(results, key = lambda result : result['seconds'], reverse = True)[:numSlowest]
+	return({'files' : len(results), 'succeeded' : len(succeeded),
+	        'failed' : [result['file'] for result in results if result['status'] != 'ok'],
+	        'workers' : numWorkers, 'seconds' : seconds,
+	        'filesPerSecond' : len(results) / max(seconds, 1e-9),
+	        'totalModels' : totalModels,
+	        'samplesPerSecond' : totalModels / max(seconds, 1e-9),
+	        'slowest' : [{'file' : result['file'], 'seconds' : result['seconds'],
+	                      'status' : result['status']} for result in slowest]})
+
+# Reads per-file budgets
+# @return : a list of (file name, seconds, samples) triples
+def ReadManifest(manifestFileName) :
+	tasks = []
+	with open(manifestFileName) as manifestFile :
+		for line in manifestFile :
+			if line.strip() == '' :
+				continue
+			entry = json.loads(line)
+			tasks.append((entry['file'], entry.get('seconds'), entry.get('samples')))
+	return(tasks)
+
+
+if __name__ == '__main__' :
+	parser = argparse.ArgumentParser(description = 'Run the logical prior on many input files')
+	parser.add_argument('files', nargs = '*', help = 'input files or globs of them')
+	parser.add_argument('--manifest', default = None,
+	                    help = 'JSON lines file of files with their own budgets')
+	parser.add_argument('--seconds', type = float, default = None,
+	                    help = 'sampling time for each file')
+	parser.add_argument('--samples', type = int, default = None,
+	                    help = 'number of models to sample for each file')
+	parser.add_argument('--workers', type = int, default = None,
+	                    help = 'worker processes, defaults to the number of cores')
+	parser.add_argument('--seed', type = int, default = None,
+	                    help = 'seed for the samplers, for repeatable runs')
+	parser.add_argument('--output', default = None,
+	                    help = 'csv or .jsonl file to write each result to')
+	parser.add_argument('--slowest', type = int, default = 10,
+	                    help = 'how many of the slowest files to report')
+	args = parser.parse_args()
+
+	tasks = []
+	if args.manifest is not None :
+		tasks.extend(ReadManifest(args.manifest))
+	for pattern in args.files :
+		fileNames = sorted(glob.glob(pattern)) or [pattern]
+		tasks.extend((fileName, None, None) for fileName in fileNames)
+	if not tasks :
+		sys.exit("No input files given")
+
+	# Without budgets on the command line, files without their own run
+	# for 30 seconds
+	if args.seconds is None and args.samples is None :
+		tasks = [(fileName, 30.0 if fileSeconds is None and fileSamples is None else fileSeconds,
+		          fileSamples) for fileName, fileSeconds, fileSamples in tasks]
+
+	report = RunBatch(tasks, args.seconds, args.samples, args.workers, args.output, args.seed,
+	                  args.slowest)
+	print(json.dumps(report, indent = 2, sort_keys = True))
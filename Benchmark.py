@@ -0,0 +1,245 @@
+# Benchmark harness for the logical prior algorithms.
+#
+# Runs DemskiPrior, consumptiveUpdate, ParseSentence and transClosure
+# on the example input files and on synthetic knowledge bases of growing
+# size, times how long a fresh process takes to import the modules and
+# answer a short query, and writes the measurements as JSON so that
+# results from different versions can be compared. Each problem runs in
+# a forked process of its own, so its peak memory is its own.
+#
+# Usage: python Benchmark.py [--seconds 2] [--sizes 10,20,40,80]
+#                            [--seed 1] [--cold-start ExampleInput4.csv]
+#                            [--output results.json]
+
+import argparse
+import glob
+import json
+import multiprocessing
+import os
+import platform
+import random
+import resource
+import subprocess
+import sys
+import time
+
+import BooleanPrior as BP
+import LogicalFunctions as LF
+from Instrumentation import SolverStats
+from LazyZ3 import z3
+
+
+# Generates a random knowledge base which is always consistent, since
+# every sentence holds when all of the variables are true
+# @numVars : how many boolean variables to declare
+# @seed    : seed for the generator, so sizes are reproducible
+# @return  : a triple of the variable declarations, the knowledge
+#            sentences and the sentence of interest, all as strings
+def SyntheticKnowledgeBase(numVars, seed=0) :
+	generator = random.Random(seed)
+	varNames = ['v' + str(i) for i in range(numVars)]
+	templates = ['{0} implies {1}',
+	             '({0} and {1}) implies {2}',
+	             '{0} or not ({1} and {2})',
+	             '({0} or not {1}) implies {2}']
+	sentences = []
+	for i in range(numVars) :
+		template = generator.choice(templates)
+		sentences.append(template.format(*generator.sample(varNames, 3)))
+	declarations = [varName + ' ' + str(round(generator.uniform(0.2, 0.8), 2))
+	                for varName in varNames]
+	return((declarations, sentences, varNames[0]))
+
+# @return : the peak resident memory of this process in kilobytes. It
+#           is a high-water mark over the life of the process, so each
+#           problem is measured in a process of its own
+def peakMemoryKB() :
+	peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+	if sys.platform == 'darwin' :
+		peak = peak // 1024
+	return(peak)
+
+# Times the stages of the algorithm on one parsed problem
+# @name         : label for the results
+# @declarations : the variable declaration strings
+# @sentences    : the background knowledge sentence strings
+# @interest     : the sentence of interest string
+# @updates      : sentence strings to update on
+# @secondsToRun : the sampling budget
+# @rng          : the random generator to sample with
+# @return       : a dictionary of measurements
+def BenchmarkProblem(name, declarations, sentences, interest, updates, secondsToRun,
+                     rng=random) :
+	result = {'name' : name, 'numVariables' : len(declarations),
+	          'numSentences' : len(sentences)}
+
+	start = time.time()
+	variables = LF.ParseVariables(declarations)
+	parser = LF.SentenceParser(variables)
+	knowledgeBase = [LF.ParseSentence(sentence, variables, parser) for sentence in sentences
+	                 if sentence.strip() != '']
+	for varName in variables.keys() :
+		variableList = variables[varName]
+		if variableList[1] == 'unif' :
+			knowledgeBase.append(variableList[0] > variableList[2]-1)
+			knowledgeBase.append(variableList[0] < variableList[3]+1)
+	statementOfInterest = LF.ParseSentence(interest, variables, parser)
+	updatedKnowledge = knowledgeBase + [LF.ParseSentence(sentence, variables, parser)
+	                                    for sentence in updates if sentence.strip() != '']
+	result['parseSeconds'] = time.time() - start
+	result['sentencesPerSecond'] = (len(sentences) + 1) / max(result['parseSeconds'], 1e-9)
+
+	start = time.time()
+	LF.transClosure(knowledgeBase, statementOfInterest)
+	result['transClosureSeconds'] = time.time() - start
+
+	stats = SolverStats()
+	LF.solverCheckCount.clear()
+	start = time.time()
+	models, interestCount, trueVarNames = LF.DemskiPrior(knowledgeBase, variables,
+		statementOfInterest, secondsToRun, stats = stats, rng = rng)
+	elapsed = time.time() - start
+	result['samples'] = len(models)
+	result['samplesPerSecond'] = len(models) / elapsed
+	result['checksPerSample'] = LF.solverCheckCount['checks'] / float(max(len(models), 1))
+	result['probability'] = interestCount / float(max(len(models), 1))
+	result['modelBytes'] = models.nbytes()
+
+	LF.solverCheckCount.clear()
+	start = time.time()
+	updatedModels, updatedCount = LF.consumptiveUpdate(models, statementOfInterest, updatedKnowledge,
+		stats = stats)
+	elapsed = time.time() - start
+	result['updateSeconds'] = elapsed
+	result['updatedModelsPerSecond'] = len(models) / max(elapsed, 1e-9)
+	result['updateChecks'] = LF.solverCheckCount['checks']
+
+	# The same budget on the pure boolean engine, where it applies
+	booleanVariables = LF.ParseDeclarations(declarations)
+	if BP.IsPureBoolean(booleanVariables) :
+		booleanParser = LF.SentenceParser(booleanVariables)
+		knowledgeNodes = [booleanParser.parseNode(sentence) for sentence in sentences
+		                  if sentence.strip() != '']
+		interestNode = booleanParser.parseNode(interest)
+		start = time.time()
+		booleanModels = LF.DemskiPrior(knowledgeNodes, booleanVariables, interestNode,
+			secondsToRun, rng = rng, backend = 'sat', parser = booleanParser)[0]
+		result['booleanSamplesPerSecond'] = len(booleanModels) / (time.time() - start)
+
+	result['peakMemoryKB'] = peakMemoryKB()
+	result['solverStats'] = stats.summary()
+	return(result)
+
+# Runs BenchmarkProblem in a freshly forked process, whose peak memory
+# is then that of the one problem rather than of every problem run
+# before it. startMemoryKB gives the memory the process began with
+# @seed   : optional seed. The problem samples from the stream
+#           RandomStream(seed, name)
+# @return : the dictionary of measurements
+def IsolatedBenchmarkProblem(name, declarations, sentences, interest, updates, secondsToRun,
+                             seed=None) :
+	if hasattr(multiprocessing, 'get_context') :
+		pool = multiprocessing.get_context('fork').Pool(1)
+	else :
+		pool = multiprocessing.Pool(1)
+	try :
+		return(pool.apply(_benchmarkWorker, (name, declarations, sentences, interest, updates,
+		                                     secondsToRun, seed)))
+	finally :
+		pool.close()
+		pool.join()
+
+def _benchmarkWorker(name, declarations, sentences, interest, updates, secondsToRun, seed) :
+	startMemory = peakMemoryKB()
+	result = BenchmarkProblem(name, declarations, sentences, interest, updates, secondsToRun,
+	                          LF.RandomStream(seed, name))
+	result['startMemoryKB'] = startMemory
+	return(result)
+
+# @return : the declaration and knowledge rows, the first query and the
+#           update row of an input file, as LF.ReadInputFile reads them
+def readExampleRows(csvFileName) :
+	variableRow, knowledgeRow, queryRow, updatedRow = LF.ReadInputRows(csvFileName)
+	interest = [query for query in queryRow if query.strip() != ''][0]
+	return((variableRow, knowledgeRow, interest, updatedRow or []))
+
+# Times fresh interpreters importing the modules and answering a short
+# query with each engine. Each is run a few times and the fastest kept,
+# so the disk cache is warm
+# @exampleFile : a purely boolean input file to query
+# @numSamples  : models to sample for the query
+# @return      : a dictionary of seconds for each command
+def ColdStart(exampleFile, numSamples=200, repeats=3) :
+	here = os.path.dirname(os.path.abspath(__file__))
+	query = [os.path.join(here, 'BooleanPrior.py'), exampleFile, '--samples', str(numSamples),
+	         '--seed', '1']
+	commands = [('importZ3', ['-c', 'import z3']),
+	            ('importLogicalFunctions', ['-c', 'import LogicalFunctions']),
+	            ('importBooleanPrior', ['-c', 'import BooleanPrior']),
+	            ('booleanQuery', query),
+	            ('z3Query', query + ['--z3'])]
+	seconds = {}
+	with open(os.devnull, 'w') as devnull :
+		for name, arguments in commands :
+			times = []
+			for i in range(repeats) :
+				start = time.time()
+				subprocess.check_call([sys.executable] + arguments, cwd = here, stdout = devnull)
+				times.append(time.time() - start)
+			seconds[name] = min(times)
+	return(seconds)
+
+# Runs every benchmark, each in a process of its own
+# @seed   : optional seed. Each problem samples from its own stream of it,
+#           so a problem's models don't depend on which others are run
+# @return : a dictionary of environment details and a list of results
+def RunBenchmarks(secondsToRun, sizes, exampleFiles, seed=None, coldStartFile=None) :
+	report = {'timestamp' : time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+	          'python' : platform.python_version(),
+	          'z3' : z3.get_version_string(),
+	          'platform' : platform.platform(),
+	          'secondsToRun' : secondsToRun,
+	          'seed' : seed,
+	          'results' : []}
+
+	for exampleFile in exampleFiles :
+		declarations, sentences, interest, updates = readExampleRows(exampleFile)
+		report['results'].append(IsolatedBenchmarkProblem(exampleFile, declarations, sentences,
+			interest, updates, secondsToRun, seed))
+
+	for size in sizes :
+		declarations, sentences, interest = SyntheticKnowledgeBase(size)
+		report['results'].append(IsolatedBenchmarkProblem('synthetic-' + str(size), declarations,
+			sentences, interest, ['v1'], secondsToRun, seed))
+
+	if coldStartFile is not None :
+		report['coldStartSeconds'] = ColdStart(os.path.abspath(coldStartFile))
+
+	return(report)
+
+
+if __name__ == '__main__' :
+	parser = argparse.ArgumentParser(description = 'Benchmark the logical prior algorithms')
+	parser.add_argument('--seconds', type = float, default = 2.0,
+	                    help = 'sampling time for each problem')
+	parser.add_argument('--sizes', default = '10,20,40,80',
+	                    help = 'comma separated synthetic knowledge base sizes')
+	parser.add_argument('--files', default = 'ExampleInput*.csv',
+	                    help = 'glob of example input files')
+	parser.add_argument('--seed', type = int, default = None,
+	                    help = 'seed for the samplers, for repeatable runs')
+	parser.add_argument('--cold-start', default = 'ExampleInput4.csv',
+	                    help = 'boolean input file to time fresh processes on, or none')
+	parser.add_argument('--output', default = None,
+	                    help = 'file to write the JSON report to, defaults to stdout')
+	args = parser.parse_args()
+
+	sizes = [int(size) for size in args.sizes.split(',') if size]
+	coldStartFile = None if args.cold_start == 'none' else args.cold_start
+	report = RunBenchmarks(args.seconds, sizes, sorted(glob.glob(args.files)), args.seed,
+	                       coldStartFile)
+	if args.output is None :
+		print(json.dumps(report, indent = 2, sort_keys = True))
+	else :
+		with open(args.output, 'w') as outputFile :
+			json.dump(report, outputFile, indent = 2, sort_keys = True)
@@ -0,0 +1,172 @@
+# Logical priors for knowledge bases of boolean variables, without z3.
+#
+# Sentences are parsed into SentenceParser nodes and sampled by
+# DemskiPrior on the sat backend, which writes them as clauses for the
+# pure Python SatSolver of BooleanSat.py, so a short run on a boolean
+# input never pays for loading z3. PriorInputFile takes this route
+# whenever it can and otherwise hands the file to the z3 implementation.
+#
+# Usage: python BooleanPrior.py FILE [--seconds S] [--samples N]
+#                                    [--seed K] [--z3] [--export PREFIX]
+#                                    [--workers N]
+
+import argparse
+import collections
+import csv
+import re
+import sys
+import time
+
+import LogicalFunctions as LF
+from Instrumentation import noStats
+from ModelStore import exportModelSets
+from RandomStreams import RandomStream
+from SentenceParser import SentenceParser, ParseDeclarations
+from VectorizedEval import EvaluateAll, EvaluateSentence
+
+
+# DemskiPrior options the boolean engine passes on. Any other option,
+# such as a cache or a backend, sends the file to the z3 implementation
+booleanOptions = frozenset(['rng', 'cachePrefixes', 'stats', 'targetWidth', 'confidence',
+	'progressCallback', 'checkEvery', 'incremental', 'propagate', 'importance', 'coinBias',
+	'orderBias'])
+
+# The parsed contents of a boolean input file. The sentences are
+# SentenceParser node ids, and updateNodes is None without a fourth row
+booleanInput = collections.namedtuple("BooleanInput", ['variables', 'parser',
+	'knowledgeNodes', 'interestNode', 'updateNodes'])
+
+
+# @return : true if every variable is a boolean with a fixed probability
+def IsPureBoolean(variables) :
+	return(all(variables[varName][1] == 'bool' and not variables[varName][-1]
+	           for varName in variables))
+
+# Parses a four-row csv input file into sentence nodes
+# @return : a BooleanInput tuple, or None if the file is a record file or
+#           declares unif or unfixed variables
+def ReadBooleanInput(csvFileName) :
+	with open(csvFileName, 'rb') as csvFile :
+		rows = list(csv.reader(csvFile, delimiter=','))
+	if not rows or [field.strip() for field in rows[0]] == ['record', 'text'] :
+		return(None)
+	while len(rows) < 4 :
+		rows.append([])
+
+	variables = ParseDeclarations(rows[0])
+	if not IsPureBoolean(variables) :
+		return(None)
+	parser = SentenceParser(variables)
+	knowledgeNodes = [parser.parseNode(sentence) for sentence in rows[1] if sentence != '']
+
+	# As in ParseInputFile, the first query is the sentence of interest
+	queryStrings = [queryString for queryString in rows[2] if queryString.strip() != '']
+	if not queryStrings :
+		sys.exit(csvFileName + " has no sentence of interest")
+	interest = re.split(r'(?<!\|)\|(?!\|)|\bgiven\b', queryStrings[0])[0]
+	interestNode = parser.parseNode(interest)
+
+	updateNodes = None
+	if len(rows) > 3 and rows[3] :
+		updateNodes = [parser.parseNode(sentence) for sentence in rows[3] if sentence.strip() != '']
+	return(booleanInput(variables = variables, parser = parser, knowledgeNodes = knowledgeNodes,
+		interestNode = interestNode, updateNodes = updateNodes))
+
+# Counterpart of ParseInputFile for boolean input files
+# @exportPrefix   : as for ParseInputFile
+# @samplerOptions : any of booleanOptions, as for DemskiPrior
+# @return         : the same tuple as ParseInputFile, or None if the file
+#                   isn't a purely boolean four-row csv file
+def BooleanInputFile(csvFileName, secondsToRun, numSamples=None, exportPrefix=None,
+                     **samplerOptions) :
+	stats = samplerOptions.get('stats', noStats)
+	with stats.phase('parse') :
+		parsed = ReadBooleanInput(csvFileName)
+	if parsed is None :
+		return(None)
+
+	consistentPaths, initialSOICount, trueVarNames = LF.DemskiPrior(parsed.knowledgeNodes,
+		parsed.variables, parsed.interestNode, secondsToRun, numSamples, backend = 'sat',
+		parser = parsed.parser, **samplerOptions)
+	numInitialModels = len(consistentPaths)
+
+	# Every model is a complete assignment, so it is consistent with the
+	# updates exactly when it satisfies them, once the updates are known
+	# to be consistent with the knowledge base
+	updatedSOICount = initialSOICount
+	updatedPaths = None
+	if parsed.updateNodes is not None :
+		T = LF.NewSolver(parsed.knowledgeNodes + parsed.updateNodes, parsed.variables, 'sat',
+		                 parsed.parser)
+		if not LF.solverCheck(T, stats, 'updateConsistency') :
+			sys.exit("Background knowledge not consistent on updating")
+		with stats.phase('update') :
+			kept = EvaluateAll(parsed.updateNodes, consistentPaths, parser = parsed.parser)
+			updatedPaths = consistentPaths.select(kept)
+			updatedSOICount = LF.weightedCount(updatedPaths,
+				EvaluateSentence(parsed.interestNode, updatedPaths, parser = parsed.parser))
+	exportModelSets(exportPrefix, consistentPaths, updatedPaths)
+	if updatedPaths is not None :
+		consistentPaths = updatedPaths
+	return((consistentPaths, numInitialModels,
+		initialSOICount, updatedSOICount, len(consistentPaths)))
+
+# Runs the prior on an input file with the boolean engine when the file
+# is a purely boolean four-row csv and only its options are given, and
+# with StreamInputFile (so z3) otherwise
+# @exportPrefix : as for ParseInputFile
+# @numWorkers   : as for ParseInputFile. Boolean files have no unfixed
+#                 meta-priors, so the boolean engine doesn't need it
+# @return       : the same tuple as ParseInputFile
+def PriorInputFile(fileName, secondsToRun, numSamples=None, exportPrefix=None, numWorkers=None,
+                   **samplerOptions) :
+	if not fileName.endswith('.jsonl') and set(samplerOptions) <= booleanOptions :
+		result = BooleanInputFile(fileName, secondsToRun, numSamples, exportPrefix,
+		                          **samplerOptions)
+		if result is not None :
+			return(result)
+	import StreamingInput
+	return(StreamingInput.StreamInputFile(fileName, secondsToRun, numSamples,
+		exportPrefix = exportPrefix, numWorkers = numWorkers, **samplerOptions))
+
+
+if __name__ == '__main__' :
+	start = time.time()
+	parser = argparse.ArgumentParser(description = 'Approximate the logical prior of an input file')
+	parser.add_argument('file', help = 'a four-row csv or record input file')
+	parser.add_argument('--seconds', type = float, default = None,
+	                    help = 'sampling time')
+	parser.add_argument('--samples', type = int, default = None,
+	                    help = 'number of models to sample')
+	parser.add_argument('--seed', type = int, default = None,
+	                    help = 'seed for the sampler, for repeatable runs')
+	parser.add_argument('--z3', action = 'store_true',
+	                    help = 'always use the z3 implementation')
+	parser.add_argument('--export', default = None, metavar = 'PREFIX',
+	                    help = 'write the sampled and updated models to PREFIX.prior.models '
+	                           'and PREFIX.updated.models')
+	parser.add_argument('--workers', type = int, default = None,
+	                    help = 'processes to approximate unfixed meta-priors on')
+	args = parser.parse_args()
+	if args.seconds is None and args.samples is None :
+		args.seconds = 10.0
+
+	options = {}
+	if args.seed is not None :
+		options['rng'] = RandomStream(args.seed)
+	if args.z3 :
+		import StreamingInput
+		result = StreamingInput.StreamInputFile(args.file, args.seconds, args.samples,
+			exportPrefix = args.export, numWorkers = args.workers, **options)
+	else :
+		result = PriorInputFile(args.file, args.seconds, args.samples, args.export, args.workers,
+		                        **options)
+	consistentPaths, numModels, initialSOICount, updatedSOICount, numUpdatedModels = result
+
+	print('engine: ' + ('z3' if 'z3' in sys.modules else 'boolean'))
+	print('models: ' + str(numModels))
+	if numModels :
+		print('probability: ' + str(float(initialSOICount) / numModels))
+	if numUpdatedModels :
+		print('updated probability: ' + str(float(updatedSOICount) / numUpdatedModels))
+	print('seconds: ' + str(round(time.time() - start, 3)))
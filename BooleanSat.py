@@ -0,0 +1,498 @@
+import collections
+import heapq
+
+from LazyZ3 import z3
+
+
+# Raised for sentences which aren't purely boolean, e.g. ones using unif
+# variables or integers, and so can't be written as clauses
+class NotBoolean(Exception) :
+	pass
+
+
+# Writes parsed sentences as clauses with the Tseitin encoding. Each
+# connective gets a variable equivalent to it, so the clauses grow
+# linearly with the sentences, and a subexpression shared between
+# sentences is only encoded once.
+class ClauseEncoder(object) :
+
+	# @parser   : the SentenceParser the sentences were parsed with
+	# @varNames : names of the declared variables, which are numbered
+	#             1, 2, ... in this order. Connectives are numbered after
+	def __init__(self, parser, varNames) :
+		self.parser = parser
+		self.varIndex = dict((varName, i + 1) for i, varName in enumerate(varNames))
+		self.numVars = len(self.varIndex)
+		self.literals = {}
+		self.clauses = []
+		self.trueVariable = None
+
+	# @return : the index of a variable, numbering it after every variable
+	#           and connective so far if it wasn't declared
+	def variable(self, varName) :
+		if varName not in self.varIndex :
+			self.numVars += 1
+			self.varIndex[varName] = self.numVars
+		return(self.varIndex[varName])
+
+	# @return : a literal which is always true, defined once
+	def trueLiteral(self) :
+		if self.trueVariable is None :
+			self.numVars += 1
+			self.trueVariable = self.numVars
+			self.clauses.append([self.trueVariable])
+		return(self.trueVariable)
+
+	# @return : the literal equivalent to a node, adding the clauses which
+	#           define it and any of its descendants not yet encoded
+	def literal(self, nodeId) :
+		stack = [nodeId]
+		while stack :
+			top = stack[-1]
+			if top in self.literals :
+				stack.pop()
+				continue
+			key = self.parser.keys[top]
+			if key[0] == 'var' :
+				if key[1] not in self.varIndex :
+					raise NotBoolean(key[1] + " is not a boolean variable")
+				self.literals[top] = self.varIndex[key[1]]
+			elif key[0] == 'int' :
+				raise NotBoolean(str(key[1]) + " is an integer")
+			elif key[0] == 'const' :
+				self.literals[top] = self.trueLiteral() if key[1] else -self.trueLiteral()
+			else :
+				unencoded = [child for child in key[1:] if child not in self.literals]
+				if unencoded :
+					stack.extend(unencoded)
+					continue
+				self.literals[top] = self.define(key[0], [self.literals[child] for child in key[1:]])
+			stack.pop()
+		return(self.literals[nodeId])
+
+	# @return : a literal equivalent to the connective of the operands
+	def define(self, operator, operands) :
+		if operator == 'not' :
+			return(-operands[0])
+		a, b = operands
+		if operator == 'implies' :
+			operator, a = 'or', -a
+		elif operator == 'eq' :
+			return(-self.define('xor', [a, b]))
+		elif operator == 'ne' :
+			operator = 'xor'
+		if operator not in ['and', 'or', 'xor'] :
+			raise NotBoolean(operator + " is not a boolean connective")
+
+		self.numVars += 1
+		out = self.numVars
+		if operator == 'and' :
+			self.clauses.extend([[-out, a], [-out, b], [out, -a, -b]])
+		elif operator == 'or' :
+			self.clauses.extend([[-out, a, b], [out, -a], [out, -b]])
+		else :
+			self.clauses.extend([[-out, a, b], [-out, -a, -b], [out, -a, b], [out, a, -b]])
+		return(out)
+
+	# Adds clauses asserting a node. Conjunctions at the top of the
+	# sentence are split into their parts, which needs no new variables
+	def assertNode(self, nodeId) :
+		stack = [(nodeId, True)]
+		while stack :
+			node, positive = stack.pop()
+			key = self.parser.keys[node]
+			if key[0] == 'not' :
+				stack.append((key[1], not positive))
+			elif key[0] == 'and' and positive :
+				stack.extend([(key[1], True), (key[2], True)])
+			elif key[0] == 'or' and not positive :
+				stack.extend([(key[1], False), (key[2], False)])
+			elif key[0] == 'implies' and not positive :
+				stack.extend([(key[1], True), (key[2], False)])
+			else :
+				literal = self.literal(node)
+				self.clauses.append([literal if positive else -literal])
+
+
+# Interns a boolean z3 sentence as nodes of a parser, the form
+# ClauseEncoder writes as clauses. Conjunctions and disjunctions of more
+# than two sentences become right-nested pairs, as the parser nests them,
+# so a sentence built from parser nodes is interned as the same nodes.
+# @parser   : the SentenceParser to intern the nodes in
+# @sentence : a z3 sentence, or a python bool
+# @varNames : optional set, to which the names of the variables met are
+#             added
+# @return   : the id of the sentence's node
+def ExpressionNode(parser, sentence, varNames=None) :
+	if sentence is True or sentence is False :
+		return(parser.intern(('const', sentence)))
+	nodeIds = {}
+	stack = [sentence]
+	while stack :
+		term = stack[-1]
+		termId = term.get_id()
+		if termId in nodeIds :
+			stack.pop()
+			continue
+		if not z3.is_bool(term) :
+			raise NotBoolean(str(term) + " is not boolean")
+		kind = term.decl().kind()
+		if z3.is_true(term) or z3.is_false(term) :
+			nodeIds[termId] = parser.intern(('const', z3.is_true(term)))
+		elif kind == z3.Z3_OP_UNINTERPRETED and term.num_args() == 0 :
+			varName = term.decl().name()
+			if varNames is not None :
+				varNames.add(varName)
+			nodeIds[termId] = parser.intern(('var', varName))
+		else :
+			children = term.children()
+			unvisited = [child for child in children if child.get_id() not in nodeIds]
+			if unvisited :
+				stack.extend(unvisited)
+				continue
+			operator = expressionOperators().get(kind)
+			childIds = [nodeIds[child.get_id()] for child in children]
+			if operator == 'not' and len(childIds) == 1 :
+				nodeId = parser.intern(('not', childIds[0]))
+			elif operator in ['and', 'or'] and len(childIds) >= 2 :
+				nodeId = childIds[-1]
+				for childId in reversed(childIds[:-1]) :
+					nodeId = parser.intern((operator, childId, nodeId))
+			elif operator is not None and operator != 'not' and len(childIds) == 2 :
+				nodeId = parser.intern((operator, childIds[0], childIds[1]))
+			else :
+				raise NotBoolean(str(term) + " is not a boolean connective")
+			nodeIds[termId] = nodeId
+		stack.pop()
+	return(nodeIds[sentence.get_id()])
+
+# The parser's name for each z3 boolean connective, filled in on first use
+_expressionOperators = {}
+
+def expressionOperators() :
+	if not _expressionOperators :
+		_expressionOperators.update([(z3.Z3_OP_NOT, 'not'), (z3.Z3_OP_AND, 'and'),
+			(z3.Z3_OP_OR, 'or'), (z3.Z3_OP_XOR, 'xor'), (z3.Z3_OP_IMPLIES, 'implies'),
+			(z3.Z3_OP_EQ, 'eq'), (z3.Z3_OP_IFF, 'eq'), (z3.Z3_OP_DISTINCT, 'ne')])
+	return(_expressionOperators)
+
+
+# The Luby restart sequence 1, 1, 2, 1, 1, 2, 4, ...
+# @return : its i'th term, counting from 0
+def luby(i) :
+	size, power = 1, 1
+	while size < i + 1 :
+		power *= 2
+		size = 2 * size + 1
+	while size - 1 != i :
+		size = (size - 1) // 2
+		power //= 2
+		i = i % size
+	return(power)
+
+
+# A conflict driven clause learning SAT solver. Clauses are lists of
+# signed integer literals over variables numbered from 1, as for
+# PropagationTrail. Assumptions passed to solve are kept as the first
+# decision levels, and a call whose assumptions start with the previous
+# call's keeps those levels instead of propagating them again, which
+# suits the sampler's checks of one growing partial assignment.
+class SatSolver(object) :
+
+	restartBase = 100
+	decay = 0.95
+
+	def __init__(self, numVars=0, clauses=[]) :
+		self.numVars = 0
+		self.values = [None]
+		self.varLevel = [0]
+		self.reasons = [None]
+		self.activity = [0.0]
+		self.phase = [False]
+		self.order = []
+		self.increment = 1.0
+		self.clauses = []
+		self.watches = collections.defaultdict(list)
+		self.trail = []
+		self.trailLimits = []
+		self.propagated = 0
+		# The assumption made at each of the first decision levels
+		self.assumed = []
+		self.consistent = True
+		self.conflicts = 0
+		self.solves = 0
+		self.addVariables(numVars)
+		for clause in clauses :
+			self.addClause(clause)
+
+	def addVariables(self, numVars) :
+		for i in range(numVars) :
+			self.numVars += 1
+			self.values.append(None)
+			self.varLevel.append(0)
+			self.reasons.append(None)
+			self.activity.append(0.0)
+			self.phase.append(False)
+			heapq.heappush(self.order, (0.0, self.numVars))
+
+	# @return : True, False or None (unassigned) for a literal
+	def literalValue(self, literal) :
+		value = self.values[abs(literal)]
+		if value is None or literal > 0 :
+			return(value)
+		return(not value)
+
+	# Adds a clause for good, dropping any assumptions
+	# @return : False if the clauses are now unsatisfiable
+	def addClause(self, clause) :
+		self.backtrack(0)
+		literals = []
+		for literal in set(clause) :
+			if -literal in clause :
+				return(self.consistent)
+			value = self.literalValue(literal)
+			if value is True :
+				return(self.consistent)
+			if value is None :
+				literals.append(literal)
+		if not literals :
+			self.consistent = False
+		elif len(literals) == 1 :
+			self.enqueue(literals[0], None)
+			if self.propagate() is not None :
+				self.consistent = False
+		else :
+			self.attach(literals)
+		return(self.consistent)
+
+	# @return : the index of the clause, which watches its first two literals
+	def attach(self, clause) :
+		clauseIndex = len(self.clauses)
+		self.clauses.append(clause)
+		self.watches[clause[0]].append(clauseIndex)
+		self.watches[clause[1]].append(clauseIndex)
+		return(clauseIndex)
+
+	def enqueue(self, literal, reason) :
+		variable = abs(literal)
+		self.values[variable] = literal > 0
+		self.varLevel[variable] = len(self.trailLimits)
+		self.reasons[variable] = reason
+		self.trail.append(literal)
+
+	# Propagates every literal on the trail not yet propagated, using two
+	# watched literals per clause
+	# @return : the index of a clause with every literal false, or None
+	def propagate(self) :
+		values = self.values
+		while self.propagated < len(self.trail) :
+			falseLiteral = -self.trail[self.propagated]
+			self.propagated += 1
+			watching = self.watches[falseLiteral]
+			stillWatching = []
+			conflict = None
+			position = 0
+			while position < len(watching) :
+				clauseIndex = watching[position]
+				position += 1
+				clause = self.clauses[clauseIndex]
+				if clause[0] == falseLiteral :
+					clause[0], clause[1] = clause[1], clause[0]
+
+				first = clause[0]
+				firstValue = values[abs(first)]
+				if firstValue is not None and firstValue == (first > 0) :
+					stillWatching.append(clauseIndex)
+					continue
+
+				# Look for another literal to watch
+				moved = False
+				for k in range(2, len(clause)) :
+					value = values[abs(clause[k])]
+					if value is None or value == (clause[k] > 0) :
+						clause[1], clause[k] = clause[k], clause[1]
+						self.watches[clause[1]].append(clauseIndex)
+						moved = True
+						break
+				if moved :
+					continue
+
+				stillWatching.append(clauseIndex)
+				if firstValue is not None :
+					conflict = clauseIndex
+					stillWatching.extend(watching[position:])
+					break
+				self.enqueue(first, clauseIndex)
+			self.watches[falseLiteral] = stillWatching
+			if conflict is not None :
+				self.propagated = len(self.trail)
+				return(conflict)
+		return(None)
+
+	# Undoes every decision level above the given one
+	def backtrack(self, level) :
+		if len(self.trailLimits) <= level :
+			return
+		mark = self.trailLimits[level]
+		for literal in self.trail[mark:] :
+			variable = abs(literal)
+			self.phase[variable] = self.values[variable]
+			self.values[variable] = None
+			self.reasons[variable] = None
+			heapq.heappush(self.order, (-self.activity[variable], variable))
+		del self.trail[mark:]
+		del self.trailLimits[level:]
+		del self.assumed[level:]
+		self.propagated = mark
+
+	def bump(self, variable) :
+		self.activity[variable] += self.increment
+		if self.activity[variable] > 1e100 :
+			self.activity = [activity * 1e-100 for activity in self.activity]
+			self.increment *= 1e-100
+			self.order = [(-self.activity[v], v) for v in range(1, self.numVars + 1)
+			              if self.values[v] is None]
+			heapq.heapify(self.order)
+		elif self.values[variable] is None :
+			heapq.heappush(self.order, (-self.activity[variable], variable))
+
+	# Finds the first unique implication point of a conflict
+	# @return : a pair of the learned clause, whose first literal is the
+	#           one it asserts, and the level to backtrack to
+	def analyze(self, conflict) :
+		level = len(self.trailLimits)
+		seen = set()
+		learned = [None]
+		pending = 0
+		clause = self.clauses[conflict]
+		literal = None
+		index = len(self.trail) - 1
+		while True :
+			for other in (clause if literal is None else clause[1:]) :
+				variable = abs(other)
+				if variable not in seen and self.varLevel[variable] > 0 :
+					seen.add(variable)
+					self.bump(variable)
+					if self.varLevel[variable] == level :
+						pending += 1
+					else :
+						learned.append(other)
+			while abs(self.trail[index]) not in seen :
+				index -= 1
+			literal = self.trail[index]
+			index -= 1
+			pending -= 1
+			if pending == 0 :
+				break
+			clause = self.clauses[self.reasons[abs(literal)]]
+		learned[0] = -literal
+
+		backtrackLevel = 0
+		if len(learned) > 1 :
+			highest = max(range(1, len(learned)), key = lambda i : self.varLevel[abs(learned[i])])
+			learned[1], learned[highest] = learned[highest], learned[1]
+			backtrackLevel = self.varLevel[abs(learned[1])]
+		return((learned, backtrackLevel))
+
+	# @return : an unassigned variable of greatest activity, or None
+	def pickBranch(self) :
+		if len(self.order) > 10 * self.numVars + 100 :
+			self.order = [(-self.activity[v], v) for v in range(1, self.numVars + 1)
+			              if self.values[v] is None]
+			heapq.heapify(self.order)
+		while self.order :
+			variable = heapq.heappop(self.order)[1]
+			if self.values[variable] is None :
+				return(variable)
+		return(None)
+
+	# Backtracks to the levels shared with the previous assumptions
+	def keepAssumed(self, assumptions) :
+		common = 0
+		limit = min(len(self.assumed), len(assumptions))
+		while common < limit and self.assumed[common] == assumptions[common] :
+			common += 1
+		self.backtrack(common)
+
+	# Sets the assumptions as decision levels and propagates them, without
+	# searching further
+	# @return : False if they conflict by propagation alone
+	def assume(self, assumptions) :
+		if not self.consistent :
+			return(False)
+		self.keepAssumed(assumptions)
+		while True :
+			if self.propagate() is not None :
+				self.backtrack(max(len(self.trailLimits) - 1, 0))
+				return(False)
+			level = len(self.trailLimits)
+			if level == len(assumptions) :
+				return(True)
+			literal = assumptions[level]
+			value = self.literalValue(literal)
+			if value is False :
+				return(False)
+			self.trailLimits.append(len(self.trail))
+			self.assumed.append(literal)
+			if value is None :
+				self.enqueue(literal, None)
+
+	# @return : the value of a variable implied by the clauses and the
+	#           assumptions last given to assume, or None if it is free
+	def impliedValue(self, variable) :
+		if self.values[variable] is None or self.varLevel[variable] > len(self.assumed) :
+			return(None)
+		return(self.values[variable])
+
+	# @assumptions : literals which must hold for this call only
+	# @return      : True if the clauses and assumptions are satisfiable,
+	#                in which case modelValue gives a satisfying model
+	def solve(self, assumptions=[]) :
+		self.solves += 1
+		if not self.consistent :
+			return(False)
+		self.keepAssumed(assumptions)
+		restarts = 0
+		conflictLimit = self.restartBase
+		while True :
+			conflict = self.propagate()
+			if conflict is not None :
+				self.conflicts += 1
+				if not self.trailLimits :
+					self.consistent = False
+					return(False)
+				learned, backtrackLevel = self.analyze(conflict)
+				self.backtrack(backtrackLevel)
+				if len(learned) == 1 :
+					self.enqueue(learned[0], None)
+				else :
+					self.enqueue(learned[0], self.attach(learned))
+				self.increment /= self.decay
+				conflictLimit -= 1
+				if conflictLimit == 0 :
+					restarts += 1
+					conflictLimit = self.restartBase * luby(restarts)
+					self.backtrack(len(self.assumed))
+				continue
+
+			level = len(self.trailLimits)
+			if level < len(assumptions) :
+				literal = assumptions[level]
+				value = self.literalValue(literal)
+				if value is False :
+					return(False)
+				self.trailLimits.append(len(self.trail))
+				self.assumed.append(literal)
+				if value is None :
+					self.enqueue(literal, None)
+				continue
+
+			variable = self.pickBranch()
+			if variable is None :
+				return(True)
+			self.trailLimits.append(len(self.trail))
+			self.enqueue(variable if self.phase[variable] else -variable, None)
+
+	# @return : the variable's value in the model found by the last solve
+	def modelValue(self, variable) :
+		return(self.values[variable])
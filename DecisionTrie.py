@@ -0,0 +1,61 @@
+import collections
+
+
+# One explored prefix of decisions. children maps each (name, value)
+# decision taken after the prefix to the prefix extended by it, and
+# unsat holds the decisions found inconsistent with the prefix
+class decisionNode(object) :
+	__slots__ = ('children', 'unsat')
+
+	def __init__(self) :
+		self.children = {}
+		self.unsat = set()
+
+
+# Trie of the decision prefixes explored by DemskiPrior. Whether a
+# choice is consistent depends only on the knowledge base and the
+# decisions made before it, so a sample whose first choices repeat an
+# earlier sample's can read the results of their checks from the trie
+# instead of calling the solver again. Only valid for one knowledge base.
+class DecisionTrie(object) :
+
+	# @maxNodes : the most prefixes to remember. Once full, samples still
+	#             use the prefixes already stored but add no new ones
+	def __init__(self, maxNodes=100000) :
+		self.root = decisionNode()
+		self.maxNodes = maxNodes
+		self.numNodes = 1
+		self.hits = collections.Counter()
+
+	# @node     : the current prefix, or None once a sample has left the
+	#             stored prefixes
+	# @decision : a (variable name, value) pair
+	# @return   : True if the decision is known consistent after the
+	#             prefix, False if known inconsistent, None if unexplored
+	def known(self, node, decision) :
+		if node is None :
+			return(None)
+		if decision in node.children :
+			self.hits['sat'] += 1
+			return(True)
+		if decision in node.unsat :
+			self.hits['unsat'] += 1
+			return(False)
+		return(None)
+
+	# Records that a decision is inconsistent after the prefix
+	def markUnsat(self, node, decision) :
+		if node is not None :
+			node.unsat.add(decision)
+
+	# Records the decision actually made after the prefix
+	# @return : the extended prefix, or None if it isn't stored
+	def advance(self, node, decision) :
+		if node is None :
+			return(None)
+		child = node.children.get(decision)
+		if child is None and self.numNodes < self.maxNodes :
+			child = decisionNode()
+			node.children[decision] = child
+			self.numNodes += 1
+		return(child)
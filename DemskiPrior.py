@@ -1,8 +1,10 @@
-from z3 import *
 from random import randint
+import sys
 
 
 def DemskiPrior(knowledgeBase, variables, variableOfInterest) :
+	# z3 is only loaded once the prior is run, not on import
+	from z3 import Solver, Not, sat, unsat
 
 
 	# Check if knowledge base is consistent
@@ -0,0 +1,173 @@
+import collections
+import contextlib
+import json
+import math
+import time
+
+
+# Counters and timers for the prior algorithms. Pass an instance as the
+# stats argument of DemskiPrior, consumptiveUpdate,
+# approximateUnfixedProbabilities or ParseInputFile to find out where
+# time goes: solver checks and their latency per phase, how often each
+# variable's first choice was unsat, how many draws each unif variable
+# needed, how fast streamed inputs parsed, and the total time spent in
+# each phase.
+class SolverStats(object) :
+
+	# @traceFile : optional path. If given, every solver check and phase
+	#              is also written to it as one JSON object per line
+	def __init__(self, traceFile=None) :
+		self.checks = collections.Counter()
+		self.checkSeconds = collections.Counter()
+		self.latencyHistogram = collections.Counter()
+		self.varSat = collections.Counter()
+		self.varUnsat = collections.Counter()
+		self.varForced = collections.Counter()
+		self.unifDraws = collections.Counter()
+		self.unifRetries = collections.Counter()
+		self.retryHistogram = collections.Counter()
+		self.phaseSeconds = collections.Counter()
+		self.phaseCalls = collections.Counter()
+		self.parseCounts = collections.Counter()
+		self.traceFile = traceFile
+		self.trace = None
+
+	def writeTrace(self, event) :
+		if self.traceFile is None :
+			return
+		if self.trace is None :
+			self.trace = open(self.traceFile, 'a')
+		self.trace.write(json.dumps(event) + '\n')
+
+	# Writes out buffered trace events, e.g. before forking workers which
+	# would otherwise inherit them
+	def flush(self) :
+		if self.trace is not None :
+			self.trace.flush()
+
+	def close(self) :
+		if self.trace is not None :
+			self.trace.close()
+			self.trace = None
+
+	# Records one solver check
+	# @phase   : the part of the algorithm making the check
+	# @varName : the variable being assigned, if any
+	# @result  : the z3 check result
+	# @seconds : how long the check took
+	def recordCheck(self, phase, varName, result, seconds) :
+		self.checks[phase] += 1
+		self.checkSeconds[phase] += seconds
+		microseconds = max(seconds * 1e6, 1.0)
+		self.latencyHistogram[2 ** int(math.ceil(math.log(microseconds, 2)))] += 1
+		if varName is not None :
+			if str(result) == 'unsat' :
+				self.varUnsat[varName] += 1
+			else :
+				self.varSat[varName] += 1
+		self.writeTrace({'event' : 'check', 'phase' : phase, 'var' : varName,
+		                 'result' : str(result), 'seconds' : seconds})
+
+	# Records a variable assigned by unit propagation without a check
+	def recordForced(self, varName) :
+		self.varForced[varName] += 1
+
+	# Records how many solver checks a unif variable took to pick a value
+	def recordUnifDraw(self, varName, draws) :
+		self.unifDraws[varName] += 1
+		self.unifRetries[varName] += draws - 1
+		self.retryHistogram[draws - 1] += 1
+
+	# Records time spent in a phase of the algorithm
+	def recordPhase(self, name, seconds) :
+		self.phaseSeconds[name] += seconds
+		self.phaseCalls[name] += 1
+		self.writeTrace({'event' : 'phase', 'phase' : name, 'seconds' : seconds})
+
+	# Records the throughput of parsing an input
+	# @records   : how many records (or rows) were read
+	# @sentences : how many sentences were parsed
+	# @seconds   : how long reading them took
+	def recordParse(self, records, sentences, seconds) :
+		self.parseCounts['records'] += records
+		self.parseCounts['sentences'] += sentences
+		self.parseCounts['seconds'] += seconds
+		self.writeTrace({'event' : 'parse', 'records' : records, 'sentences' : sentences,
+		                 'seconds' : seconds})
+
+	# Context manager timing a phase of the algorithm
+	@contextlib.contextmanager
+	def phase(self, name) :
+		start = time.time()
+		try :
+			yield
+		finally :
+			self.recordPhase(name, time.time() - start)
+
+	# Adds the counts of another SolverStats, e.g. from a worker process
+	def merge(self, other) :
+		for name in ['checks', 'checkSeconds', 'latencyHistogram', 'varSat', 'varUnsat',
+		             'varForced', 'unifDraws', 'unifRetries', 'retryHistogram', 'phaseSeconds', 'phaseCalls',
+		             'parseCounts'] :
+			getattr(self, name).update(getattr(other, name))
+
+	# Stats objects cross process boundaries without their open trace
+	def __getstate__(self) :
+		state = dict(self.__dict__)
+		state['trace'] = None
+		return(state)
+
+	# @return : the fraction of checks on each variable that were unsat
+	def unsatRates(self) :
+		rates = {}
+		for varName in set(self.varSat) | set(self.varUnsat) :
+			total = self.varSat[varName] + self.varUnsat[varName]
+			rates[varName] = float(self.varUnsat[varName]) / total
+		return(rates)
+
+	# @return : everything recorded, as a JSON-serialisable dictionary
+	def summary(self) :
+		meanRetries = {}
+		for varName in self.unifDraws :
+			meanRetries[varName] = float(self.unifRetries[varName]) / self.unifDraws[varName]
+		return({'checks' : dict(self.checks),
+		        'totalChecks' : sum(self.checks.values()),
+		        'checkSeconds' : dict(self.checkSeconds),
+		        'latencyHistogramMicroseconds' : dict((str(bound), count) for bound, count
+		                                              in sorted(self.latencyHistogram.items())),
+		        'unsatRates' : self.unsatRates(),
+		        'forcedByPropagation' : dict(self.varForced),
+		        'unifMeanRetries' : meanRetries,
+		        'unifRetryHistogram' : dict((str(retries), count) for retries, count
+		                                    in sorted(self.retryHistogram.items())),
+		        'phaseSeconds' : dict(self.phaseSeconds),
+		        'phaseCalls' : dict(self.phaseCalls),
+		        'parse' : dict(self.parseCounts,
+		                       sentencesPerSecond = self.parseCounts['sentences'] /
+		                                            max(self.parseCounts['seconds'], 1e-9))})
+
+
+# Stand-in for a SolverStats when none is given, so callers can always
+# write stats.phase(...) without checking for None
+class _NoStats(object) :
+
+	@contextlib.contextmanager
+	def phase(self, name) :
+		yield
+
+	def recordCheck(self, phase, varName, result, seconds) :
+		pass
+
+	def recordForced(self, varName) :
+		pass
+
+	def recordPhase(self, name, seconds) :
+		pass
+
+	def recordUnifDraw(self, varName, draws) :
+		pass
+
+	def recordParse(self, records, sentences, seconds) :
+		pass
+
+noStats = _NoStats()
@@ -0,0 +1,291 @@
+from LazyZ3 import z3
+import collections
+import sys
+
+import LogicalFunctions as LF
+
+
+# Raised when a knowledge base can't be compiled, either because it
+# isn't purely boolean or because it grew past the size limits
+class CompilationLimit(Exception) :
+	pass
+
+
+# Reduced ordered binary decision diagram. Node 0 is false, node 1 is
+# true, and every other node is a (level, low, high) triple where level
+# is the index of the variable branched on.
+class BDD(object) :
+
+	def __init__(self, numLevels, maxNodes=1000000) :
+		self.numLevels = numLevels
+		self.maxNodes = maxNodes
+		self.nodes = [(numLevels, 0, 0), (numLevels, 1, 1)]
+		self.unique = {}
+		self.applyCache = {}
+
+	# @return : the node branching on level, reusing an identical node
+	def mk(self, level, low, high) :
+		if low == high :
+			return(low)
+		key = (level, low, high)
+		node = self.unique.get(key)
+		if node is None :
+			if len(self.nodes) >= self.maxNodes :
+				raise CompilationLimit("BDD has more than " + str(self.maxNodes) + " nodes")
+			node = len(self.nodes)
+			self.nodes.append(key)
+			self.unique[key] = node
+		return(node)
+
+	def var(self, level) :
+		return(self.mk(level, 0, 1))
+
+	def negate(self, u) :
+		return(self.apply('xor', u, 1))
+
+	# Combines two diagrams with a binary boolean operator
+	# @op : one of 'and', 'or', 'xor', 'iff'
+	def apply(self, op, u, v) :
+		if u <= 1 and v <= 1 :
+			if op == 'and' :
+				return(u & v)
+			if op == 'or' :
+				return(u | v)
+			if op == 'xor' :
+				return(u ^ v)
+			return(1 - (u ^ v))
+
+		key = (op, u, v)
+		if key in self.applyCache :
+			return(self.applyCache[key])
+
+		uLevel, uLow, uHigh = self.nodes[u]
+		vLevel, vLow, vHigh = self.nodes[v]
+		level = min(uLevel, vLevel)
+		if uLevel != level :
+			uLow = uHigh = u
+		if vLevel != level :
+			vLow = vHigh = v
+		result = self.mk(level, self.apply(op, uLow, vLow), self.apply(op, uHigh, vHigh))
+		self.applyCache[key] = result
+		return(result)
+
+	# Builds the diagram for a boolean z3 sentence
+	# @levels : a dictionary from variable names to their levels
+	def fromZ3(self, sentence, levels) :
+		if sentence is True or sentence is False :
+			return(int(sentence))
+		if not z3.is_bool(sentence) :
+			raise CompilationLimit(str(sentence) + " is not boolean")
+		if z3.is_true(sentence) :
+			return(1)
+		if z3.is_false(sentence) :
+			return(0)
+		if z3.is_const(sentence) :
+			name = str(sentence)
+			if name not in levels :
+				raise CompilationLimit(name + " is not a declared variable")
+			return(self.var(levels[name]))
+
+		children = [self.fromZ3(child, levels) for child in sentence.children()]
+		kind = sentence.decl().kind()
+		if kind == z3.Z3_OP_NOT :
+			return(self.negate(children[0]))
+		if kind == z3.Z3_OP_AND :
+			return(self.fold('and', children))
+		if kind == z3.Z3_OP_OR :
+			return(self.fold('or', children))
+		if kind == z3.Z3_OP_XOR :
+			return(self.fold('xor', children))
+		if kind == z3.Z3_OP_IMPLIES :
+			return(self.apply('or', self.negate(children[0]), children[1]))
+		if kind == z3.Z3_OP_EQ :
+			return(self.apply('iff', children[0], children[1]))
+		if kind == z3.Z3_OP_DISTINCT and len(children) == 2 :
+			return(self.apply('xor', children[0], children[1]))
+		raise CompilationLimit("can't compile " + str(sentence))
+
+	def fold(self, op, children) :
+		result = children[0]
+		for child in children[1:] :
+			result = self.apply(op, result, child)
+		return(result)
+
+	# @return : whether some extension of the partial assignment satisfies u
+	# @mask   : bit i is set if the variable at level i is assigned
+	# @bits   : bit i holds the value of the variable at level i
+	def consistent(self, u, mask, bits, memo) :
+		if u <= 1 :
+			return(u == 1)
+		if u in memo :
+			return(memo[u])
+		level, low, high = self.nodes[u]
+		bit = 1 << level
+		if mask & bit :
+			result = self.consistent(high if bits & bit else low, mask, bits, memo)
+		else :
+			result = (self.consistent(low, mask, bits, memo) or
+			          self.consistent(high, mask, bits, memo))
+		memo[u] = result
+		return(result)
+
+	# @return : whether the full assignment given by bits satisfies u
+	def evaluate(self, u, bits) :
+		while u > 1 :
+			level, low, high = self.nodes[u]
+			u = high if bits & (1 << level) else low
+		return(u == 1)
+
+
+# The Demski prior of a purely boolean knowledge base computed exactly
+# from a BDD of the knowledge base rather than estimated by sampling.
+#
+# The sampling process picks a uniformly random unassigned variable and
+# sets it by its meta-prior unless only one value is consistent. The
+# distribution over partial assignments is propagated one variable at a
+# time, so the result is a distribution over the models of the knowledge
+# base which every query is evaluated against.
+class CompiledPrior(object) :
+
+	# @knowledgeBase : a list of z3 instances corresponding to the
+	#                  given axiom scheme
+	# @variables     : the dictionary of variables from ParseVariables
+	# @maxNodes      : largest BDD to build before giving up
+	# @maxStates     : most partial assignments to track at one step
+	#                  before giving up
+	# Raises CompilationLimit if the knowledge base is too large or
+	# contains non-boolean variables
+	def __init__(self, knowledgeBase, variables, maxNodes=1000000, maxStates=200000) :
+		self.varNames = list(variables.keys())
+		self.levels = {}
+		for varName in self.varNames :
+			if variables[varName][1] != 'bool' :
+				raise CompilationLimit(varName + " is not boolean")
+			self.levels[varName] = len(self.levels)
+
+		self.variables = variables
+		self.maxStates = maxStates
+		self.bdd = BDD(len(self.varNames), maxNodes)
+		self.root = 1
+		for sentence in knowledgeBase :
+			self.root = self.bdd.apply('and', self.root, self.bdd.fromZ3(sentence, self.levels))
+		if self.root == 0 :
+			sys.exit("Background knowledge not consistent")
+		self.modelProbabilities = None
+
+	# Runs the sampling process exactly using the current meta-priors
+	# @return : a dictionary from full models (as bits) to probabilities
+	def distribution(self) :
+		if self.modelProbabilities is not None :
+			return(self.modelProbabilities)
+
+		numVars = len(self.varNames)
+		probabilities = [self.variables[varName][2] for varName in self.varNames]
+		consistentCache = {}
+		def consistent(mask, bits) :
+			key = (mask, bits)
+			if key not in consistentCache :
+				consistentCache[key] = self.bdd.consistent(self.root, mask, bits, {})
+			return(consistentCache[key])
+
+		layer = {(0, 0) : 1.0}
+		for step in range(numVars) :
+			nextLayer = collections.defaultdict(float)
+			for (mask, bits), mass in layer.items() :
+				remaining = [i for i in range(numVars) if not mask & (1 << i)]
+				share = mass / len(remaining)
+				for i in remaining :
+					bit = 1 << i
+					trueOk  = consistent(mask | bit, bits | bit)
+					falseOk = consistent(mask | bit, bits)
+					if trueOk and falseOk :
+						nextLayer[(mask | bit, bits | bit)] += share * probabilities[i]
+						nextLayer[(mask | bit, bits)] += share * (1 - probabilities[i])
+					elif trueOk :
+						nextLayer[(mask | bit, bits | bit)] += share
+					else :
+						nextLayer[(mask | bit, bits)] += share
+			if len(nextLayer) > self.maxStates :
+				raise CompilationLimit("more than " + str(self.maxStates) + " partial assignments")
+			layer = nextLayer
+
+		self.modelProbabilities = dict((bits, mass) for (mask, bits), mass in layer.items())
+		return(self.modelProbabilities)
+
+	# @return : the prior probability of a z3 sentence
+	def probability(self, sentence) :
+		return(self.updatedProbability(sentence, []))
+
+	# Conditions the prior on new knowledge, as consumptiveUpdate does
+	# @return : the probability of sentence among the models where every
+	#           sentence of newKnowledge holds
+	def updatedProbability(self, sentence, newKnowledge) :
+		target = self.bdd.fromZ3(sentence, self.levels)
+		evidence = 1
+		for knowledgeSentence in newKnowledge :
+			evidence = self.bdd.apply('and', evidence, self.bdd.fromZ3(knowledgeSentence, self.levels))
+
+		evidenceMass = 0.0
+		targetMass = 0.0
+		for bits, mass in self.distribution().items() :
+			if self.bdd.evaluate(evidence, bits) :
+				evidenceMass += mass
+				if self.bdd.evaluate(target, bits) :
+					targetMass += mass
+		if evidenceMass == 0 :
+			sys.exit("Background knowledge not consistent on updating")
+		return(targetMass / evidenceMass)
+
+	# Exact counterpart of LF.approximateUnfixedProbabilities. Sets each
+	# unfixed variable's meta-prior to its probability under the prior,
+	# repeating for up to maxRounds rounds until no meta-prior changes
+	# by tolerance or more
+	def updateUnfixedProbabilities(self, unfixedVarNames, maxRounds=4, tolerance=0.02) :
+		for roundIndex in range(maxRounds) :
+			marginals = dict.fromkeys(unfixedVarNames, 0.0)
+			for bits, mass in self.distribution().items() :
+				for varName in unfixedVarNames :
+					if bits & (1 << self.levels[varName]) :
+						marginals[varName] += mass
+			change = max([0.0] + [abs(marginals[varName] - self.variables[varName][2])
+			                      for varName in unfixedVarNames])
+			for varName in unfixedVarNames :
+				self.variables[varName][2] = marginals[varName]
+			self.modelProbabilities = None
+			if change < tolerance :
+				break
+
+
+# Computes the prior probability of a sentence exactly, without sampling
+# @return : the probability, or None if the knowledge base can't be
+#           compiled within the limits
+def ExactDemskiPrior(knowledgeBase, variables, statementOfInterest, **limits) :
+	try :
+		return(CompiledPrior(knowledgeBase, variables, **limits).probability(statementOfInterest))
+	except CompilationLimit :
+		return(None)
+
+
+# Counterpart of LF.ParseInputFile which answers exactly when the input
+# can be compiled, and falls back on Demski's sampling algorithm when not
+# @csvFileName  : a string specifying the variables, background knowledge
+#                 and statement(s) of interest
+# @secondsToRun : how many seconds to sample for if compilation fails
+# @return       : a triple of the prior probability of the sentence of
+#                 interest, its probability after updating, and whether
+#                 the probabilities are exact
+def ExactInputFile(csvFileName, secondsToRun, **limits) :
+	parsed = LF.ReadInputFile(csvFileName)
+	updates = parsed.updatedKnowledgeSentences or []
+
+	try :
+		prior = CompiledPrior(parsed.backgroundKnowledge, parsed.variables, **limits)
+		if parsed.unfixedVarNames :
+			prior.updateUnfixedProbabilities(parsed.unfixedVarNames)
+		return((prior.probability(parsed.statementOfInterest),
+		        prior.updatedProbability(parsed.statementOfInterest, updates), True))
+	except CompilationLimit :
+		pass
+
+	result = LF.ParseInputFile(csvFileName, secondsToRun)
+	return((float(result[2]) / result[1], float(result[3]) / result[4], False))
@@ -0,0 +1,25 @@
+import importlib
+import sys
+
+
+# Loading z3 takes a noticeable part of a second, so the modules refer
+# to it through this stand-in, which only imports it the first time one
+# of its names is looked up. A run which never builds a z3 expression,
+# such as the pure boolean engine of BooleanPrior.py, never loads it.
+class lazyModule(object) :
+
+	def __init__(self, moduleName) :
+		self.moduleName = moduleName
+
+	# Only called for names not yet looked up, which are then kept
+	def __getattr__(self, name) :
+		value = getattr(importlib.import_module(self.moduleName), name)
+		setattr(self, name, value)
+		return(value)
+
+z3 = lazyModule('z3')
+
+# @return : true if value is a z3 expression. Nothing can be one before
+#           z3 is loaded, so asking never loads it
+def IsExpression(value) :
+	return('z3' in sys.modules and isinstance(value, z3.ExprRef))
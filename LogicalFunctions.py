@@ -1,182 +1,1056 @@
-from z3 import *
+from LazyZ3 import z3
 import collections
 import csv
-from random import randint, random, randrange
+import math
+import multiprocessing
+import numpy
+import os
+import re
+import sys
+import random as randomModule
 import time
 import cProfile
+from UnitPropagation import CompileCNF, PropagationTrail
+from ModelStore import ModelStore, TrueVarNamesView, concatenateStores, joinStores, \
+	exportModelSets
+from VectorizedEval import VectorizedSentence, NotVectorizable, EvaluateAll
+from ModelCache import KnowledgeBaseFingerprint
+from SentenceParser import SentenceParser, ParseDeclarations
+from Relevance import IncidenceIndex, SentenceVariables
+from DecisionTrie import DecisionTrie
+from SolverBackend import ChooseBackend, NewSolver, Z3Backend
+from RandomStreams import RandomStream
+from Instrumentation import SolverStats, noStats
+
+
+# Number of solver checks made by the functions in this module
+solverCheckCount = collections.Counter()
+
+# Checks T for satisfiability, counting the call
+# @T       : a solver backend, see SolverBackend.py
+# @stats   : a SolverStats to record the check's latency in
+# @phase   : the part of the algorithm making the check
+# @varName : the variable being assigned, if any
+# @assumptions : a list of literals assumed for this check only
+# @return  : True if satisfiable
+def solverCheck(T, stats=noStats, phase='other', varName=None, assumptions=()) :
+	solverCheckCount['checks'] += 1
+	if stats is noStats :
+		return(T.check(*assumptions))
+	start = time.time()
+	result = T.check(*assumptions)
+	stats.recordCheck(phase, varName, 'sat' if result else 'unsat', time.time() - start)
+	return(result)
 
+# Adds the sentences waiting in pending to T and empties it
+def flushPending(T, pending) :
+	if pending :
+		T.add(pending)
+		del pending[:]
+
+# How many random values of a unif variable are tried before its
+# feasible values are enumerated instead
+unifAttempts = 3
+
+# @rng    : the random generator to draw with
+# @return : a value in lower..upper which is not excluded, drawn in
+#           proportion to weights, or uniformly if they are None. None if
+#           every value of positive weight is excluded
+def drawValue(lower, upper, weights, excluded, rng=randomModule) :
+	if weights is None :
+		if len(excluded) > upper - lower :
+			return(None)
+		varValue = rng.randint(lower, upper)
+		while varValue in excluded :
+			varValue = rng.randint(lower, upper)
+		return(varValue)
+
+	total = sum(weight for offset, weight in enumerate(weights) if lower + offset not in excluded)
+	if total <= 0 :
+		return(None)
+	threshold = rng.random() * total
+	varValue = None
+	for offset, weight in enumerate(weights) :
+		if lower + offset in excluded or weight <= 0 :
+			continue
+		varValue = lower + offset
+		threshold -= weight
+		if threshold < 0 :
+			break
+	return(varValue)
+
+# Picks a value of a unif variable uniformly among those consistent with
+# what T asserts. A few random values are tried first, each with a single
+# check under an assumption; if they all fail the range is heavily
+# constrained, so the feasible values are enumerated by excluding each
+# model's value in turn and one of them is drawn. The chosen value is
+# added to T.
+# @T       : the solver backend holding the partial assignment
+# @varName : the variable's name
+# @lower   : the smallest value in its range
+# @upper   : the largest value in its range
+# @weights : optional relative probabilities of the values lower..upper,
+#            as approximated for unfixed unif variables. Values are then
+#            drawn in proportion to them instead of uniformly
+# @rng     : the random generator to draw with
+# @trie    : optional DecisionTrie whose results for the prefix node are
+#            used in place of checks, and which records new ones
+# @pending : optional list of literals not yet added to T, as kept by
+#            DemskiPrior. They are added before T is next checked, and
+#            the chosen value is appended to it rather than added to T
+# @return  : a pair of the value and the number of solver checks used,
+#            counting those answered by the trie
+def sampleUnif(T, varName, lower, upper, stats=noStats, weights=None,
+               rng=randomModule, trie=None, node=None, pending=None) :
+	excluded = set()
+	rangeSize = upper - lower + 1
+	if weights is not None :
+		rangeSize = sum(1 for weight in weights if weight > 0)
+	for attempt in range(min(unifAttempts, rangeSize)) :
+		varValue = drawValue(lower, upper, weights, excluded, rng)
+		equality = T.literal(varName, varValue)
+		consistent = None
+		if trie is not None :
+			consistent = trie.known(node, (varName, varValue))
+		if consistent is None :
+			flushPending(T, pending)
+			consistent = solverCheck(T, stats, 'unif', varName, [equality])
+			if not consistent and trie is not None :
+				trie.markUnsat(node, (varName, varValue))
+		if consistent :
+			if pending is None :
+				T.add(equality)
+			else :
+				pending.append(equality)
+			return((varValue, attempt + 1))
+		excluded.add(varValue)
+
+	flushPending(T, pending)
+	feasible = []
+	T.push()
+	T.add(T.bounds(varName, lower, upper))
+	for varValue in excluded :
+		T.add(T.negation(T.literal(varName, varValue)))
+	while solverCheck(T, stats, 'unifDomain', varName) :
+		varValue = T.value(varName)
+		feasible.append(varValue)
+		T.add(T.negation(T.literal(varName, varValue)))
+	T.pop()
+	if not feasible :
+		sys.exit("No value of " + varName + " in " + str(lower) + ".." + str(upper) +
+		         " is consistent with the knowledge base")
+	varValue = None
+	if weights is not None :
+		varValue = drawValue(lower, upper, weights, set(range(lower, upper + 1)) - set(feasible), rng)
+	if varValue is None :
+		varValue = feasible[rng.randrange(len(feasible))]
+	T.add(T.literal(varName, varValue))
+	return((varValue, len(excluded) + len(feasible) + 1))
+
+# Builds an importance sampling proposal which makes the statement of
+# interest likelier. Its variables are drawn earlier in the order, and
+# their coins lean towards the values they take in one model of the
+# knowledge base and the statement of interest.
+# @T          : a solver backend asserting the knowledge base
+# @coinBias   : the least probability a leaning coin gives its target
+# @orderBias  : how much more likely the statement's variables are to be
+#               drawn next than the other variables. This helps when the
+#               statement's variables are otherwise forced by earlier
+#               choices, but spreads the weights when they are not
+# @parser     : optional SentenceParser whose node the statement is
+# @return     : a pair of dictionaries, from variable names to proposal
+#               coin probabilities and to order weights. Both are empty
+#               if the statement of interest is impossible
+def importanceProposal(T, variables, statementOfInterest, coinBias, orderBias, stats=noStats,
+                       parser=None) :
+	coinProbabilities = {}
+	orderWeights = {}
+	T.push()
+	T.add(T.sentence(statementOfInterest))
+	if solverCheck(T, stats, 'importance') :
+		for varName in SentenceVariables(statementOfInterest, parser) & set(variables.keys()) :
+			if orderBias != 1 :
+				orderWeights[varName] = orderBias
+			variableList = variables[varName]
+			probability = variableList[2]
+			if variableList[1] == 'bool' and 0 < probability < 1 :
+				target = T.value(varName) is True
+				targetProbability = probability if target else 1 - probability
+				proposal = max(targetProbability, coinBias)
+				coinProbabilities[varName] = proposal if target else 1 - proposal
+	T.pop()
+	return((coinProbabilities, orderWeights))
 
 # Runs the Demski algorithm for generating a logical prior
 # @knowledgeBase	 : a list of z3 instances corresponding to the
-#                     given axiom scheme
+#                     given axiom scheme, or node ids of parser
 # @variables         : the list of z3 variables involved
 # @statementOfInterest: the variable to generate a prior probability on
-# @secondsToRun      : how much time to spend running the alg
-# @return            : a list of lists, where each element
-#                      of the larger list gives variables corresponding
-#                      to a consistent model
-def DemskiPrior(knowledgeBase, variables, statementOfInterest, secondsToRun) :
-
-	consistentPaths = list()
-	modelsTrueVarNames = list()
-
-	stopTime = time.time() + secondsToRun
+# @secondsToRun      : how much time to spend running the alg, or None
+#                      to run until one of the other stopping rules
+# @maxSamples        : stop after drawing this many models
+# @targetWidth       : stop once the confidence interval on the
+#                      probability of the statement of interest is at
+#                      most this wide
+# @confidence        : confidence level of that interval
+# @progressCallback  : called with a progress snapshot (see
+#                      progressSnapshot) every checkEvery models and once
+#                      at the end. Sampling stops if it returns True
+# @checkEvery        : how many models to draw between snapshots
+# @stats             : optional SolverStats to record checks and
+#                      phase timings in
+# @incremental       : if true the knowledge base is asserted once and
+#                      each sample runs inside a push/pop scope, keeping
+#                      the solver's learned lemmas between samples.
+#                      Otherwise the solver is reset for every sample
+# @propagate         : if true and every variable is boolean, variables
+#                      implied by earlier choices are assigned by unit
+#                      propagation over a CNF of the knowledge base
+#                      without calling the solver. The CNF is the same
+#                      whichever backend checks the choices, so the
+#                      backends draw the same models from the same seed
+# @solver            : optional solver backend which already asserts the
+#                      knowledge base, e.g. a Z3Backend filled while
+#                      streaming the input. Sampling is then always
+#                      incremental and the solver is left as it was given
+# @importance        : if true, models are drawn from a proposal leaning
+#                      towards the statement of interest (see
+#                      importanceProposal) and each carries the ratio of
+#                      its probability under Demski's process to that
+#                      under the proposal as its weight. The interest
+#                      count is then the sum of the weights of the models
+#                      where the statement holds, so divided by the
+#                      number of models it is still an unbiased estimate
+# @coinBias          : see importanceProposal
+# @orderBias         : see importanceProposal
+# @rng               : the random generator to sample with, e.g. a
+#                      random.Random or one from RandomStream. With a
+#                      seeded generator and a sample budget the models
+#                      are identical from run to run. Defaults to the
+#                      random module's shared generator
+# @cachePrefixes     : if true, the result of every check is kept in a
+#                      DecisionTrie of the choices made before it, and
+#                      later samples which make the same choices in the
+#                      same order reuse it instead of calling the solver.
+#                      The models drawn are the same either way
+# @trie              : optional DecisionTrie to use, e.g. one kept from
+#                      an earlier call on the same knowledge base
+# @backend           : 'z3' or 'sat', the solver to check choices with
+#                      (see NewSolver). By default the pure Python SAT
+#                      solver when every variable is boolean and z3
+#                      otherwise. Not used if solver is given
+# @parser            : optional SentenceParser. The knowledge base and
+#                      the statement of interest are then node ids of
+#                      it, as ReadBooleanInput in BooleanPrior.py gives
+#                      them, and with the sat backend z3 is never loaded
+# @return            : a triple of a ModelStore holding the consistent
+#                      models, the number of models where the statement
+#                      of interest was satisfiable, and a sequence giving
+#                      the names of the true variables in each model
+def DemskiPrior(knowledgeBase, variables, statementOfInterest, secondsToRun,
+                maxSamples=None, targetWidth=None, confidence=0.95,
+                progressCallback=None, checkEvery=100,
+                incremental=True, propagate=True, stats=noStats, solver=None,
+                importance=False, coinBias=0.8, orderBias=1.0, rng=randomModule,
+                cachePrefixes=True, trie=None, backend=None, parser=None) :
+
+	consistentPaths = ModelStore.fromVariables(variables, weighted = importance)
+
+	if secondsToRun is None and maxSamples is None and targetWidth is None :
+		sys.exit("DemskiPrior needs a time, sample or precision budget")
+	startTime = time.time()
+	stopTime = None
+	if secondsToRun is not None :
+		stopTime = startTime + secondsToRun
 	numLoops = 0
 	# Check if knowledge base is consistent
-	T = Solver()
-	for sentence in knowledgeBase :
-		T.add(sentence)
-	if (T.check() == unsat) :
+	if solver is not None :
+		T = solver
+		incremental = True
+	else :
+		T = NewSolver(knowledgeBase, variables, backend, parser)
+	baseScopes = T.num_scopes()
+	if not solverCheck(T, stats, 'consistency') :
 		sys.exit("Background knowledge not consistent")
 
+	with stats.phase('compile') :
+		trail = None
+		if propagate :
+			cnf = CompileCNF(knowledgeBase, variables, parser)
+			if cnf is not None :
+				numVars, clauses, varIndex = cnf
+				trail = PropagationTrail(numVars, clauses)
+
+		# Every sampled model is complete, so the statement of interest can be
+		# scored over all of them at once after sampling
+		vectorizedSOI = None
+		try :
+			vectorizedSOI = VectorizedSentence(statementOfInterest, consistentPaths, parser)
+		except NotVectorizable :
+			pass
+
+		if trie is None and cachePrefixes :
+			trie = DecisionTrie()
+
+		coinProbabilities = {}
+		orderWeights = {}
+		if importance :
+			coinProbabilities, orderWeights = importanceProposal(T, variables,
+				statementOfInterest, coinBias, orderBias, stats, parser)
+	samplingStart = time.time()
+
 	# Demski prior generation algorithm
 	###################################
 
 	interestCount = 0
-	while time.time() < stopTime :
+	interestSquares = 0.0
+	while (stopTime is None or time.time() < stopTime) and \
+	      (maxSamples is None or numLoops < maxSamples) :
 		numLoops += 1
-		thisPath = list()
-		theseTrueVarNames = list()
+		boolValues = [False] * len(consistentPaths.boolNames)
+		unifValues = [0] * len(consistentPaths.unifNames)
 
 
 		#Add the original knowledge base
-		T.reset()
-		for sentence in knowledgeBase :
-			T.add(sentence)
+		if incremental :
+			T.push()
+		else :
+			T.reset()
+			for sentence in knowledgeBase :
+				T.add(T.sentence(sentence))
 		remKeys            = variables.keys()
+		weight             = 1.0
+		node               = trie.root if trie is not None else None
+		# Choices not yet given to the solver. They are only added when
+		# it is next called, so a sample whose checks all come from the
+		# trie never touches the solver
+		pending            = []
+		if orderWeights :
+			remWeights  = [orderWeights.get(varName, 1.0) for varName in remKeys]
+			totalWeight = sum(remWeights)
 
 
 		for i in range(0,len(variables)) :
-			nextKeyIndex = randrange(len(remKeys))
+			if orderWeights :
+				# Draw the next variable in proportion to its order weight
+				threshold = rng.random() * totalWeight
+				nextKeyIndex = len(remKeys) - 1
+				for j in range(len(remKeys)) :
+					threshold -= remWeights[j]
+					if threshold < 0 :
+						nextKeyIndex = j
+						break
+				weight *= totalWeight / (remWeights[nextKeyIndex] * len(remKeys))
+				totalWeight -= remWeights.pop(nextKeyIndex)
+			else :
+				nextKeyIndex = rng.randrange(len(remKeys))
 			nextKey      = remKeys[nextKeyIndex]
 			nextVarlist  = variables[nextKey]
-			nextVar      = nextVarlist[0]
 			nextVarType  = nextVarlist[1]
 
 			# Begin bool case
 			if nextVarType == 'bool' :
 				probability = nextVarlist[2]
-				# Randomly add the variable or its negation
-				if (random() < probability) :
-					T.push()
-					T.add(nextVar)
-
-					if (T.check() == unsat) :
-						T.pop()
-						T.add(Not(nextVar))
-						thisPath.append(Not(nextVar))
-					else :
-						thisPath.append(nextVar)
-						theseTrueVarNames.append(nextKey)
+				forcedValue = None
+				if trail is not None :
+					forcedValue = trail.value(varIndex[nextKey])
+
+				# Variables implied by earlier choices need no solver call
+				if forcedValue is not None :
+					isTrue = forcedValue
+					pending.append(T.literal(nextKey, isTrue))
+					stats.recordForced(nextKey)
 
+				# Randomly add the variable or its negation
 				else :
-					T.push()
-					T.add(Not(nextVar))
-
-					if (T.check() == unsat) :
-						T.pop()
-						T.add(nextVar)
-						thisPath.append(nextVar)
-						theseTrueVarNames.append(nextKey)
+					proposal = coinProbabilities.get(nextKey, probability)
+					isTrue = rng.random() < proposal
+					if proposal != probability :
+						if isTrue :
+							weight *= probability / proposal
+						else :
+							weight *= (1 - probability) / (1 - proposal)
+					chosen   = T.literal(nextKey, isTrue)
+					opposite = T.literal(nextKey, not isTrue)
+
+					# An earlier sample with the same prefix may have checked it
+					consistent = None
+					if trie is not None :
+						consistent = trie.known(node, (nextKey, isTrue))
+
+					# A propagation conflict shows the choice is unsat
+					propagated = True
+					if trail is not None :
+						literal = varIndex[nextKey] if isTrue else -varIndex[nextKey]
+						if consistent is False :
+							trail.assign(-literal)
+						else :
+							trail.push()
+							propagated = trail.assign(literal)
+							if not propagated :
+								trail.pop()
+								trail.assign(-literal)
+
+					if consistent is False :
+						isTrue = not isTrue
+						pending.append(opposite)
+					elif not propagated :
+						isTrue = not isTrue
+						pending.append(opposite)
+						stats.recordForced(nextKey)
+					elif consistent :
+						pending.append(chosen)
 					else :
-						thisPath.append(Not(nextVar))
+						flushPending(T, pending)
+						T.push()
+						T.add(chosen)
+
+						if not solverCheck(T, stats, 'bool', nextKey) :
+							if trie is not None :
+								trie.markUnsat(node, (nextKey, isTrue))
+							T.pop()
+							T.add(opposite)
+							isTrue = not isTrue
+							if trail is not None :
+								trail.pop()
+								trail.assign(-literal)
+
+				boolValues[consistentPaths.boolIndex[nextKey]] = isTrue
+				if trie is not None :
+					node = trie.advance(node, (nextKey, isTrue))
 			# End bool case
 
 			# Begin uniform case
 			if nextVarType == 'unif' :
-				satisfied = False
-				while not(satisfied) :
-					varValue = randint(nextVarlist[2], nextVarlist[3])
-					T.push()
-					T.add(nextVar == varValue)
-					if (T.check() == sat) :
-						satisfied = True
-						thisPath.append(nextVar == varValue)
-					else :
-						T.pop()
+				varValue, draws = sampleUnif(T, nextKey, nextVarlist[2], nextVarlist[3],
+				                             stats, nextVarlist[4], rng, trie, node, pending)
+				unifValues[consistentPaths.unifIndex[nextKey]] = varValue
+				stats.recordUnifDraw(nextKey, draws)
+				if trie is not None :
+					node = trie.advance(node, (nextKey, varValue))
 
 			remKeys.pop(nextKeyIndex)
 
 		# Supports arbitrary statements but slower
-		T.add(statementOfInterest)
-		if (T.check() == sat) :
-			interestCount += 1
-
-		consistentPaths.append(thisPath)
-		modelsTrueVarNames.append(theseTrueVarNames)
+		if vectorizedSOI is None :
+			flushPending(T, pending)
+			T.add(T.sentence(statementOfInterest))
+			if solverCheck(T, stats, 'interest') :
+				interestCount += weight
+				interestSquares += weight * weight
+
+		# Drop back to just the knowledge base for the next sample
+		if incremental :
+			T.pop(T.num_scopes() - baseScopes)
+		if trail is not None :
+			trail.reset()
+
+		consistentPaths.appendRow(boolValues, unifValues, weight)
+
+		# Score the newest models and stop early once precise enough
+		if (targetWidth is not None or progressCallback is not None) and \
+		   numLoops % checkEvery == 0 :
+			if vectorizedSOI is not None :
+				with stats.phase('interest') :
+					newModels = consistentPaths.select(slice(numLoops - checkEvery, numLoops))
+					values = vectorizedSOI.evaluate(newModels) * newModels.weightVector()
+					interestCount += values.sum()
+					interestSquares += (values * values).sum()
+			snapshot = progressSnapshot(interestCount, numLoops, startTime, confidence,
+				interestSquares if importance else None)
+			if progressCallback is not None and progressCallback(snapshot) :
+				break
+			if targetWidth is not None and snapshot['ciWidth'] <= targetWidth :
+				break
+
+	stats.recordPhase('sampling', time.time() - samplingStart)
+	if vectorizedSOI is not None :
+		with stats.phase('interest') :
+			values = vectorizedSOI.evaluate(consistentPaths) * consistentPaths.weightVector()
+			interestSquares = float((values * values).sum())
+			interestCount = float(values.sum()) if importance else int(values.sum())
+	elif not importance :
+		interestCount = int(interestCount)
+	if progressCallback is not None :
+		progressCallback(progressSnapshot(interestCount, numLoops, startTime, confidence,
+			interestSquares if importance else None))
+
+	return((consistentPaths, interestCount, TrueVarNamesView(consistentPaths)))
+
+# @return : the standard normal quantile for probability p
+def normalQuantile(p) :
+	lower, upper = -40.0, 40.0
+	for i in range(100) :
+		middle = (lower + upper) / 2
+		if 0.5 * (1 + math.erf(middle / math.sqrt(2))) < p :
+			lower = middle
+		else :
+			upper = middle
+	return((lower + upper) / 2)
+
+# Wilson score interval for a binomial proportion
+# @return : a (lower, upper) pair
+def WilsonInterval(successes, trials, confidence=0.95) :
+	if trials == 0 :
+		return((0.0, 1.0))
+	z = normalQuantile(1 - (1 - confidence) / 2)
+	estimate = float(successes) / trials
+	denominator = 1 + z * z / trials
+	centre = (estimate + z * z / (2 * trials)) / denominator
+	halfWidth = z * math.sqrt(estimate * (1 - estimate) / trials + z * z / (4 * trials * trials)) / denominator
+	return((max(0.0, centre - halfWidth), min(1.0, centre + halfWidth)))
+
+# The state of a running DemskiPrior, as passed to progress callbacks
+# @interestSquares : for weighted models, the sum of the squared weights
+#                    of the models where the statement holds. The
+#                    interval is then a normal one on the weighted mean,
+#                    once the statement has held at all
+# @return : a dictionary with the number of samples, the interest count,
+#           the running estimate, its confidence interval and width,
+#           the elapsed seconds and the samples per second
+def progressSnapshot(interestCount, numSamples, startTime, confidence, interestSquares=None) :
+	elapsed = time.time() - startTime
+	if interestSquares is None or numSamples == 0 or interestCount == 0 :
+		lower, upper = WilsonInterval(interestCount, numSamples, confidence)
+	else :
+		mean = float(interestCount) / numSamples
+		variance = max(float(interestSquares) / numSamples - mean * mean, 0.0)
+		halfWidth = normalQuantile(1 - (1 - confidence) / 2) * math.sqrt(variance / numSamples)
+		lower, upper = max(0.0, mean - halfWidth), min(1.0, mean + halfWidth)
+	estimate = None
+	if numSamples :
+		estimate = float(interestCount) / numSamples
+	samplesPerSecond = 0.0
+	if elapsed > 0 :
+		samplesPerSecond = numSamples / elapsed
+	return({'samples' : numSamples, 'interestCount' : interestCount,
+	        'estimate' : estimate, 'ciLower' : lower, 'ciUpper' : upper,
+	        'ciWidth' : upper - lower, 'elapsed' : elapsed,
+	        'samplesPerSecond' : samplesPerSecond})
+
+# Shared arguments for the parallel sampling workers. They are set in
+# the parent before the pool is forked, since z3 instances can't be pickled
+_parallelArgs = None
+
+# Runs DemskiPrior on each of several worker processes and merges the
+# results, so that sampling uses every available core
+# @knowledgeBase	 : a list of z3 instances corresponding to the
+#                     given axiom scheme
+# @variables         : the list of z3 variables involved
+# @statementOfInterest: the variable to generate a prior probability on
+# @secondsToRun      : how much time each worker spends running the alg
+# @numWorkers        : how many worker processes to use, defaults to
+#                      the number of cores
+# @seed              : base seed, worker i samples from the stream
+#                      RandomStream(seed, i). If None every worker seeds
+#                      from the os
+# @samplerOptions    : keyword arguments passed on to DemskiPrior
+# @return            : the same triple as DemskiPrior, merged over all
+#                      of the workers
+def ParallelDemskiPrior(knowledgeBase, variables, statementOfInterest, secondsToRun,
+                        numWorkers=None, seed=None, **samplerOptions) :
+	global _parallelArgs
+
+	if numWorkers is None :
+		numWorkers = multiprocessing.cpu_count()
+
+	# Check consistency up front, a worker exiting would hang the pool
+	T = NewSolver(knowledgeBase, variables, samplerOptions.get('backend'),
+	              samplerOptions.get('parser'))
+	if not solverCheck(T) :
+		sys.exit("Background knowledge not consistent")
 
+	# A generator given for the run seeds the workers' streams
+	rng = samplerOptions.pop('rng', None)
+	if seed is None and rng is not None :
+		seed = rng.getrandbits(63)
+
+	# Each worker records into its own stats, and traces to its own file,
+	# and they are merged in once the workers finish
+	stats = samplerOptions.pop('stats', noStats)
+	traceFiles = None
+	if stats is not noStats and stats.traceFile is not None :
+		traceFiles = [workerTraceFile(stats.traceFile, i) for i in range(numWorkers)]
+		stats.writeTrace({'event' : 'workers', 'traceFiles' : traceFiles})
+		stats.flush()
+	_parallelArgs = (knowledgeBase, variables, statementOfInterest, secondsToRun, seed,
+	                 samplerOptions, stats is not noStats, traceFiles)
+	if hasattr(multiprocessing, 'get_context') :
+		pool = multiprocessing.get_context('fork').Pool(numWorkers)
+	else :
+		pool = multiprocessing.Pool(numWorkers)
+	try :
+		workerResults = pool.map(_parallelDemskiWorker, range(numWorkers))
+	finally :
+		pool.close()
+		pool.join()
+		_parallelArgs = None
+
+	consistentPaths = concatenateStores([workerResult[0] for workerResult in workerResults])
+	interestCount = sum([workerResult[1] for workerResult in workerResults])
+	for workerResult in workerResults :
+		solverCheckCount.update(workerResult[3])
+		if stats is not noStats :
+			stats.merge(workerResult[2])
+
+	return((consistentPaths, interestCount, TrueVarNamesView(consistentPaths)))
+
+# @return : the trace file of a parallel worker, e.g. run.worker0.jsonl
+#           for worker 0 of a run traced to run.jsonl
+def workerTraceFile(traceFile, workerIndex) :
+	root, extension = os.path.splitext(traceFile)
+	return(root + '.worker' + str(workerIndex) + extension)
+
+# Runs in a forked worker process. Each worker draws from its own random
+# stream, so workers don't share the parent's state
+# @return : the models and interest count, the worker's stats and the
+#           solver checks it made
+def _parallelDemskiWorker(workerIndex) :
+	knowledgeBase, variables, statementOfInterest, secondsToRun, seed, samplerOptions, \
+		recordStats, traceFiles = _parallelArgs
+	samplerOptions = dict(samplerOptions)
+	samplerOptions['rng'] = RandomStream(seed, workerIndex)
+	samplerOptions['stats'] = noStats
+	if recordStats :
+		samplerOptions['stats'] = SolverStats(traceFiles[workerIndex] if traceFiles else None)
+	startChecks = collections.Counter(solverCheckCount)
+
+	result = DemskiPrior(knowledgeBase, variables, statementOfInterest, secondsToRun,
+	                     **samplerOptions)
+	if recordStats :
+		samplerOptions['stats'].close()
+	return((result[0], result[1], samplerOptions['stats'], solverCheckCount - startChecks))
+
+# @T      : a solver backend
+# @return : T's literals fixing every variable to its value in model i
+#           of a ModelStore
+def modelLiterals(T, store, i) :
+	return([T.literal(varName, value) for varName, value in store.model(i).items()])
+
+# @memo   : optional memo shared between evaluations on the same store
+# @return : a boolean array of which models in a ModelStore satisfy a
+#           sentence
+def satisfyingModels(store, sentence, memo=None, stats=noStats) :
+	holds = EvaluateAll([sentence], store, memo)
+	if holds is not None :
+		return(holds)
+
+	holds = numpy.zeros(len(store), dtype=bool)
+	T = NewSolver([sentence], backend = 'z3')
+	for i in range(len(store)) :
+		holds[i] = solverCheck(T, stats, 'update', assumptions = modelLiterals(T, store, i))
+	return(holds)
+
+# @return : the number of models in a ModelStore which satisfy a sentence
+def countSatisfying(store, sentence) :
+	return(int(satisfyingModels(store, sentence).sum()))
+
+# @holds  : a boolean array over the models of a ModelStore
+# @return : how many of the models hold. For weighted models, the number
+#           of models times the weighted fraction which hold, so that
+#           divided by the number of models it is an unbiased estimate
+def weightedCount(store, holds) :
+	if store.weights is None :
+		return(int(holds.sum()))
+	weights = store.weightVector()
+	totalWeight = float(weights.sum())
+	if totalWeight == 0 :
+		return(0.0)
+	return(float(weights[holds].sum()) / totalWeight * len(store))
+
+# Runs DemskiPrior separately on each independent component of the
+# knowledge base and pairs up their models, so each solver only holds
+# its own component's sentences
+# @index          : optional IncidenceIndex of knowledgeBase
+# @secondsToRun   : the time budget, shared equally between components
+# @maxSamples     : optional number of models to draw per component
+# @samplerOptions : further keyword arguments for each DemskiPrior
+# @return         : the same triple as DemskiPrior, holding as many
+#                   models as the component with the fewest
+def DecomposedDemskiPrior(knowledgeBase, variables, statementOfInterest, secondsToRun,
+                          maxSamples=None, index=None, **samplerOptions) :
+	if samplerOptions.get('targetWidth') is not None :
+		sys.exit("Components are sampled separately, so there is no interval to stop on")
+	if samplerOptions.get('importance') :
+		sys.exit("Components are sampled separately, so there is no statement of interest " +
+		         "to lean towards")
+	if index is None :
+		index = IncidenceIndex(knowledgeBase)
+	components = index.components(variables.keys())
+	componentSeconds = None
+	if secondsToRun is not None :
+		componentSeconds = float(secondsToRun) / max(len(components), 1)
+
+	stores = []
+	for varNames in components :
+		componentVariables = dict((varName, variables[varName]) for varName in varNames)
+		componentKnowledge = index.relevantSentences(set(varNames))
+		stores.append(DemskiPrior(componentKnowledge, componentVariables, True,
+			componentSeconds, maxSamples, **samplerOptions)[0])
+
+	numModels = min(len(store) for store in stores) if stores else 0
+	consistentPaths = joinStores(stores, numModels)
+	interestCount = countSatisfying(consistentPaths, statementOfInterest)
+	return((consistentPaths, interestCount, TrueVarNamesView(consistentPaths)))
+
+# Runs DemskiPrior with models kept in an on-disk cache. Models already
+# cached for the same knowledge base are reused, and only the shortfall
+# up to numSamples is sampled and added to the cache. When more models
+# are cached than asked for, the first numSamples of them are used.
+# @cache         : a ModelCache
+# @fingerprint   : the knowledge base's KnowledgeBaseFingerprint
+# @numSamples    : how many models the result should hold
+# @secondsToRun  : optional time limit on the additional sampling
+# @metaPriors    : the unfixed variable probabilities to record with the
+#                  models
+# @samplerOptions : further keyword arguments for DemskiPrior, such as rng,
+#                  stats or backend. Cached models are shared by every
+#                  statement of interest, so options which depend on the
+#                  statement (importance, targetWidth, progressCallback)
+#                  can't be honoured and exit
+# @return        : the same triple as DemskiPrior
+def CachedDemskiPrior(cache, fingerprint, knowledgeBase, variables, statementOfInterest,
+                      numSamples, secondsToRun=None, metaPriors=None, **samplerOptions) :
+	for option in ['importance', 'targetWidth', 'progressCallback'] :
+		if samplerOptions.get(option) :
+			sys.exit("Cached models are shared between statements of interest, so " +
+			         option + " can't be used with the model cache")
+	store = cache.load(fingerprint)
+
+	shortfall = numSamples - (len(store) if store is not None else 0)
+	if shortfall > 0 :
+		newModels = DemskiPrior(knowledgeBase, variables, True, secondsToRun,
+		                        maxSamples = shortfall, **samplerOptions)[0]
+		if store is None :
+			store = newModels
+		else :
+			store.extend(newModels)
+		cache.save(fingerprint, store, metaPriors)
+	elif shortfall < 0 :
+		store = store.select(slice(0, numSamples))
 
-	return((consistentPaths, interestCount, modelsTrueVarNames))
+	interestCount = countSatisfying(store, statementOfInterest)
+	return((store, interestCount, TrueVarNamesView(store)))
 
 # Given a list of consistent model paths from a prior algorithm,
 # and a sentence to compute the probability on along with some new knowledge,
 # outputs the updated probability of the sentence being true.
-# @consistentPaths       : a list of lists of z3 variables or their negations
+# @consistentPaths       : a ModelStore of consistent models
 # @sentenceOfInterest    : a z3 sentence
 # @newKnowledgeSentences : a list of z3 sentences
-# @returns               : a list of lists of z3 variables or their negations 
-def consumptiveUpdate(consistentPaths, sentenceOfInterest, newKnowledgeBase) :
-
-	stillConsistentPaths = []
-	# Number of models consistent with the sentence of interest
-	SOIcount = 0
-
-	T = Solver()
-	for sentence in newKnowledgeBase :
-		T.add(sentence)
-	if (T.check() == unsat) :
+# @incremental           : if true the new knowledge is asserted once and
+#                          each path is checked inside a push/pop scope
+# @stats                 : optional SolverStats to record checks in
+# @backend               : 'z3' or 'sat', as for DemskiPrior. By default
+#                          'sat' when the models have no unif variables
+# @returns               : a pair of a ModelStore of the models which are
+#                          still consistent and how many of them satisfy
+#                          the sentence of interest, weighted as by
+#                          weightedCount for weighted models
+def consumptiveUpdate(consistentPaths, sentenceOfInterest, newKnowledgeBase, incremental=True,
+                      stats=noStats, backend=None) :
+
+	if backend is None :
+		backend = 'z3' if consistentPaths.unifNames else 'sat'
+	T = NewSolver(newKnowledgeBase, backend = backend)
+	if not solverCheck(T, stats, 'updateConsistency') :
 		sys.exit("Background knowledge not consistent on updating")
 
+	# Complete models are filtered by evaluating the sentences directly
+	with stats.phase('vectorizedUpdate') :
+		memo = {}
+		stillConsistent = EvaluateAll(newKnowledgeBase, consistentPaths, memo)
+		SOIholds = None
+		if stillConsistent is not None :
+			SOIholds = EvaluateAll([sentenceOfInterest], consistentPaths, memo)
+	if SOIholds is not None :
+		stillConsistentPaths = consistentPaths.select(stillConsistent)
+		SOIcount = weightedCount(stillConsistentPaths, SOIholds[stillConsistent])
+		return((stillConsistentPaths, SOIcount))
+	stillConsistent = []
+	SOIholds = []
+
 	# Recheck the consistency of all paths based on new knowledge
-	for path in consistentPaths :
-		T.reset()
-		for sentence in newKnowledgeBase :
-			T.add(sentence)
-		for var in path :
-			T.add(var)
+	for i in range(len(consistentPaths)) :
+		if incremental :
+			T.push()
+		else :
+			T.reset()
+			for sentence in newKnowledgeBase :
+				T.add(T.sentence(sentence))
+		T.add(modelLiterals(T, consistentPaths, i))
 
 		# Only keep consistent models
-		if (T.check() == sat) :
-			stillConsistentPaths.append(path)
+		if solverCheck(T, stats, 'update') :
+			stillConsistent.append(i)
 
 			T.push()
-			T.add(sentenceOfInterest)
-			if (T.check() == sat) :
-				SOIcount = SOIcount + 1
+			T.add(T.sentence(sentenceOfInterest))
+			SOIholds.append(solverCheck(T, stats, 'updateInterest'))
+
+		if incremental :
+			T.pop(T.num_scopes())
 
 	# Old code for testing correctness
 	#print("Probability true on updating was: " + str(float(SOIcount)/len(stillConsistentPaths)))
 
 
+	stillConsistentPaths = consistentPaths.select(stillConsistent)
+	SOIcount = weightedCount(stillConsistentPaths, numpy.array(SOIholds, dtype=bool))
 	return((stillConsistentPaths,SOIcount))
 
+# A set of models which is updated on evidence as it arrives. Each new
+# sentence is checked against the surviving models only, since they
+# already satisfy the knowledge base and all earlier evidence, and the
+# models where it fails are dropped. Once too few models are left the
+# prior is sampled again from the knowledge base and all of the evidence.
+class Posterior(object) :
+
+	# @knowledgeBase  : a list of z3 sentences. It is copied, never changed
+	# @variables      : the dictionary of variables from ParseVariables
+	# @statementOfInterest : the sentence whose probability is wanted
+	# @consistentPaths : optional ModelStore sampled from the knowledge
+	#                   base. If None the prior is sampled now
+	# @minModels      : resample once fewer models than this survive. 0
+	#                   never resamples
+	# @numSamples     : how many models to resample, by default as many
+	#                   as there were to begin with
+	# @secondsToRun   : time limit for each resampling
+	# @samplerOptions : further keyword arguments for DemskiPrior. With
+	#                   importance the prior, and every resampling, leans
+	#                   towards the statement of interest
+	def __init__(self, knowledgeBase, variables, statementOfInterest, consistentPaths=None,
+	             minModels=100, numSamples=None, secondsToRun=None, **samplerOptions) :
+		self.knowledgeBase = list(knowledgeBase)
+		self.variables = variables
+		self.statementOfInterest = statementOfInterest
+		self.evidence = []
+		self.minModels = minModels
+		self.secondsToRun = secondsToRun
+		self.samplerOptions = samplerOptions
+		self.stats = samplerOptions.get('stats', noStats)
+		self.numResamples = 0
+		# The importance proposal needs the statement to lean towards,
+		# otherwise it isn't worth having DemskiPrior score it
+		self.samplerStatement = statementOfInterest if samplerOptions.get('importance') else True
+
+		self.solver = NewSolver(self.knowledgeBase, variables, samplerOptions.get('backend'))
+
+		if consistentPaths is None :
+			if numSamples is None and secondsToRun is None :
+				sys.exit("Posterior needs a sample or time budget to sample the prior")
+			consistentPaths = DemskiPrior(self.knowledgeBase, variables, self.samplerStatement,
+				secondsToRun, numSamples, solver = self.solver, **samplerOptions)[0]
+		self.numSamples = numSamples if numSamples is not None else len(consistentPaths)
+		self.setModels(consistentPaths)
+
+	def setModels(self, consistentPaths) :
+		self.consistentPaths = consistentPaths
+		self.interestHolds = satisfyingModels(consistentPaths, self.statementOfInterest,
+			stats = self.stats)
+
+	def __len__(self) :
+		return(len(self.consistentPaths))
+
+	# @return : the number of models the estimates are effectively based
+	#           on, which is less than the number of models when they are
+	#           importance weighted
+	def effectiveSampleSize(self) :
+		return(self.consistentPaths.effectiveSize())
+
+	# Updates on a new sentence
+	# @sentence : a z3 sentence, which must be consistent with the
+	#             knowledge base and the evidence so far
+	# @return   : the number of models left
+	def observe(self, sentence) :
+		self.solver.add(self.solver.sentence(sentence))
+		if not solverCheck(self.solver, self.stats, 'updateConsistency') :
+			sys.exit("Background knowledge not consistent on updating")
+		self.evidence.append(sentence)
+
+		with self.stats.phase('observe') :
+			holds = satisfyingModels(self.consistentPaths, sentence, stats = self.stats)
+			self.consistentPaths = self.consistentPaths.select(holds)
+			self.interestHolds = self.interestHolds[holds]
+
+		if self.effectiveSampleSize() < self.minModels :
+			self.resample()
+		return(len(self.consistentPaths))
+
+	# Samples the prior again from the knowledge base and the evidence
+	def resample(self) :
+		with self.stats.phase('resample') :
+			consistentPaths = DemskiPrior(self.knowledgeBase + self.evidence, self.variables,
+				self.samplerStatement, self.secondsToRun, self.numSamples, solver = self.solver,
+				**self.samplerOptions)[0]
+		self.numResamples += 1
+		self.setModels(consistentPaths)
+
+	# @return : the number of surviving models where the statement of
+	#           interest holds. For weighted models, the surviving number
+	#           of models times the weighted fraction where it holds
+	def interestCount(self) :
+		return(weightedCount(self.consistentPaths, self.interestHolds))
+
+	# @sentence : optional sentence, by default the statement of interest
+	# @return   : its probability among the surviving models, weighted if
+	#             they are, or None if there are none
+	def probability(self, sentence=None) :
+		holds = self.interestHolds
+		if sentence is not None :
+			holds = satisfyingModels(self.consistentPaths, sentence, stats = self.stats)
+		weights = self.consistentPaths.weightVector()
+		totalWeight = float(weights.sum())
+		if not len(self.consistentPaths) or totalWeight == 0 :
+			return(None)
+		return(float(weights[holds].sum()) / totalWeight)
+
+
+# @return : the meta-prior of an unfixed variable, its probability if
+#           bool or its list of value weights if unif
+def metaPrior(variables, varName) :
+	variableList = variables[varName]
+	if variableList[1] == 'bool' :
+		return(variableList[2])
+	return(variableList[4])
+
+def setMetaPrior(variables, varName, value) :
+	if variables[varName][1] == 'bool' :
+		variables[varName][2] = value
+	else :
+		variables[varName][4] = value
+
+# @return : the empirical meta-prior of an unfixed variable over some
+#           models, in the form metaPrior returns
+def empiricalMetaPrior(variables, varName, store) :
+	weights = store.weightVector()
+	totalWeight = float(weights.sum())
+	variableList = variables[varName]
+	if variableList[1] == 'bool' :
+		return(float(weights[store.column(varName)].sum()) / totalWeight)
+	counts = numpy.bincount(store.column(varName) - variableList[2], weights,
+	                        minlength = variableList[3] - variableList[2] + 1)
+	return([float(count) / totalWeight for count in counts])
+
+# @return : the largest change in any unfixed variable's meta-prior.
+#           A uniform unif variable counts as having equal weights
+def metaPriorChange(variables, unfixedVarNames, oldPriors, newPriors) :
+	change = 0.0
+	for varName in unfixedVarNames :
+		old, new = oldPriors[varName], newPriors[varName]
+		if variables[varName][1] == 'bool' :
+			change = max(change, abs(new - old))
+		else :
+			rangeSize = variables[varName][3] - variables[varName][2] + 1
+			if old is None :
+				old = [1.0 / rangeSize] * rangeSize
+			if new is None :
+				new = [1.0 / rangeSize] * rangeSize
+			change = max([change] + [abs(a - b) for a, b in zip(old, new)])
+	return(change)
+
+# @return : the widest confidence interval on how often any unfixed
+#           variable takes any of its values over some models
+def metaPriorWidth(variables, unfixedVarNames, store, confidence=0.95) :
+	width = 0.0
+	for varName in unfixedVarNames :
+		variableList = variables[varName]
+		if variableList[1] == 'bool' :
+			counts = [store.column(varName).sum()]
+		else :
+			counts = numpy.bincount(store.column(varName) - variableList[2],
+			                        minlength = variableList[3] - variableList[2] + 1)
+		for count in counts :
+			lower, upper = WilsonInterval(int(count), len(store), confidence)
+			width = max(width, upper - lower)
+	return(width)
+
+# Splits the budget of a run between approximating the unfixed meta-priors
+# and sampling with them. The meta-prior rounds get half of the time and
+# half of the samples. A run stopped only by precision has neither, so
+# each round samples until every meta-prior is known to the same width
+# @samplerOptions : the keyword arguments the run gives DemskiPrior
+# @return         : a dictionary of budget keyword arguments for
+#                   approximateUnfixedProbabilities
+def metaPriorBudget(secondsToRun, numSamples, samplerOptions) :
+	budget = {'secondsToRun' : None if secondsToRun is None else secondsToRun/2.0,
+	          'maxSamples' : None if numSamples is None else numSamples//2}
+	if secondsToRun is None and numSamples is None :
+		budget['targetWidth'] = samplerOptions.get('targetWidth')
+		budget['confidence'] = samplerOptions.get('confidence', 0.95)
+	return(budget)
+
 # Iterates Demski's algorithm in order to achieve successively better
-# approximations of variable's true probability
+# approximations of variable's true probability. Each round samples with
+# the current meta-priors and replaces them with the frequencies seen,
+# until they change by less than tolerance. Models from every round whose
+# meta-priors were within tolerance of the latest are pooled into the
+# frequencies, so rounds near the fixpoint aren't wasted.
 # @knowledgeBase	 : a list of z3 instances corresponding to the
 #                     given axiom scheme
 # @variables         : the list of z3 variables involved,
 #                      along with their types and distributions
 # @unfixedVarNames   : a list of the variables which will have their
 #                      probabilities updated
-# @secondsToRun      : how much time to spend running each iteration
-# @return            : the variables, where unfixed vars have their
-#                      probabilities updated based on the empirical
-#                      results
-def approximateUnfixedProbabilities(knowledgeBase, variables, unfixedVarNames, secondsToRun) :
-
-	unfixedVarCounts = dict.fromkeys(unfixedVarNames, 0)
-	demskiRes = DemskiPrior(knowledgeBase, variables, True, secondsToRun)
-	models = demskiRes[2]
-	numModels = float(demskiRes[1])
-
-	for model in models :
-		for var in model :
-			if var in unfixedVarNames :
-				unfixedVarCounts[var] = unfixedVarCounts[var] + 1
-
-	for unfixedVar in unfixedVarNames :
-		if variables[unfixedVar][1] == 'bool' :
-			variables[unfixedVar][2] = unfixedVarCounts[unfixedVar]/numModels
+# @secondsToRun      : how much time to spend over all of the rounds
+# @maxSamples        : optional cap on the models drawn over all rounds
+# @stats             : optional SolverStats to record checks in
+# @solver            : optional z3 Solver asserting the knowledge base,
+#                      as for DemskiPrior. Not used with numWorkers
+# @maxRounds         : the most rounds to run
+# @tolerance         : the meta-prior change at which to stop
+# @numWorkers        : if more than one, each round is sampled by
+#                      ParallelDemskiPrior on that many processes
+# @rng               : the random generator to sample with, as for
+#                      DemskiPrior
+# @targetWidth       : used when there is neither a time nor a sample
+#                      budget. Each round samples checkEvery models at a
+#                      time until metaPriorWidth is at most this
+# @confidence        : the confidence level of those intervals
+# @return            : the variables, where unfixed bool vars have their
+#                      probabilities, and unfixed unif vars their value
+#                      weights, updated based on the empirical results
+def approximateUnfixedProbabilities(knowledgeBase, variables, unfixedVarNames, secondsToRun,
+                                    maxSamples=None, stats=noStats, solver=None,
+                                    maxRounds=4, tolerance=0.02, numWorkers=None,
+                                    rng=randomModule, targetWidth=None, confidence=0.95,
+                                    checkEvery=100) :
+	if secondsToRun is None and maxSamples is None and targetWidth is None :
+		sys.exit("approximateUnfixedProbabilities needs a time, sample or precision budget")
+	roundSeconds = None if secondsToRun is None else float(secondsToRun) / maxRounds
+	roundSamples = None if maxSamples is None else max(maxSamples // maxRounds, 1)
+	rounds = []
+
+	def sampleRound(seconds, samples) :
+		if numWorkers is not None and numWorkers > 1 :
+			workerSamples = None
+			if samples is not None :
+				workerSamples = -(-samples // numWorkers)
+			return(ParallelDemskiPrior(knowledgeBase, variables, True, seconds,
+				numWorkers, maxSamples = workerSamples, stats = stats, rng = rng)[0])
+		return(DemskiPrior(knowledgeBase, variables, True, seconds, samples,
+		                   stats = stats, solver = solver, rng = rng)[0])
+
+	with stats.phase('metaPrior') :
+		for roundIndex in range(maxRounds) :
+			priors = dict((varName, metaPrior(variables, varName)) for varName in unfixedVarNames)
+			if roundSeconds is None and roundSamples is None :
+				models = sampleRound(None, checkEvery)
+				while metaPriorWidth(variables, unfixedVarNames, models, confidence) > targetWidth :
+					models.extend(sampleRound(None, checkEvery))
+			else :
+				models = sampleRound(roundSeconds, roundSamples)
+			rounds.append((priors, models))
+
+			# Pool the rounds sampled with meta-priors close to these
+			pooled = concatenateStores([roundModels for roundPriors, roundModels in rounds
+				if metaPriorChange(variables, unfixedVarNames, roundPriors, priors) <= tolerance])
+			newPriors = dict((varName, empiricalMetaPrior(variables, varName, pooled))
+			                 for varName in unfixedVarNames)
+			for varName in unfixedVarNames :
+				setMetaPrior(variables, varName, newPriors[varName])
+			if metaPriorChange(variables, unfixedVarNames, priors, newPriors) < tolerance :
+				break
 
 	return(variables)
 
@@ -188,219 +1062,76 @@ def approximateUnfixedProbabilities(knowledgeBase, variables, unfixedVarNames, s
 #                  values as z3 boolean variables/corresponding meta-
 #                  prior probabilities (respectively)
 def ParseVariables(variableNames) :
-	variables = {}
-	reservedNames = ['not', 'and', 'or', 'implies', 'xor', '=', '==',
-					 'bool', 'Bool', 'boolean', 'Boolean',
-					 'Unif', 'unif', 'uniform', 'Uniform',
-					 'unfixed', 'Unfixed']
-	for variableString in variableNames :
-		varDeclaration = variableString.split()
-		varType = "EMPTY"
-
-		# Whether or not the variable's probability is already fixed
-		isUnfixed = False
-		if varDeclaration[0] in ['unfixed', 'Unfixed'] :
-			isUnfixed = True
-			varDeclaration.pop(0)
-
-		# Either assign the default probability (.5) or that specified
-		# defaults bool cases
-		isBool = False
-		if len(varDeclaration) == 1 :
-			probability = .5
-			variableName = varDeclaration[0]
-			isBool = True
-		elif len(varDeclaration) == 2 :
-			probability = float(varDeclaration[1])
-			variableName = varDeclaration[0]
-			isBool = True
-
-		# Explicit bool parsing cases
-		if varDeclaration[0] in ['bool', 'Bool', 'boolean', 'Boolean'] :
-			if len(varDeclaration) == 1 :
-				sys.exit("insufficient arguments when declaring " + varDeclaration[0])
-			if len(varDeclaration) == 2 :
-				probability = .5
-				variableName = varDeclaration[1]
-			elif len(varDeclaration) == 3 :
-				probability = float(varDeclaration[2])
-				variableName = varDeclaration[1]
-			isBool = True
-
-		if isBool :
-			z3Instance = Bool(variableName)
-			argList = [probability, isUnfixed]
-			varType = 'bool'
-
-		# Integer variable parsing cases
-		if varDeclaration[0] in ['Unif', 'unif', 'uniform', 'Uniform'] :
-			if len(varDeclaration) != 4 :
-				sys.exit("""uniform variables are declared with the following form:
-					        unif VarName 0 10
-					        this error occurred when parsing""" + variableString)
-
-			variableName = varDeclaration[1]
-			lowerBound   = int(varDeclaration[2])
-			upperBound   = int(varDeclaration[3])
-			argList      = [lowerBound, upperBound, isUnfixed]
-			z3Instance   = Int(variableName)
-			varType      = 'unif'
-
-
-		if varType == "EMPTY" :
-			print("Error in parsing variable names")
-			sys.exit("<" + variableString + "> is neither uniform nor boolean")
-		if variableName.lower() in reservedNames :
-			print("Error in parsing variable names")
-			sys.exit(variableName + " is a reserved name")
-			return()
-		key = variableName
-		variables[variableName] = [z3Instance, varType] + argList
-
+	variables = ParseDeclarations(variableNames)
+	for varName in variables :
+		if variables[varName][1] == 'bool' :
+			variables[varName][0] = z3.Bool(varName)
+		else :
+			variables[varName][0] = z3.Int(varName)
 	return(variables)
 
 
 
 # Parses a single sentence of the knowledge base
-# @words	 : a list of words in the sentence. Each word should be
-#              either a variable, operator, or parens
-# @wordIndex : which word in the list should be parsed next
-# @variables : a list the z3 variables declared in the csv file
-# @return    : a z3 instance. When called on the whole sentence with
-#              wordIndex 0, the z3 instance will be the sentence's
-parseResult = collections.namedtuple("ParseResult", ['nextIndex', 'Instance'])
-def ParseKnowledgeSentence(words, wordIndex, variables, varNames) :
-
-	while len(words) > wordIndex :
-		word = words[wordIndex]
-		wordIndex += 1
-
-		if word in varNames :
-			lastInstance = variables[word][0]
-
-		else :
-
-			if (word == "not") or (word == "Not") :
-				recResult = ParseKnowledgeSentence(words, wordIndex, variables, varNames)
-				wordIndex = recResult.nextIndex
-				result = parseResult(nextIndex = wordIndex, Instance = Not(recResult.Instance))
-				return(result)
-
-			elif word ==  "(" :
-				recResult = ParseKnowledgeSentence(words, wordIndex, variables, varNames)
-				wordIndex = recResult.nextIndex
-
-				lastInstance = recResult.Instance
-
-			elif word == ")" :
-				result = parseResult(Instance = lastInstance, nextIndex = wordIndex)
-				return(result)
-
-			elif word in ["implies", "Implies", "->"] :
-				recResult = ParseKnowledgeSentence(words, wordIndex, variables, varNames)
-				result = parseResult(nextIndex = recResult.nextIndex, Instance = Implies(lastInstance, recResult.Instance))
-				return(result)
-			elif word in ["and", "And", "&"] :
-				recResult = ParseKnowledgeSentence(words, wordIndex, variables, varNames)
-				result = parseResult(nextIndex = recResult.nextIndex, Instance = And(lastInstance, recResult.Instance))
-				return(result)			
-			elif word in ["or", "Or", "||"] :
-				recResult = ParseKnowledgeSentence(words, wordIndex, variables, varNames)
-				result = parseResult(nextIndex = recResult.nextIndex, Instance = Or(lastInstance, recResult.Instance))
-				return(result)
-			elif word in ["Xor", "xor"] :
-				recResult = ParseKnowledgeSentence(words, wordIndex, variables, varNames)
-				result = parseResult(nextIndex = recResult.nextIndex, Instance = Xor(lastInstance, recResult.Instance))
-				return(result)
-			elif word in ["=", "==", "iff"] :
-				recResult = ParseKnowledgeSentence(words, wordIndex, variables, varNames)
-				nextInstance = (lastInstance == recResult.Instance)
-				result = parseResult(nextIndex = recResult.nextIndex, Instance = nextInstance)
-				return(result)
-			elif word in ["!=", "<>", "=/="] :
-				recResult = ParseKnowledgeSentence(words, wordIndex, variables, varNames)
-				nextInstance = (lastInstance != recResult.Instance)
-				result = parseResult(nextIndex = recResult.nextIndex, Instance = nextInstance)
-				return(result)	
-			elif word == ">" :
-				recResult = ParseKnowledgeSentence(words, wordIndex, variables, varNames)
-				result = parseResult(nextIndex = recResult.nextIndex, Instance = (lastInstance > recResult.Instance))
-				return(result)
-			elif word == "<" :
-				recResult = ParseKnowledgeSentence(words, wordIndex, variables, varNames)
-				result = parseResult(nextIndex = recResult.nextIndex, Instance = (lastInstance < recResult.Instance))
-				return(result)
-			elif word == ">=" :
-				recResult = ParseKnowledgeSentence(words, wordIndex, variables, varNames)
-				result = parseResult(nextIndex = recResult.nextIndex, Instance = (lastInstance >= recResult.Instance))
-				return(result)
-			elif word == "<=" :
-				recResult = ParseKnowledgeSentence(words, wordIndex, variables, varNames)
-				result = parseResult(nextIndex = recResult.nextIndex, Instance = (lastInstance <= recResult.Instance))
-				return(result)
-			elif RepresentsInt(word) :
-				lastInstance = int(word)
-			elif word == "+" :
-				nextExpr = GetNextExpr(words, wordIndex, variables, varNames)
-				lastInstance = (lastInstance + nextExpr)
-				wordIndex += 1
-			else :
-				print("Error parsing background knowledge ")
-				sys.exit(word + " is neither variable nor operator")
-
-	result = parseResult(Instance = lastInstance, nextIndex = 0)
-	return(result)
-
-
-def GetNextExpr(words, wordIndex, variables, varNames) :
-	while len(words) > wordIndex :
-		word = words[wordIndex]
-		wordIndex += 1
-
-		if word in varNames :
-			return (variables[word][0])
-		elif RepresentsInt(word) :
-			return (int(word))
-		else :
-			print("Error processing arithmetic")
-			sys.exit("TODO finish implementing this")
-
-
-
-
-# Wrapper for ParseKnowledgeSentence
-def ParseSentence(sentence, variables) :
-	sentenceIndex = 0
-	spacedSentence = ''
-	#Pad the parentheses with spaces for easier parsing
-	for char in sentence :
-
-		if char == '(' or char == ')' :
-			spacedSentence = spacedSentence + ' ' + char + ' '
-		else :
-			spacedSentence = spacedSentence + char
-
-		sentenceIndex += 1
-	variableNames = variables.keys()
-	result = ParseKnowledgeSentence(spacedSentence.split(), 0, variables, variableNames)
-	return(result.Instance)
-
-# Parse the csv file and print the prior probability using Demski's alg
-# @csvFileName  : a string specifying the variables, background knowledge
-#                 and statement(s) of interest
-# @secondsToRun : how many seconds to run Demski's algorithm for.
-#				  The time taken to pre-process the file is not
-#				  included
-# @return       : A triple of the consistent models, the number of times
-#                 the sentence of interest was true in these models,
-#                 and the number of times it was true after updating.
-def ParseInputFile(csvFileName, secondsToRun) :
-	csvFile = open(csvFileName, 'rb')
-	rows = csv.reader(csvFile, delimiter=',')
-	variableRow = rows.next()
-
+# @sentence  : the sentence as written in the input
+# @variables : the variables declared in the csv file
+# @parser    : optional SentenceParser for these variables. Parsing a
+#              file's sentences with one parser shares their common
+#              subexpressions
+# @return    : the z3 instance of the sentence
+def ParseSentence(sentence, variables, parser=None) :
+	if parser is None :
+		parser = SentenceParser(variables)
+	return(parser.parse(sentence))
+
+# The parsed contents of an input file
+inputFile = collections.namedtuple("InputFile", ['variables', 'unfixedVarNames',
+	'backgroundKnowledge', 'statementOfInterest', 'queries', 'updatedKnowledgeSentences'])
+
+# A sentence whose probability is wanted, optionally conditioned on
+# another sentence. condition is None for unconditional queries
+query = collections.namedtuple("Query", ['text', 'sentence', 'condition'])
+
+# Parses a query of the form 'S', 'S | S' or 'S given S'
+# @queryString : the query as written in the input
+# @variables   : the variables declared in the csv file
+# @parser      : optional SentenceParser, as for ParseSentence
+# @return      : a Query tuple
+def ParseQuery(queryString, variables, parser=None) :
+	parts = re.split(r'(?<!\|)\|(?!\|)|\bgiven\b', queryString)
+	if len(parts) > 2 :
+		sys.exit("Queries can only be conditioned once: " + queryString)
+	sentence = ParseSentence(parts[0], variables, parser)
+	condition = None
+	if len(parts) == 2 :
+		condition = ParseSentence(parts[1], variables, parser)
+	return(query(text = queryString.strip(), sentence = sentence, condition = condition))
+
+# @return : the rows of a four-row csv input file as lists of cells, the
+#           variable, knowledge and query rows and the update row, which
+#           is None if the file has no fourth row
+def ReadInputRows(csvFileName) :
+	with open(csvFileName, 'rb') as csvFile :
+		rows = csv.reader(csvFile, delimiter=',')
+		variableRow = rows.next()
+		knowledgeRow = rows.next()
+		queryRow = rows.next()
+		updatedRow = next(rows, None)
+	return((variableRow, knowledgeRow, queryRow, updatedRow or None))
+
+# Parse the csv file into z3 variables and sentences
+# @csvFileName : a string specifying the variables, background knowledge
+#                and statement(s) of interest
+# @return      : an InputFile tuple. queries holds a Query for each cell
+#                of the third row and statementOfInterest is the sentence
+#                of the first. updatedKnowledgeSentences holds the
+#                parsed sentences of the fourth row, or None if there is
+#                no fourth row
+def ReadInputFile(csvFileName) :
+	variableRow, sentences, queryRow, updatedRow = ReadInputRows(csvFileName)
 
 	variables = ParseVariables(variableRow)
+	parser = SentenceParser(variables)
 
 	# Collect the unfixed probability variables
 	unfixedVarNames = []
@@ -408,13 +1139,12 @@ def ParseInputFile(csvFileName, secondsToRun) :
 		if variables[varName][-1] :
 			unfixedVarNames.append(varName)
 
-	sentences = rows.next()
 	backgroundKnowledge = []
 	for sentence in sentences :
 		if sentence == '' :
 			pass
 		else :
-			backgroundKnowledge.append(ParseSentence(sentence,variables))
+			backgroundKnowledge.append(ParseSentence(sentence, variables, parser))
 
 	# Add constraints for uniform variables having bounded range
 	for varName in variables.keys() :
@@ -423,49 +1153,152 @@ def ParseInputFile(csvFileName, secondsToRun) :
 			backgroundKnowledge.append(variableList[0] > variableList[2]-1)
 			backgroundKnowledge.append(variableList[0] < variableList[3]+1)
 
+	queries = []
+	for queryString in queryRow :
+		if queryString.strip() != '' :
+			queries.append(ParseQuery(queryString, variables, parser))
+	statementOfInterest = queries[0].sentence
+
+	updatedKnowledgeSentences = None
+	if updatedRow :
+		updatedKnowledgeSentences = []
+		for sentence in updatedRow :
+			if sentence == '' :
+				pass
+			else :
+				updatedKnowledgeSentences.append(ParseSentence(sentence, variables, parser))
+
+	return(inputFile(variables = variables, unfixedVarNames = unfixedVarNames,
+		backgroundKnowledge = backgroundKnowledge,
+		statementOfInterest = statementOfInterest, queries = queries,
+		updatedKnowledgeSentences = updatedKnowledgeSentences))
+
+# Parse the csv file and print the prior probability using Demski's alg
+# @csvFileName  : a string specifying the variables, background knowledge
+#                 and statement(s) of interest
+# @secondsToRun : how many seconds to run Demski's algorithm for.
+#				  The time taken to pre-process the file is not
+#				  included. May be None if numSamples is given
+# @numSamples   : optional number of models to stop sampling at
+# @cache        : optional ModelCache. Models (and approximated
+#                 meta-priors) cached for the same variables and
+#                 background knowledge are reused, and only the
+#                 shortfall up to numSamples is sampled. importance,
+#                 targetWidth and progressCallback can't be used with it
+# @prune        : if true, variables and sentences which can't influence
+#                 the sentence of interest or the updates are left out,
+#                 and the models only hold the remaining variables
+# @decompose    : if true, independent components of the remaining
+#                 knowledge base are sampled separately (see
+#                 DecomposedDemskiPrior). Not used with a cache, and
+#                 can't be combined with importance or targetWidth
+# @exportPrefix : optional path prefix to write the sampled and updated
+#                 models to as model files (see exportModelSets), which
+#                 ModelStore.fromFile maps back without copying
+# @numWorkers   : if more than one, each round of approximating the
+#                 unfixed meta-priors samples on that many processes
+# @samplerOptions : further keyword arguments for DemskiPrior, such as
+#                 targetWidth, progressCallback and stats. A SolverStats
+#                 given as stats also records parsing and updating, and a
+#                 seeded random.Random given as rng makes the run repeatable
+# @return       : A tuple of a ModelStore of the consistent models, the
+#                 number of initial models, the number of times the
+#                 sentence of interest was true in them, the number of
+#                 times it was true after updating, and the number of
+#                 models left after updating.
+def ParseInputFile(csvFileName, secondsToRun, numSamples=None, cache=None, prune=True,
+                   decompose=False, exportPrefix=None, numWorkers=None, **samplerOptions) :
+	stats = samplerOptions.get('stats', noStats)
+	with stats.phase('parse') :
+		parsed = ReadInputFile(csvFileName)
+	return(SampleParsedInput(parsed, secondsToRun, numSamples, cache, prune, decompose,
+		exportPrefix, numWorkers, **samplerOptions))
+
+# The rest of ParseInputFile once its input is read: prunes the knowledge
+# base, approximates the unfixed meta-priors, samples and updates
+# @parsed : an InputFile tuple, or any tuple with the same fields such as
+#           a StreamedInput holding its sentences
+# The other arguments and the result are as for ParseInputFile
+def SampleParsedInput(parsed, secondsToRun, numSamples=None, cache=None, prune=True,
+                      decompose=False, exportPrefix=None, numWorkers=None, **samplerOptions) :
+	stats = samplerOptions.get('stats', noStats)
+	rng = samplerOptions.get('rng', randomModule)
+	variables = parsed.variables
+	unfixedVarNames = parsed.unfixedVarNames
+	backgroundKnowledge = parsed.backgroundKnowledge
+	statementOfInterest = parsed.statementOfInterest
+
 	# Check if all variables are potentially capable of influencing the outcome of interest
-	statementOfInterest = ParseSentence(rows.next(),variables)
-	relevantVars = transClosure(backgroundKnowledge, statementOfInterest)
-	if (len(relevantVars) < len(variables)) :
-		print("Warning: not all variables declared are in the transitive closure with the sentence of interest")
+	with stats.phase('transClosure') :
+		index = IncidenceIndex(backgroundKnowledge)
+		sentencesOfInterest = [statementOfInterest] + (parsed.updatedKnowledgeSentences or [])
+		prunedKnowledge, relevantVariables = PruneKnowledgeBase(backgroundKnowledge, variables,
+			sentencesOfInterest, index)
+	if len(relevantVariables) < len(variables) :
+		if not prune :
+			print("Warning: not all variables declared are in the transitive closure with the sentence of interest")
+		else :
+			# The left out sentences must still be consistent
+			T = NewSolver(backgroundKnowledge, variables, samplerOptions.get('backend'))
+			if not solverCheck(T, stats, 'consistency') :
+				sys.exit("Background knowledge not consistent")
+			print("Sampling the " + str(len(relevantVariables)) + " of " + str(len(variables)) +
+			      " variables connected to the sentence of interest")
+			backgroundKnowledge = prunedKnowledge
+			variables = relevantVariables
+			unfixedVarNames = [varName for varName in unfixedVarNames if varName in variables]
+			index = IncidenceIndex(backgroundKnowledge)
+
+	fingerprint = None
+	metaPriors = None
+	if cache is not None :
+		if numSamples is None :
+			sys.exit("A sample budget is needed to use the model cache")
+		fingerprint = KnowledgeBaseFingerprint(variables, backgroundKnowledge)
+		metaPriors = cache.metaPriors(fingerprint)
 
 	# Approximate unfixed variable probabilities
 	if unfixedVarNames :
-		variables = approximateUnfixedProbabilities(backgroundKnowledge, variables, unfixedVarNames, secondsToRun/2)	
-
-	result = DemskiPrior(backgroundKnowledge, variables, statementOfInterest, secondsToRun)
+		if metaPriors :
+			for varName in metaPriors :
+				setMetaPrior(variables, varName, metaPriors[varName])
+		else :
+			variables = approximateUnfixedProbabilities(backgroundKnowledge, variables,
+				unfixedVarNames, stats = stats, numWorkers = numWorkers, rng = rng,
+				**metaPriorBudget(secondsToRun, numSamples, samplerOptions))
+			metaPriors = dict((varName, metaPrior(variables, varName))
+			                  for varName in unfixedVarNames)
+
+	if cache is not None :
+		result = CachedDemskiPrior(cache, fingerprint, backgroundKnowledge, variables,
+			statementOfInterest, numSamples, secondsToRun, metaPriors, **samplerOptions)
+	elif decompose :
+		result = DecomposedDemskiPrior(backgroundKnowledge, variables, statementOfInterest,
+			secondsToRun, numSamples, index, **samplerOptions)
+	else :
+		result = DemskiPrior(backgroundKnowledge, variables, statementOfInterest, secondsToRun,
+			numSamples, **samplerOptions)
 	consistentPaths = result[0]
 	initialSOICount = result[1]
 	numInitialModels = len(consistentPaths)
 
-	# TO-DO add separate method for updating that way
-	# it can be done in response to new info.
-	updatedKnowledgeSentences = next(rows, None)
-	if updatedKnowledgeSentences :
-		updatedKnowledge = backgroundKnowledge
-		for sentence in updatedKnowledgeSentences :
-			if sentence == '' :
-				pass
-			else :
-				updatedKnowledge.append(ParseSentence(sentence,variables))
-		result = consumptiveUpdate(consistentPaths, statementOfInterest, updatedKnowledge)
-		consistentPaths = result[0]
-		updatedSOICount = result[1]
+	# Update on each new sentence in turn, checking only that sentence
+	if parsed.updatedKnowledgeSentences is not None :
+		posterior = Posterior(backgroundKnowledge, variables, statementOfInterest,
+			consistentPaths, minModels = 0, stats = stats)
+		for sentence in parsed.updatedKnowledgeSentences :
+			posterior.observe(sentence)
+		consistentPaths = posterior.consistentPaths
+		updatedSOICount = posterior.interestCount()
 		numUpdatedModels = len(consistentPaths)
 	else :
 		updatedSOICount = initialSOICount
 		numUpdatedModels = len(consistentPaths)
+	exportModelSets(exportPrefix, result[0],
+		consistentPaths if parsed.updatedKnowledgeSentences is not None else None)
 	return((consistentPaths, numInitialModels, 
 		initialSOICount, updatedSOICount, numUpdatedModels))
 
-# Returns true if s can be coerced to an integer
-def RepresentsInt(s):
-    try: 
-        int(s)
-        return True
-    except ValueError:
-        return False
-
 
 # Wrapper to let Z3 instances to be used in python hash tables
 class AstRefKey:
@@ -479,42 +1312,52 @@ class AstRefKey:
         return str(self.n)
 
 def askey(n):
-    assert isinstance(n, AstRef)
+    assert isinstance(n, z3.AstRef)
     return AstRefKey(n)
 
 def get_vars(f):
     r = set()
-    def collect(f):
-      if is_const(f): 
-          if f.decl().kind() == Z3_OP_UNINTERPRETED and not askey(f) in r:
-              r.add(askey(f))
-      else:
-          for c in f.children():
-              collect(c)
-    collect(f)
+    seen = set()
+    stack = [f]
+    while stack:
+        f = stack.pop()
+        if f.get_id() in seen:
+            continue
+        seen.add(f.get_id())
+        if z3.is_const(f):
+            if f.decl().kind() == z3.Z3_OP_UNINTERPRETED:
+                r.add(askey(f))
+        else:
+            stack.extend(f.children())
     return r
 
 # Find the transitive closure of variables which are logically
 # connected to the sentence of interest
-def transClosure(backgroundKnowledge, SOI) :
-
-	connectedVars = set(get_vars(SOI))
-	newConnections = True
-	while newConnections :
-		newConnections = False
-		for sentence in backgroundKnowledge :
-
-			# Add variables in sentences connected to variables
-			# already in our set, but only there are new vars to add.
-			sentenceSet = set(get_vars(sentence))
-			if (connectedVars & sentenceSet) :
-				if (connectedVars.issuperset(sentenceSet)) :
-					pass
-				else :
-					connectedVars = connectedVars.union(sentenceSet)
-					newConnections = True
-
-	return(connectedVars)
+# @index  : optional IncidenceIndex of backgroundKnowledge, to save
+#           building it again
+# @return : the names of the connected variables
+def transClosure(backgroundKnowledge, SOI, index=None) :
+	if index is None :
+		index = IncidenceIndex(backgroundKnowledge)
+	return(index.relevantVariables([SOI]))
+
+# Drops the variables and sentences which can't influence some sentences.
+# Variables in different components of the knowledge base are sampled
+# independently by DemskiPrior, so leaving out the components which the
+# sentences don't touch doesn't change their probabilities.
+# @knowledgeBase : a list of z3 sentences
+# @variables     : the dictionary of variables from ParseVariables
+# @sentences     : the sentences whose probabilities are wanted,
+#                  including any to be updated on
+# @index         : optional IncidenceIndex of knowledgeBase
+# @return        : a pair of the relevant sentences and a dictionary of
+#                  the relevant variables
+def PruneKnowledgeBase(knowledgeBase, variables, sentences, index=None) :
+	if index is None :
+		index = IncidenceIndex(knowledgeBase)
+	relevantVars = index.relevantVariables(sentences) & set(variables.keys())
+	relevantVariables = dict((varName, variables[varName]) for varName in relevantVars)
+	return((index.relevantSentences(relevantVars), relevantVariables))
 
 
 
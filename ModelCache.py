@@ -0,0 +1,144 @@
+import contextlib
+import hashlib
+import json
+import os
+import time
+
+import numpy
+
+try :
+	import fcntl
+except ImportError :
+	fcntl = None
+
+from ModelStore import ModelStore
+
+
+# Canonical hash of a knowledge base and the variables it is sampled
+# over. Sentence order and dictionary order don't change the result.
+# @variables     : the dictionary of variables from ParseVariables, before
+#                  any unfixed meta-priors have been approximated
+# @knowledgeBase : a list of z3 sentences
+# @return        : a hex digest identifying the sampling problem
+def KnowledgeBaseFingerprint(variables, knowledgeBase) :
+	declarations = []
+	for varName in sorted(variables.keys()) :
+		declarations.append([varName] + [repr(arg) for arg in variables[varName][1:]])
+	sentences = sorted(sentence.sexpr() for sentence in knowledgeBase)
+	canonical = json.dumps([declarations, sentences], sort_keys=True)
+	return(hashlib.sha256(canonical.encode('utf-8')).hexdigest())
+
+
+# Directory of sampled ModelStores keyed by knowledge-base fingerprint.
+# Each entry is a compressed .npz file. An index records the size and
+# last use of each entry, and the least recently used entries are
+# removed once the cache grows past maxBytes or maxEntries.
+# Several processes can share a cache directory. Files are written under
+# a name unique to the process and renamed into place, and the index is
+# reread and rewritten under a lock on the directory's lock file, so no
+# process sees a half written file or loses another's entries. Where
+# fcntl is missing, as on windows, the index isn't locked.
+class ModelCache(object) :
+
+	def __init__(self, cacheDir, maxBytes=256 * 1024 * 1024, maxEntries=None) :
+		self.cacheDir = cacheDir
+		self.maxBytes = maxBytes
+		self.maxEntries = maxEntries
+		if not os.path.isdir(cacheDir) :
+			os.makedirs(cacheDir)
+		self.indexPath = os.path.join(cacheDir, 'index.json')
+		self.lockPath = os.path.join(cacheDir, 'index.lock')
+		self.index = {}
+		with self.locked() :
+			self.readIndex()
+
+	def entryPath(self, fingerprint) :
+		return(os.path.join(self.cacheDir, fingerprint + '.npz'))
+
+	# @return : a path next to path for this process to write to before
+	#           renaming it into place
+	def temporaryPath(self, path, extension='') :
+		return(path + '.' + str(os.getpid()) + '.tmp' + extension)
+
+	# Holds the lock on the index while the block runs
+	@contextlib.contextmanager
+	def locked(self) :
+		if fcntl is None :
+			yield
+			return
+		with open(self.lockPath, 'a') as lockFile :
+			fcntl.flock(lockFile.fileno(), fcntl.LOCK_EX)
+			try :
+				yield
+			finally :
+				fcntl.flock(lockFile.fileno(), fcntl.LOCK_UN)
+
+	# Rereads the index, picking up entries written by other processes
+	def readIndex(self) :
+		self.index = {}
+		if os.path.exists(self.indexPath) :
+			with open(self.indexPath) as indexFile :
+				self.index = json.load(indexFile)
+
+	def writeIndex(self) :
+		temporaryPath = self.temporaryPath(self.indexPath)
+		with open(temporaryPath, 'w') as indexFile :
+			json.dump(self.index, indexFile)
+		os.rename(temporaryPath, self.indexPath)
+
+	# @return : the cached ModelStore, or None if not cached
+	def load(self, fingerprint) :
+		path = self.entryPath(fingerprint)
+		with self.locked() :
+			self.readIndex()
+			if fingerprint not in self.index or not os.path.exists(path) :
+				return(None)
+			with numpy.load(path) as arrays :
+				store = ModelStore.fromArrays(arrays)
+			self.index[fingerprint]['lastUsed'] = time.time()
+			self.writeIndex()
+		return(store)
+
+	# @return : a dictionary of the unfixed variable meta-priors the cached
+	#           models were sampled with, or None if not cached
+	def metaPriors(self, fingerprint) :
+		with self.locked() :
+			self.readIndex()
+		if fingerprint not in self.index :
+			return(None)
+		return(self.index[fingerprint]['metaPriors'])
+
+	# Stores the models for a fingerprint, replacing any earlier entry
+	# @metaPriors : the probabilities of unfixed variables used to sample
+	def save(self, fingerprint, store, metaPriors=None) :
+		path = self.entryPath(fingerprint)
+		temporaryPath = self.temporaryPath(path, '.npz')
+		numpy.savez_compressed(temporaryPath, **store.toArrays())
+
+		with self.locked() :
+			os.rename(temporaryPath, path)
+			self.readIndex()
+			self.index[fingerprint] = {'bytes' : os.path.getsize(path),
+			                           'numModels' : len(store),
+			                           'metaPriors' : metaPriors or {},
+			                           'lastUsed' : time.time()}
+			self.evict(keep = fingerprint)
+			self.writeIndex()
+
+	# Removes least recently used entries until the cache is within its
+	# limits. The entry named by keep is never removed. Called with the
+	# index locked
+	def evict(self, keep=None) :
+		byAge = sorted(self.index.keys(), key = lambda entry : self.index[entry]['lastUsed'])
+		totalBytes = sum(self.index[entry]['bytes'] for entry in byAge)
+		for entry in byAge :
+			overBytes = totalBytes > self.maxBytes
+			overEntries = self.maxEntries is not None and len(self.index) > self.maxEntries
+			if not (overBytes or overEntries) :
+				break
+			if entry == keep :
+				continue
+			totalBytes -= self.index[entry]['bytes']
+			del self.index[entry]
+			if os.path.exists(self.entryPath(entry)) :
+				os.remove(self.entryPath(entry))
@@ -0,0 +1,326 @@
+import json
+import numpy
+import sys
+
+
+# Model files, written by ModelStore.toFile, start with this magic
+# string, the length of a JSON header as a little endian 8 byte integer,
+# and the header itself. The header gives the variable names and, for
+# each of the boolBits, unifValues and weights matrices, its dtype, shape
+# and offset from the end of the header. Every matrix starts on a
+# multiple of modelFileAlignment bytes so it can be mapped in place.
+modelFileMagic = b'MODELS\x00\x01'
+modelFileAlignment = 64
+modelFileExtension = '.models'
+
+# @return : padding bytes taking a size up to the alignment
+def _alignmentPadding(size) :
+	return(b'\x00' * (-size % modelFileAlignment))
+
+# Names come back from the JSON header as unicode, which under python 2
+# this code keeps as utf-8 byte strings
+def _nativeName(name) :
+	if sys.version_info[0] < 3 :
+		return(name.encode('utf-8'))
+	return(name)
+
+
+# Columnar storage for the models produced by the prior algorithms.
+# Boolean assignments are kept as packed bit rows and unif values as an
+# integer matrix, with a header giving the column of each variable.
+# Models drawn by importance sampling also carry a likelihood ratio
+# weight each; weights is None for unweighted stores.
+class ModelStore(object) :
+
+	# @boolNames : names of the boolean variables, in column order
+	# @unifNames : names of the unif variables, in column order
+	# @capacity  : number of models to allocate space for initially
+	# @weighted  : if true every model carries a weight
+	def __init__(self, boolNames, unifNames, capacity=64, weighted=False) :
+		self.boolNames = list(boolNames)
+		self.unifNames = list(unifNames)
+		self.boolIndex = dict((name, i) for i, name in enumerate(self.boolNames))
+		self.unifIndex = dict((name, i) for i, name in enumerate(self.unifNames))
+		self.numModels = 0
+		self.packedWidth = (len(self.boolNames) + 7) // 8
+		self.boolBits = numpy.zeros((capacity, self.packedWidth), dtype=numpy.uint8)
+		self.unifValues = numpy.zeros((capacity, len(self.unifNames)), dtype=numpy.int64)
+		self.weights = None
+		if weighted :
+			self.weights = numpy.ones(capacity, dtype=numpy.float64)
+
+	# @variables : the dictionary of variables from ParseVariables
+	# @return    : an empty store with a column for every variable
+	@classmethod
+	def fromVariables(cls, variables, weighted=False) :
+		boolNames = [name for name in variables.keys() if variables[name][1] == 'bool']
+		unifNames = [name for name in variables.keys() if variables[name][1] == 'unif']
+		return(cls(boolNames, unifNames, weighted = weighted))
+
+	# @return : an empty store with the same columns as this one
+	def emptyCopy(self, capacity=64) :
+		return(ModelStore(self.boolNames, self.unifNames, capacity, self.weights is not None))
+
+	def __len__(self) :
+		return(self.numModels)
+
+	def __iter__(self) :
+		for i in range(self.numModels) :
+			yield self.model(i)
+
+	def reserve(self, capacity) :
+		if capacity <= len(self.boolBits) :
+			return
+		capacity = max(capacity, 2 * len(self.boolBits))
+		self.boolBits = numpy.resize(self.boolBits, (capacity, self.packedWidth))
+		self.unifValues = numpy.resize(self.unifValues, (capacity, len(self.unifNames)))
+		if self.weights is not None :
+			self.weights = numpy.resize(self.weights, capacity)
+
+	# Adds one model
+	# @boolValues : truth values of the boolean variables in column order
+	# @unifValues : values of the unif variables in column order
+	# @weight     : the model's weight, for weighted stores
+	def appendRow(self, boolValues, unifValues, weight=1.0) :
+		self.reserve(self.numModels + 1)
+		if self.packedWidth :
+			self.boolBits[self.numModels] = numpy.packbits(numpy.asarray(boolValues, dtype=numpy.uint8))
+		self.unifValues[self.numModels] = unifValues
+		if self.weights is not None :
+			self.weights[self.numModels] = weight
+		self.numModels += 1
+
+	# Adds every model of another store with the same columns
+	def extend(self, other) :
+		if other.boolNames != self.boolNames or other.unifNames != self.unifNames :
+			raise ValueError("model stores have different variables")
+		if (other.weights is None) != (self.weights is None) :
+			raise ValueError("only one of the model stores is weighted")
+		self.reserve(self.numModels + other.numModels)
+		end = self.numModels + other.numModels
+		self.boolBits[self.numModels:end] = other.boolBits[:other.numModels]
+		self.unifValues[self.numModels:end] = other.unifValues[:other.numModels]
+		if self.weights is not None :
+			self.weights[self.numModels:end] = other.weights[:other.numModels]
+		self.numModels = end
+
+	# @return : a (models x boolean variables) array of truth values
+	def boolMatrix(self) :
+		unpacked = numpy.unpackbits(self.boolBits[:self.numModels], axis=1)
+		return(unpacked[:, :len(self.boolNames)].astype(bool))
+
+	# @return : a (models x unif variables) array of values
+	def unifMatrix(self) :
+		return(self.unifValues[:self.numModels])
+
+	# @return : the weight of every model, all ones for unweighted stores
+	def weightVector(self) :
+		if self.weights is None :
+			return(numpy.ones(self.numModels))
+		return(self.weights[:self.numModels])
+
+	# @return : the effective number of models behind weighted estimates,
+	#           (sum of weights)^2 / (sum of squared weights)
+	def effectiveSize(self) :
+		if self.weights is None :
+			return(float(self.numModels))
+		weights = self.weights[:self.numModels]
+		squares = float((weights * weights).sum())
+		if squares == 0 :
+			return(0.0)
+		return(float(weights.sum()) ** 2 / squares)
+
+	# @return : an array with the value of a variable in every model
+	def column(self, name) :
+		if name in self.boolIndex :
+			index = self.boolIndex[name]
+			byte = self.boolBits[:self.numModels, index // 8]
+			return(((byte >> (7 - index % 8)) & 1).astype(bool))
+		return(self.unifValues[:self.numModels, self.unifIndex[name]])
+
+	# @return : a dictionary from variable names to values for one model
+	def model(self, i) :
+		values = {}
+		if self.packedWidth :
+			bits = numpy.unpackbits(self.boolBits[i])
+			for name, index in self.boolIndex.items() :
+				values[name] = bool(bits[index])
+		for name, index in self.unifIndex.items() :
+			values[name] = int(self.unifValues[i, index])
+		return(values)
+
+	# @return : the names of the boolean variables true in one model
+	def trueVarNames(self, i) :
+		if not self.packedWidth :
+			return([])
+		bits = numpy.unpackbits(self.boolBits[i])
+		return([name for name, bit in zip(self.boolNames, bits) if bit])
+
+	# @selector : a boolean mask or an array of model indices
+	# @return   : a new store holding only the selected models
+	def select(self, selector) :
+		boolBits = self.boolBits[:self.numModels][selector]
+		selected = self.emptyCopy(max(len(boolBits), 1))
+		selected.boolBits[:len(boolBits)] = boolBits
+		selected.unifValues[:len(boolBits)] = self.unifValues[:self.numModels][selector]
+		if self.weights is not None :
+			selected.weights[:len(boolBits)] = self.weights[:self.numModels][selector]
+		selected.numModels = len(boolBits)
+		return(selected)
+
+	# @return : a dictionary of arrays from which fromArrays can rebuild
+	#           the store, suitable for numpy.savez
+	def toArrays(self) :
+		arrays = {'boolNames'  : numpy.array(self.boolNames, dtype=str),
+		          'unifNames'  : numpy.array(self.unifNames, dtype=str),
+		          'boolBits'   : self.boolBits[:self.numModels],
+		          'unifValues' : self.unifValues[:self.numModels]}
+		if self.weights is not None :
+			arrays['weights'] = self.weights[:self.numModels]
+		return(arrays)
+
+	# Inverse of toArrays
+	@classmethod
+	def fromArrays(cls, arrays) :
+		weighted = 'weights' in arrays
+		store = cls([str(name) for name in arrays['boolNames']],
+		            [str(name) for name in arrays['unifNames']],
+		            max(len(arrays['boolBits']), 1), weighted)
+		store.numModels = len(arrays['boolBits'])
+		store.boolBits[:store.numModels] = arrays['boolBits']
+		store.unifValues[:store.numModels] = arrays['unifValues']
+		if weighted :
+			store.weights[:store.numModels] = arrays['weights']
+		return(store)
+
+	# Writes the models as a model file, which fromFile opens again
+	# without reading the matrices into memory
+	def toFile(self, fileName) :
+		matrices = [('boolBits', self.boolBits[:self.numModels]),
+		            ('unifValues', self.unifValues[:self.numModels])]
+		if self.weights is not None :
+			matrices.append(('weights', self.weights[:self.numModels]))
+		header = {'version' : 1, 'numModels' : self.numModels,
+		          'boolNames' : self.boolNames, 'unifNames' : self.unifNames,
+		          'matrices' : {}}
+		offset = 0
+		for name, matrix in matrices :
+			header['matrices'][name] = {'dtype' : matrix.dtype.str, 'shape' : list(matrix.shape),
+			                            'offset' : offset}
+			offset += matrix.nbytes + len(_alignmentPadding(matrix.nbytes))
+
+		headerBytes = json.dumps(header, sort_keys = True).encode('utf-8')
+		headerBytes += b' ' * (-(len(modelFileMagic) + 8 + len(headerBytes)) % modelFileAlignment)
+		with open(fileName, 'wb') as modelFile :
+			modelFile.write(modelFileMagic)
+			modelFile.write(numpy.array([len(headerBytes)], dtype='<u8').tobytes())
+			modelFile.write(headerBytes)
+			for name, matrix in matrices :
+				numpy.ascontiguousarray(matrix).tofile(modelFile)
+				modelFile.write(_alignmentPadding(matrix.nbytes))
+
+	# Opens a model file written by toFile. The matrices are numpy.memmap
+	# arrays over the file, so only the pages used are ever read, and
+	# processes opening the same file share them
+	# @mode   : the numpy.memmap mode. 'r' is read only, 'c' copies pages
+	#           on writing to them and 'r+' writes changes to the file
+	# @return : a store of the models in the file. Adding models to it
+	#           copies them into memory
+	@classmethod
+	def fromFile(cls, fileName, mode='r') :
+		with open(fileName, 'rb') as modelFile :
+			if modelFile.read(len(modelFileMagic)) != modelFileMagic :
+				raise ValueError(fileName + " is not a model file")
+			headerLength = int(numpy.frombuffer(modelFile.read(8), dtype='<u8')[0])
+			header = json.loads(modelFile.read(headerLength).decode('utf-8'))
+		if header['version'] != 1 :
+			raise ValueError(fileName + " has unknown model file version " + str(header['version']))
+		dataStart = len(modelFileMagic) + 8 + headerLength
+
+		matrices = header['matrices']
+		store = cls([_nativeName(name) for name in header['boolNames']],
+		            [_nativeName(name) for name in header['unifNames']], 0, 'weights' in matrices)
+		for name in matrices :
+			shape = tuple(matrices[name]['shape'])
+			dtype = numpy.dtype(str(matrices[name]['dtype']))
+			if header['numModels'] and all(shape) :
+				matrix = numpy.memmap(fileName, dtype, mode, dataStart + matrices[name]['offset'], shape)
+			else :
+				matrix = numpy.zeros(shape, dtype)
+			setattr(store, name, matrix)
+		store.numModels = header['numModels']
+		return(store)
+
+	# @return : the total bytes used by the stored models
+	def nbytes(self) :
+		total = self.boolBits[:self.numModels].nbytes + self.unifValues[:self.numModels].nbytes
+		if self.weights is not None :
+			total += self.weights[:self.numModels].nbytes
+		return(total)
+
+
+# Read-only sequence giving the true variable names of each model,
+# without materialising them all at once
+class TrueVarNamesView(object) :
+
+	def __init__(self, store) :
+		self.store = store
+
+	def __len__(self) :
+		return(len(self.store))
+
+	def __getitem__(self, i) :
+		if i < 0 :
+			i += len(self.store)
+		if not 0 <= i < len(self.store) :
+			raise IndexError(i)
+		return(self.store.trueVarNames(i))
+
+	def __iter__(self) :
+		for i in range(len(self.store)) :
+			yield self.store.trueVarNames(i)
+
+
+# Concatenates stores which share the same columns
+# @return : a new store holding every model of every store in order
+def concatenateStores(stores) :
+	stores = list(stores)
+	merged = stores[0].emptyCopy(max(sum(len(store) for store in stores), 1))
+	for store in stores :
+		merged.extend(store)
+	return(merged)
+
+
+# Places the columns of stores over disjoint variables side by side, so
+# that model i of the result combines model i of each store
+# @numModels : how many models to take from each store
+# @return    : a new store with the variables of every store
+def joinStores(stores, numModels) :
+	boolNames = [name for store in stores for name in store.boolNames]
+	unifNames = [name for store in stores for name in store.unifNames]
+	weighted = any(store.weights is not None for store in stores)
+	joined = ModelStore(boolNames, unifNames, max(numModels, 1), weighted)
+	if boolNames :
+		bools = numpy.hstack([store.boolMatrix()[:numModels] for store in stores])
+		joined.boolBits[:numModels] = numpy.packbits(bools.astype(numpy.uint8), axis=1)
+	if unifNames :
+		joined.unifValues[:numModels] = numpy.hstack([store.unifMatrix()[:numModels]
+		                                              for store in stores])
+	if weighted :
+		for store in stores :
+			joined.weights[:numModels] *= store.weightVector()[:numModels]
+	joined.numModels = numModels
+	return(joined)
+
+
+# Writes the models sampled for an input file as a model file named
+# exportPrefix + '.prior.models', and the models left after updating, if
+# the file had updates, as exportPrefix + '.updated.models'
+# @exportPrefix : the path and start of the file names, or None to write
+#                 nothing
+def exportModelSets(exportPrefix, priorPaths, updatedPaths=None) :
+	if exportPrefix is None :
+		return
+	priorPaths.toFile(exportPrefix + '.prior' + modelFileExtension)
+	if updatedPaths is not None :
+		updatedPaths.toFile(exportPrefix + '.updated' + modelFileExtension)
@@ -0,0 +1,380 @@
+# Long-running prior service.
+#
+# Loads knowledge bases once, keeps a solver and a pool of sampled
+# models warm for each, and answers probability queries over HTTP on
+# localhost. Requests go through a bounded queue served by one worker
+# thread, since z3 isn't thread safe; when the queue is full the service
+# answers 503 so callers can back off.
+#
+# Usage: python PriorService.py [--port 8765] [--samples 2000]
+#                               [--queue 64] [--cache DIR] [--min-models 100]
+#                               [--load name=ExampleInput1.csv ...]
+#
+#   POST /load   {"name": "monty", "file": "ExampleInput1.csv"}
+#   POST /query  {"kb": "monty", "queries": ["car1", "car1 | pick1"],
+#                 "evidence": ["reveal2"]}
+#   GET  /stats
+#
+# Every response includes the request's queue, service and total seconds.
+# When fewer than min-models of a knowledge base's models are consistent
+# with a query's evidence, more are sampled before it is answered.
+
+import argparse
+import collections
+import json
+import sys
+import threading
+import time
+
+try :
+	import Queue as queue
+	from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+	from SocketServer import ThreadingMixIn
+except ImportError :
+	import queue
+	from http.server import BaseHTTPRequestHandler, HTTPServer
+	from socketserver import ThreadingMixIn
+
+import LogicalFunctions as LF
+import QueryBatch as QB
+import StreamingInput as SI
+from ModelCache import ModelCache, KnowledgeBaseFingerprint
+from ModelStore import ModelStore
+from DecisionTrie import DecisionTrie
+from SentenceParser import SentenceParser
+
+
+# Raised for requests which can't be served, with the HTTP status to send
+class RequestError(Exception) :
+
+	def __init__(self, status, message) :
+		Exception.__init__(self, message)
+		self.status = status
+
+
+# A knowledge base loaded into the service, with its solver, parser and
+# sampled models kept between requests
+class LoadedKnowledgeBase(object) :
+
+	# @fileName   : a four-row csv or record input file
+	# @numSamples : how many models to keep sampled
+	# @cache      : optional ModelCache to reuse models from
+	# @minModels  : when fewer models than this are consistent with a
+	#               request's evidence, more models are sampled
+	# @maxSamples : the most models to grow to, by default sixteen times
+	#               numSamples
+	def __init__(self, name, fileName, numSamples, cache=None, minModels=100, maxSamples=None) :
+		self.name = name
+		self.fileName = fileName
+		self.numSamples = numSamples
+		self.minModels = minModels
+		self.maxSamples = maxSamples if maxSamples is not None else 16 * numSamples
+		self.cache = cache
+		start = time.time()
+
+		if SI.IsRecordFile(fileName) :
+			parsed = SI.ReadStreamedInput(fileName)
+			self.solver = parsed.solver
+		else :
+			parsed = LF.ReadInputFile(fileName)
+			self.solver = LF.Z3Backend()
+			self.solver.add(parsed.backgroundKnowledge)
+		self.variables = parsed.variables
+		self.knowledgeBase = parsed.backgroundKnowledge
+		self.parser = SentenceParser(self.variables)
+		if not LF.solverCheck(self.solver) :
+			raise RequestError(400, "Background knowledge not consistent")
+
+		self.fingerprint = None
+		self.metaPriors = None
+		if cache is not None :
+			self.fingerprint = KnowledgeBaseFingerprint(self.variables, self.knowledgeBase)
+			self.metaPriors = cache.metaPriors(self.fingerprint)
+		if parsed.unfixedVarNames :
+			if self.metaPriors :
+				for varName in self.metaPriors :
+					LF.setMetaPrior(self.variables, varName, self.metaPriors[varName])
+			else :
+				LF.approximateUnfixedProbabilities(self.knowledgeBase, self.variables,
+					parsed.unfixedVarNames, None, numSamples, solver = self.solver)
+				self.metaPriors = dict((varName, LF.metaPrior(self.variables, varName))
+				                       for varName in parsed.unfixedVarNames)
+
+		# Checks made while topping up are kept for the next top up
+		self.trie = DecisionTrie()
+		self.store = None
+		if cache is not None :
+			self.store = cache.load(self.fingerprint)
+		if self.store is None :
+			self.store = ModelStore.fromVariables(self.variables)
+		self.topUp()
+		self.loadSeconds = time.time() - start
+
+	# Samples until numSamples models are held, saving them to the cache
+	# if any were added
+	def topUp(self) :
+		shortfall = self.numSamples - len(self.store)
+		if shortfall <= 0 :
+			return
+		newModels = LF.DemskiPrior(self.knowledgeBase, self.variables, True, None,
+			maxSamples = shortfall, solver = self.solver, trie = self.trie)[0]
+		self.store.extend(newModels)
+		if self.cache is not None :
+			self.cache.save(self.fingerprint, self.store, self.metaPriors)
+
+	# Doubles the models held, up to maxSamples, until at least minModels
+	# of them are consistent with the evidence. Later requests with the
+	# same or similar evidence are then answered from the larger store
+	# @updatedKnowledge : a list of z3 sentences
+	def topUpForEvidence(self, updatedKnowledge) :
+		memo = {}
+		consistent = int(QB.evaluateSentences(updatedKnowledge, self.store, memo).sum())
+		while consistent < self.minModels and self.numSamples < self.maxSamples :
+			self.numSamples = min(max(2 * self.numSamples, 1), self.maxSamples)
+			numModels = len(self.store)
+			self.topUp()
+			newModels = self.store.select(slice(numModels, len(self.store)))
+			consistent += int(QB.evaluateSentences(updatedKnowledge, newModels, {}).sum())
+
+	# @queryStrings : queries as in the third row of an input file
+	# @evidence     : sentences to condition every query on
+	# @return       : a list of QueryResult dictionaries
+	def answer(self, queryStrings, evidence) :
+		queries = [LF.ParseQuery(queryString, self.variables, self.parser)
+		           for queryString in queryStrings]
+		updatedKnowledge = None
+		if evidence :
+			updatedKnowledge = [LF.ParseSentence(sentence, self.variables, self.parser)
+			                    for sentence in evidence]
+			self.solver.push()
+			self.solver.add(updatedKnowledge)
+			consistent = LF.solverCheck(self.solver)
+			self.solver.pop()
+			if not consistent :
+				raise RequestError(400, "Evidence not consistent with the knowledge base")
+			self.topUpForEvidence(updatedKnowledge)
+		results = QB.AnswerQueries(self.store, queries, updatedKnowledge)
+		return([dict(result._asdict()) for result in results])
+
+
+# Latency of the most recent requests
+class LatencyStats(object) :
+
+	def __init__(self, window=1000) :
+		self.lock = threading.Lock()
+		self.latencies = collections.deque(maxlen = window)
+		self.served = 0
+		self.rejected = 0
+		self.failed = 0
+
+	def record(self, seconds, failed=False) :
+		with self.lock :
+			self.served += 1
+			self.failed += int(failed)
+			self.latencies.append(seconds)
+
+	def reject(self) :
+		with self.lock :
+			self.rejected += 1
+
+	# @return : counts and latency percentiles as a dictionary
+	def summary(self) :
+		with self.lock :
+			latencies = sorted(self.latencies)
+			summary = {'served' : self.served, 'rejected' : self.rejected,
+			           'failed' : self.failed}
+		if latencies :
+			for name, fraction in [('p50', 0.5), ('p95', 0.95), ('p99', 0.99)] :
+				summary[name + 'Seconds'] = latencies[min(int(fraction * len(latencies)), len(latencies) - 1)]
+			summary['meanSeconds'] = sum(latencies) / len(latencies)
+		return(summary)
+
+
+# One queued request. The HTTP thread waits on done for the worker
+class pendingRequest(object) :
+
+	def __init__(self, action, body) :
+		self.action = action
+		self.body = body
+		self.enqueued = time.time()
+		self.started = None
+		self.status = 200
+		self.response = None
+		self.done = threading.Event()
+
+
+# Holds the loaded knowledge bases and serves queued requests on a single
+# worker thread
+class PriorService(object) :
+
+	# @numSamples : how many models to keep for each knowledge base
+	# @queueSize  : the most requests waiting at once before new ones are
+	#               turned away
+	# @cacheDir   : optional directory for an on-disk ModelCache
+	# @minModels  : as for LoadedKnowledgeBase
+	def __init__(self, numSamples=2000, queueSize=64, cacheDir=None, minModels=100) :
+		self.numSamples = numSamples
+		self.minModels = minModels
+		self.requests = queue.Queue(queueSize)
+		self.knowledgeBases = {}
+		self.stats = LatencyStats()
+		self.cache = None
+		if cacheDir is not None :
+			self.cache = ModelCache(cacheDir)
+		self.closed = False
+		self.worker = threading.Thread(target = self.serve)
+		self.worker.daemon = True
+		self.worker.start()
+
+	# Queues a request and waits for its answer
+	# @return : a pair of the HTTP status and the response dictionary
+	def submit(self, action, body) :
+		if self.closed :
+			return((503, {'error' : 'service is closed'}))
+		request = pendingRequest(action, body)
+		try :
+			self.requests.put_nowait(request)
+		except queue.Full :
+			self.stats.reject()
+			return((503, {'error' : 'request queue is full'}))
+		request.done.wait()
+		return((request.status, request.response))
+
+	# Stops the worker thread once the requests already queued are
+	# served. Later requests are refused with 503
+	def close(self) :
+		if self.closed :
+			return
+		self.closed = True
+		self.requests.put(None)
+		self.worker.join()
+
+	def serve(self) :
+		while True :
+			request = self.requests.get()
+			if request is None :
+				return
+			request.started = time.time()
+			try :
+				request.response = self.handle(request.action, request.body)
+			except RequestError as error :
+				request.status, request.response = error.status, {'error' : str(error)}
+			except SystemExit as error :
+				# The parsing functions exit on malformed input
+				request.status, request.response = 400, {'error' : str(error)}
+			except Exception as error :
+				request.status, request.response = 500, {'error' : repr(error)}
+			finished = time.time()
+			request.response['latency'] = {'queueSeconds' : request.started - request.enqueued,
+			                               'serviceSeconds' : finished - request.started,
+			                               'totalSeconds' : finished - request.enqueued}
+			self.stats.record(finished - request.enqueued, request.status != 200)
+			request.done.set()
+
+	# Runs one request on the worker thread
+	def handle(self, action, body) :
+		if action == 'load' :
+			if 'name' not in body or 'file' not in body :
+				raise RequestError(400, "load needs a name and a file")
+			loaded = LoadedKnowledgeBase(body['name'], body['file'],
+				body.get('numSamples', self.numSamples), self.cache,
+				body.get('minModels', self.minModels), body.get('maxSamples'))
+			self.knowledgeBases[loaded.name] = loaded
+			return({'name' : loaded.name, 'models' : len(loaded.store),
+			        'loadSeconds' : loaded.loadSeconds})
+
+		if action == 'query' :
+			if body.get('kb') not in self.knowledgeBases :
+				raise RequestError(404, "no knowledge base named " + repr(body.get('kb')))
+			loaded = self.knowledgeBases[body['kb']]
+			results = loaded.answer(body.get('queries', []), body.get('evidence', []))
+			return({'results' : results, 'models' : len(loaded.store)})
+
+		raise RequestError(404, "unknown action " + repr(action))
+
+	# @return : the service's state for GET /stats
+	def status(self) :
+		summary = self.stats.summary()
+		summary['queued'] = self.requests.qsize()
+		summary['knowledgeBases'] = dict((name, len(loaded.store))
+		                                 for name, loaded in self.knowledgeBases.items())
+		return(summary)
+
+
+class ThreadedHTTPServer(ThreadingMixIn, HTTPServer) :
+	daemon_threads = True
+
+
+def makeHandler(service) :
+
+	class PriorRequestHandler(BaseHTTPRequestHandler) :
+
+		def sendJSON(self, status, response) :
+			payload = json.dumps(response).encode('utf-8')
+			self.send_response(status)
+			self.send_header('Content-Type', 'application/json')
+			self.send_header('Content-Length', str(len(payload)))
+			if status == 503 :
+				self.send_header('Retry-After', '1')
+			self.end_headers()
+			self.wfile.write(payload)
+
+		def do_GET(self) :
+			if self.path == '/stats' :
+				self.sendJSON(200, service.status())
+			else :
+				self.sendJSON(404, {'error' : 'unknown path ' + self.path})
+
+		def do_POST(self) :
+			length = int(self.headers.get('Content-Length') or 0)
+			try :
+				body = json.loads(self.rfile.read(length) or '{}')
+			except ValueError :
+				self.sendJSON(400, {'error' : 'request body is not JSON'})
+				return
+			status, response = service.submit(self.path.strip('/'), body)
+			self.sendJSON(status, response)
+
+		def log_message(self, format, *args) :
+			pass
+
+	return(PriorRequestHandler)
+
+# Starts the HTTP server, which only listens on localhost
+# @return : the server, whose serve_forever method runs it
+def MakeServer(service, port=8765) :
+	return(ThreadedHTTPServer(('127.0.0.1', port), makeHandler(service)))
+
+
+if __name__ == '__main__' :
+	parser = argparse.ArgumentParser(description = 'Serve logical prior queries over HTTP')
+	parser.add_argument('--port', type = int, default = 8765)
+	parser.add_argument('--samples', type = int, default = 2000,
+	                    help = 'models to keep sampled for each knowledge base')
+	parser.add_argument('--queue', type = int, default = 64,
+	                    help = 'requests that may wait before new ones are refused')
+	parser.add_argument('--cache', default = None,
+	                    help = 'directory to cache sampled models in')
+	parser.add_argument('--min-models', type = int, default = 100,
+	                    help = 'sample more models when fewer than this fit the evidence')
+	parser.add_argument('--load', action = 'append', default = [],
+	                    help = 'name=file of a knowledge base to load at start')
+	args = parser.parse_args()
+
+	service = PriorService(args.samples, args.queue, args.cache, args.min_models)
+	for nameAndFile in args.load :
+		name, fileName = nameAndFile.split('=', 1)
+		status, response = service.submit('load', {'name' : name, 'file' : fileName})
+		print(name + ': ' + json.dumps(response))
+		if status != 200 :
+			service.close()
+			sys.exit(1)
+	server = MakeServer(service, args.port)
+	print('Serving on http://127.0.0.1:' + str(args.port))
+	try :
+		server.serve_forever()
+	except KeyboardInterrupt :
+		pass
+	finally :
+		server.server_close()
+		service.close()
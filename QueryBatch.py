@@ -0,0 +1,120 @@
+import collections
+import csv
+import numpy
+
+import LogicalFunctions as LF
+from VectorizedEval import EvaluateAll
+
+
+# One row of the result table. conditionCount is the number of models
+# where the query's condition holds (every model for unconditional
+# queries) and count the number where the sentence also holds.
+# probability is None when no model satisfies the condition.
+queryResult = collections.namedtuple("QueryResult", ['query',
+	'conditionCount', 'count', 'probability',
+	'updatedConditionCount', 'updatedCount', 'updatedProbability'])
+
+
+# Truth of a sentence in each stored model, checked with the solver.
+# Used for sentences which can't be vectorized.
+def solverEvaluate(sentence, store) :
+	T = LF.NewSolver([sentence], backend = 'z3')
+	holds = numpy.zeros(len(store), dtype=bool)
+	for i in range(len(store)) :
+		holds[i] = LF.solverCheck(T, assumptions = LF.modelLiterals(T, store, i))
+	return(holds)
+
+# @return : the truth of the conjunction of sentences in every model
+def evaluateSentences(sentences, store, memo) :
+	holds = EvaluateAll(sentences, store, memo)
+	if holds is None :
+		holds = numpy.ones(len(store), dtype=bool)
+		for sentence in sentences :
+			holds &= solverEvaluate(sentence, store)
+	return(holds)
+
+# @return : the count and probability of sentenceHolds among the models
+#           selected by conditionHolds
+def conditionalCount(sentenceHolds, conditionHolds) :
+	conditionCount = int(conditionHolds.sum())
+	count = int((sentenceHolds & conditionHolds).sum())
+	probability = None
+	if conditionCount :
+		probability = float(count) / conditionCount
+	return((conditionCount, count, probability))
+
+
+# Answers many queries from one set of models. The statements and
+# conditions are evaluated with a shared memo, so subexpressions common
+# to several queries are only computed once.
+# @store            : a ModelStore of consistent models
+# @queries          : a list of Query tuples from LF.ParseQuery
+# @updatedKnowledge : optional list of z3 sentences. If given, each query
+#                     is also answered among the models consistent with it
+# @return           : a list of QueryResult tuples, one per query
+def AnswerQueries(store, queries, updatedKnowledge=None) :
+	memo = {}
+	everyModel = numpy.ones(len(store), dtype=bool)
+	updatedModels = None
+	if updatedKnowledge is not None :
+		updatedModels = evaluateSentences(updatedKnowledge, store, memo)
+
+	results = []
+	for thisQuery in queries :
+		sentenceHolds = evaluateSentences([thisQuery.sentence], store, memo)
+		conditionHolds = everyModel
+		if thisQuery.condition is not None :
+			conditionHolds = evaluateSentences([thisQuery.condition], store, memo)
+
+		conditionCount, count, probability = conditionalCount(sentenceHolds, conditionHolds)
+		if updatedModels is None :
+			updatedCounts = (conditionCount, count, probability)
+		else :
+			updatedCounts = conditionalCount(sentenceHolds, conditionHolds & updatedModels)
+
+		results.append(queryResult(query = thisQuery.text,
+			conditionCount = conditionCount, count = count, probability = probability,
+			updatedConditionCount = updatedCounts[0], updatedCount = updatedCounts[1],
+			updatedProbability = updatedCounts[2]))
+	return(results)
+
+
+# Samples the prior once and answers every query against those models
+# @knowledgeBase    : a list of z3 instances corresponding to the
+#                     given axiom scheme
+# @variables        : the dictionary of variables from ParseVariables
+# @queries          : a list of Query tuples from LF.ParseQuery
+# @secondsToRun     : how long to run Demski's algorithm for
+# @updatedKnowledge : optional list of new z3 sentences to update on
+# @return           : a list of QueryResult tuples, one per query
+def SampleQueries(knowledgeBase, variables, queries, secondsToRun, updatedKnowledge=None) :
+	store = LF.DemskiPrior(knowledgeBase, variables, True, secondsToRun)[0]
+	if updatedKnowledge is not None :
+		updatedKnowledge = knowledgeBase + updatedKnowledge
+	return(AnswerQueries(store, queries, updatedKnowledge))
+
+
+# Counterpart of LF.ParseInputFile that answers every sentence of
+# interest on the third row, each of which may be conditional
+# ('A | B' or 'A given B'), from a single sampling run
+# @csvFileName  : a string specifying the variables, background knowledge
+#                 and statements of interest
+# @secondsToRun : how many seconds to run Demski's algorithm for
+# @return       : a list of QueryResult tuples, one per query
+def QueryInputFile(csvFileName, secondsToRun) :
+	parsed = LF.ReadInputFile(csvFileName)
+	variables = parsed.variables
+	if parsed.unfixedVarNames :
+		variables = LF.approximateUnfixedProbabilities(parsed.backgroundKnowledge,
+			variables, parsed.unfixedVarNames, secondsToRun/2.0)
+	return(SampleQueries(parsed.backgroundKnowledge, variables, parsed.queries,
+		secondsToRun, parsed.updatedKnowledgeSentences))
+
+
+# Writes a result table as csv, one row per query
+def WriteQueryTable(results, csvFileName) :
+	with open(csvFileName, 'wb') as outputFile :
+		resWriter = csv.writer(outputFile, delimiter=',')
+		resWriter.writerow(queryResult._fields)
+		for result in results :
+			resWriter.writerow(list(result))
@@ -0,0 +1,18 @@
+import hashlib
+import os
+import random
+
+
+# A random generator for one of many independent sampling streams. The
+# generator is seeded with a hash of the base seed and the stream's path,
+# so stream (seed, 3) draws the same numbers however many other streams
+# are in use, and different streams get unrelated seeds.
+# @seed       : the base seed, or None to seed from the operating system
+# @streamPath : integers or strings identifying the stream, e.g. a
+#               worker index, or a round and a worker index
+# @return     : a random.Random
+def RandomStream(seed, *streamPath) :
+	if seed is None :
+		return(random.Random(os.urandom(16)))
+	digest = hashlib.sha256(repr((seed,) + streamPath).encode('utf-8')).hexdigest()
+	return(random.Random(int(digest, 16)))
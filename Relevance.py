@@ -0,0 +1,117 @@
+from LazyZ3 import z3, IsExpression
+
+
+# @sentence : a z3 sentence, or a node id of parser
+# @parser   : optional SentenceParser whose node the sentence is
+# @return   : the names of the variables occurring in the sentence. Each
+#             shared subterm is only visited once
+def SentenceVariables(sentence, parser=None) :
+	names = set()
+	if parser is not None and not isinstance(sentence, bool) :
+		return(NodeVariables(parser, sentence))
+	if not IsExpression(sentence) :
+		return(names)
+	seen = set()
+	stack = [sentence]
+	while stack :
+		term = stack.pop()
+		termId = term.get_id()
+		if termId in seen :
+			continue
+		seen.add(termId)
+		if z3.is_const(term) :
+			if term.decl().kind() == z3.Z3_OP_UNINTERPRETED :
+				names.add(term.decl().name())
+		else :
+			stack.extend(term.children())
+	return(names)
+
+
+# @return : the names of the variables occurring in a parser node
+def NodeVariables(parser, nodeId) :
+	names = set()
+	seen = set()
+	stack = [nodeId]
+	while stack :
+		nodeId = stack.pop()
+		if nodeId in seen :
+			continue
+		seen.add(nodeId)
+		key = parser.keys[nodeId]
+		if key[0] == 'var' :
+			names.add(key[1])
+		elif key[0] not in ['int', 'const'] :
+			stack.extend(key[1:])
+	return(names)
+
+
+# Which variables occur in which sentences of a knowledge base, built
+# once. Variables sharing a sentence are joined in a union-find, so the
+# variables that can influence a sentence are those in the components it
+# touches, found without rescanning the knowledge base.
+class IncidenceIndex(object) :
+
+	# @knowledgeBase : a list of z3 sentences
+	def __init__(self, knowledgeBase) :
+		self.knowledgeBase = list(knowledgeBase)
+		self.sentenceVars = [SentenceVariables(sentence) for sentence in self.knowledgeBase]
+		self.parent = {}
+		for varNames in self.sentenceVars :
+			first = None
+			for varName in varNames :
+				self.parent.setdefault(varName, varName)
+				if first is None :
+					first = varName
+				else :
+					self.union(first, varName)
+
+	# @return : the representative of a variable's component
+	def find(self, varName) :
+		parent = self.parent.get(varName, varName)
+		while parent != varName :
+			grandparent = self.parent[parent]
+			self.parent[varName] = grandparent
+			varName, parent = parent, grandparent
+		return(varName)
+
+	def union(self, first, second) :
+		firstRoot = self.find(first)
+		secondRoot = self.find(second)
+		if firstRoot != secondRoot :
+			self.parent[secondRoot] = firstRoot
+
+	# @sentences : z3 sentences, e.g. the sentence of interest and any
+	#              sentences to be updated on
+	# @return    : the names of every variable connected to them
+	def relevantVariables(self, sentences) :
+		varNames = set()
+		for sentence in sentences :
+			varNames |= SentenceVariables(sentence)
+		roots = set(self.find(varName) for varName in varNames)
+		for varName in self.parent :
+			if self.find(varName) in roots :
+				varNames.add(varName)
+		return(varNames)
+
+	# @return : the knowledge base sentences mentioning any of the
+	#           variables, in their original order
+	def relevantSentences(self, varNames) :
+		return([sentence for sentence, sentenceVars in zip(self.knowledgeBase, self.sentenceVars)
+		        if sentenceVars & varNames])
+
+	# Splits variables into independent groups. Variables which occur in
+	# no sentence are gathered into a single group, since nothing
+	# constrains them
+	# @return : a list of lists of variable names
+	def components(self, varNames) :
+		groups = {}
+		free = []
+		for varName in sorted(varNames) :
+			if varName in self.parent :
+				groups.setdefault(self.find(varName), []).append(varName)
+			else :
+				free.append(varName)
+		components = list(groups.values())
+		if free :
+			components.append(free)
+		return(components)
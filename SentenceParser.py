@@ -0,0 +1,304 @@
+import re
+import sys
+
+# z3 is only imported once an expression is first built, so that
+# parsing for the pure boolean engine (see BooleanPrior.py) never loads it
+z3 = None
+builders = None
+
+
+# Words for each operator of the sentence language
+notWords     = frozenset(["not", "Not"])
+binaryWords  = {"implies" : 'implies', "Implies" : 'implies', "->" : 'implies',
+                "and" : 'and', "And" : 'and', "&" : 'and',
+                "or" : 'or', "Or" : 'or', "||" : 'or',
+                "Xor" : 'xor', "xor" : 'xor',
+                "=" : 'eq', "==" : 'eq', "iff" : 'eq',
+                "!=" : 'ne', "<>" : 'ne', "=/=" : 'ne',
+                ">" : 'gt', "<" : 'lt', ">=" : 'ge', "<=" : 'le',
+                "+" : 'add'}
+
+# Precedence of each operator. Every logical and comparison operator
+# shares one level and groups to the right, so 'a and b or c' is
+# 'a and (b or c)'; '+' binds tighter and groups to the left. 'not'
+# has the lowest level, so it applies to the rest of its parenthesised
+# group.
+precedence = {'not' : 0, 'implies' : 1, 'and' : 1, 'or' : 1, 'xor' : 1,
+              'eq' : 1, 'ne' : 1, 'gt' : 1, 'lt' : 1, 'ge' : 1, 'le' : 1,
+              'add' : 2}
+leftAssociative = frozenset(['add'])
+
+# Connectives between boolean operands are built with the z3 C API
+# directly; the z3py wrappers spend most of their time re-checking and
+# coercing the sorts of their arguments
+def connective(mkFunction, fallback) :
+	def build(a, b) :
+		if isinstance(a, z3.BoolRef) and isinstance(b, z3.BoolRef) :
+			return(z3.BoolRef(mkFunction(a.ctx_ref(), a.as_ast(), b.as_ast()), a.ctx))
+		return(fallback(a, b))
+	return(build)
+
+def mkAnd(ctx, a, b) :
+	args = (z3.Ast * 2)(a, b)
+	return(z3.Z3_mk_and(ctx, 2, args))
+
+def mkOr(ctx, a, b) :
+	args = (z3.Ast * 2)(a, b)
+	return(z3.Z3_mk_or(ctx, 2, args))
+
+def mkDistinct(ctx, a, b) :
+	args = (z3.Ast * 2)(a, b)
+	return(z3.Z3_mk_distinct(ctx, 2, args))
+
+def mkNot(a) :
+	if isinstance(a, z3.BoolRef) :
+		return(z3.BoolRef(z3.Z3_mk_not(a.ctx_ref(), a.as_ast()), a.ctx))
+	return(z3.Not(a))
+
+# Imports z3 and fills in how to build the z3 expression for each
+# operator, the first time it is needed
+def loadBuilders() :
+	global z3, builders
+	if builders is not None :
+		return(builders)
+	import z3
+	builders = {'not'     : mkNot,
+	            'implies' : connective(z3.Z3_mk_implies, lambda a, b : z3.Implies(a, b)),
+	            'and'     : connective(mkAnd, lambda a, b : z3.And(a, b)),
+	            'or'      : connective(mkOr, lambda a, b : z3.Or(a, b)),
+	            'xor'     : connective(z3.Z3_mk_xor, lambda a, b : z3.Xor(a, b)),
+	            'eq'      : connective(z3.Z3_mk_eq, lambda a, b : a == b),
+	            'ne'      : connective(mkDistinct, lambda a, b : a != b),
+	            'gt'      : lambda a, b : a > b,
+	            'lt'      : lambda a, b : a < b,
+	            'ge'      : lambda a, b : a >= b,
+	            'le'      : lambda a, b : a <= b,
+	            'add'     : lambda a, b : a + b}
+	return(builders)
+
+tokenPattern   = re.compile(r'[()]|[^\s()]+')
+integerPattern = re.compile(r'^[+-]?\d+$')
+
+# Splits a sentence into words, parentheses always being words of their own
+# @return : a list of strings
+def Tokenize(sentence) :
+	return(tokenPattern.findall(sentence))
+
+
+# Parses variable declarations, as in the first row of an input file,
+# without building their z3 variables
+# @variableNames : a list of declaration strings
+# @return        : a dictionary from variable names to lists of None (in
+#                  place of the z3 variable), the type, and then the
+#                  probability for bool variables or the bounds and value
+#                  weights for unif variables, and whether it is unfixed
+def ParseDeclarations(variableNames) :
+	variables = {}
+	reservedNames = ['not', 'and', 'or', 'implies', 'xor', '=', '==',
+					 'bool', 'Bool', 'boolean', 'Boolean',
+					 'Unif', 'unif', 'uniform', 'Uniform',
+					 'unfixed', 'Unfixed', 'given']
+	for variableString in variableNames :
+		varDeclaration = variableString.split()
+		varType = "EMPTY"
+
+		# Whether or not the variable's probability is already fixed
+		isUnfixed = False
+		if varDeclaration[0] in ['unfixed', 'Unfixed'] :
+			isUnfixed = True
+			varDeclaration.pop(0)
+
+		# Either assign the default probability (.5) or that specified
+		# defaults bool cases
+		isBool = False
+		if len(varDeclaration) == 1 :
+			probability = .5
+			variableName = varDeclaration[0]
+			isBool = True
+		elif len(varDeclaration) == 2 :
+			probability = float(varDeclaration[1])
+			variableName = varDeclaration[0]
+			isBool = True
+
+		# Explicit bool parsing cases
+		if varDeclaration[0] in ['bool', 'Bool', 'boolean', 'Boolean'] :
+			if len(varDeclaration) == 1 :
+				sys.exit("insufficient arguments when declaring " + varDeclaration[0])
+			if len(varDeclaration) == 2 :
+				probability = .5
+				variableName = varDeclaration[1]
+			elif len(varDeclaration) == 3 :
+				probability = float(varDeclaration[2])
+				variableName = varDeclaration[1]
+			isBool = True
+
+		if isBool :
+			argList = [probability, isUnfixed]
+			varType = 'bool'
+
+		# Integer variable parsing cases
+		if varDeclaration[0] in ['Unif', 'unif', 'uniform', 'Uniform'] :
+			if len(varDeclaration) != 4 :
+				sys.exit("""uniform variables are declared with the following form:
+					        unif VarName 0 10
+					        this error occurred when parsing""" + variableString)
+
+			variableName = varDeclaration[1]
+			lowerBound   = int(varDeclaration[2])
+			upperBound   = int(varDeclaration[3])
+			# No value weights means every value is equally likely
+			argList      = [lowerBound, upperBound, None, isUnfixed]
+			varType      = 'unif'
+
+
+		if varType == "EMPTY" :
+			print("Error in parsing variable names")
+			sys.exit("<" + variableString + "> is neither uniform nor boolean")
+		if variableName.lower() in reservedNames :
+			print("Error in parsing variable names")
+			sys.exit(variableName + " is a reserved name")
+			return()
+		key = variableName
+		variables[variableName] = [None, varType] + argList
+
+	return(variables)
+
+
+def parseError(word, sentence) :
+	print("Error parsing background knowledge: " + sentence)
+	sys.exit(word)
+
+
+# Parses sentences over one set of variables. Each distinct
+# subexpression is interned as a node once and shared by every sentence
+# parsed with the same parser, so a generated knowledge base that
+# repeats the same clauses costs little more to load than one that
+# doesn't. Nodes are numbered in the order they are first seen, so a
+# node's children always have smaller ids than it.
+class SentenceParser(object) :
+
+	# @variables : the dictionary of variables from ParseVariables, or
+	#              from ParseDeclarations when no z3 expressions are built
+	def __init__(self, variables) :
+		self.variables = variables
+		# Node key to node id. Keys are ('var', name), ('int', value),
+		# ('not', id) or (operator, id, id), and ('const', True or False)
+		# for the constants of sentences interned from z3
+		self.nodeIds = {}
+		self.keys = []
+		# The z3 expression of each node, or None until it is built
+		self.expressions = []
+
+	# @return : the id of the interned node
+	def intern(self, key) :
+		nodeId = self.nodeIds.get(key)
+		if nodeId is None :
+			nodeId = len(self.keys)
+			self.keys.append(key)
+			self.expressions.append(None)
+			self.nodeIds[key] = nodeId
+		return(nodeId)
+
+	# @return : the z3 expression of a node, building it and any of its
+	#           descendants not yet built
+	def expression(self, nodeId) :
+		if self.expressions[nodeId] is not None :
+			return(self.expressions[nodeId])
+		operatorBuilders = loadBuilders()
+		stack = [nodeId]
+		while stack :
+			top = stack[-1]
+			key = self.keys[top]
+			if key[0] == 'var' :
+				self.expressions[top] = self.variable(key[1])
+			elif key[0] == 'int' :
+				self.expressions[top] = key[1]
+			elif key[0] == 'const' :
+				self.expressions[top] = z3.BoolVal(key[1])
+			else :
+				unbuilt = [child for child in key[1:] if self.expressions[child] is None]
+				if unbuilt :
+					stack.extend(unbuilt)
+					continue
+				self.expressions[top] = operatorBuilders[key[0]](*[self.expressions[child]
+				                                                   for child in key[1:]])
+			stack.pop()
+		return(self.expressions[nodeId])
+
+	# @return : the z3 variable of a name. Variables from ParseDeclarations
+	#           have none, so it is made from the name and declared type
+	def variable(self, varName) :
+		variableList = self.variables[varName]
+		if variableList[0] is None :
+			if variableList[1] == 'bool' :
+				return(z3.Bool(varName))
+			return(z3.Int(varName))
+		return(variableList[0])
+
+	# Applies the operator on top of the stack to the operands below it
+	def reduce(self, operators, operands) :
+		operator = operators.pop()
+		if operator == 'not' :
+			operands.append(self.intern(('not', operands.pop())))
+		else :
+			right = operands.pop()
+			left = operands.pop()
+			operands.append(self.intern((operator, left, right)))
+
+	# @sentence : the sentence as written in the input
+	# @return   : the z3 expression of the sentence
+	def parse(self, sentence) :
+		return(self.expression(self.parseNode(sentence)))
+
+	# Parses one sentence with an operator-precedence (shunting-yard)
+	# parser, which runs in time linear in its length and without
+	# recursion however deeply it is nested
+	# @sentence : the sentence as written in the input
+	# @return   : the id of the sentence's node
+	def parseNode(self, sentence) :
+		operators = []
+		operands = []
+		expectOperand = True
+
+		for word in Tokenize(sentence) :
+			if expectOperand :
+				if word in self.variables :
+					operands.append(self.intern(('var', word)))
+					expectOperand = False
+				elif word in notWords :
+					operators.append('not')
+				elif word == '(' :
+					operators.append('(')
+				elif integerPattern.match(word) :
+					operands.append(self.intern(('int', int(word))))
+					expectOperand = False
+				else :
+					parseError(word + " is neither variable nor operand", sentence)
+
+			elif word == ')' :
+				while operators and operators[-1] != '(' :
+					self.reduce(operators, operands)
+				if not operators :
+					parseError("unmatched )", sentence)
+				operators.pop()
+
+			elif word in binaryWords :
+				operator = binaryWords[word]
+				level = precedence[operator]
+				while operators and operators[-1] != '(' and \
+				      (precedence[operators[-1]] > level or
+				       (precedence[operators[-1]] == level and operator in leftAssociative)) :
+					self.reduce(operators, operands)
+				operators.append(operator)
+				expectOperand = True
+
+			else :
+				parseError(word + " is neither variable nor operator", sentence)
+
+		if expectOperand :
+			parseError("sentence ends without an operand", sentence)
+		while operators :
+			if operators[-1] == '(' :
+				parseError("unmatched (", sentence)
+			self.reduce(operators, operands)
+		return(operands[0])
@@ -0,0 +1,295 @@
+from LazyZ3 import z3, IsExpression
+import sys
+
+from BooleanSat import ClauseEncoder, ExpressionNode, NotBoolean, SatSolver
+from SentenceParser import SentenceParser
+
+
+# The prior's algorithms talk to their solver through a small interface.
+# literal(varName, value) gives an opaque literal for the choice of a
+# value for a variable, and sentence(sentence) one for a whole sentence,
+# given as a z3 sentence or as a node id of the backend's parser. add
+# asserts literals in the current scope, push and pop open and close
+# scopes, check(*assumptions) says whether the assertions and the assumed
+# literals are satisfiable, and value(varName) reads a variable's value
+# in the model the last satisfiable check found. Z3Backend answers these
+# calls with a z3 Solver. SatBackend answers them with the pure Python
+# SatSolver of BooleanSat.py over the clauses ClauseEncoder writes, which
+# for purely boolean knowledge bases avoids z3's per-call overhead on
+# every check, and never loads z3 when its sentences are parser nodes.
+
+# The most variables for which SatBackend is chosen by default. Each of
+# its checks extends the choices to a whole model in Python, so beyond a
+# hundred or so variables z3's checks are quicker despite their overhead
+satVariableLimit = 100
+
+# @return : 'sat' if every variable is boolean and there are at most
+#           satVariableLimit of them, otherwise 'z3'
+def ChooseBackend(variables) :
+	if len(variables) <= satVariableLimit and \
+	   all(variables[varName][1] == 'bool' for varName in variables) :
+		return('sat')
+	return('z3')
+
+# @knowledgeBase : sentences to assert in the new solver, z3 sentences or
+#                  node ids of parser
+# @variables     : the dictionary of variables from ParseVariables, used
+#                  to choose the backend if it isn't given
+# @backend       : 'z3' or 'sat'. 'sat' falls back on z3 if some
+#                  variable isn't boolean or a sentence can't be written
+#                  as clauses
+# @parser        : optional SentenceParser whose node ids the sentences
+#                  are
+# @return        : a solver of the chosen backend asserting the knowledge
+#                  base
+def NewSolver(knowledgeBase, variables=None, backend=None, parser=None) :
+	if backend is None :
+		backend = ChooseBackend(variables)
+	if backend not in ['z3', 'sat'] :
+		sys.exit("Unknown solver backend " + str(backend))
+	if backend == 'sat' and (variables is None or
+	                         all(variables[varName][1] == 'bool' for varName in variables)) :
+		try :
+			T = SatBackend(parser, variables)
+			T.add([T.sentence(sentence) for sentence in knowledgeBase])
+			return(T)
+		except NotBoolean :
+			pass
+	T = Z3Backend(parser)
+	T.add([T.sentence(sentence) for sentence in knowledgeBase])
+	return(T)
+
+
+# The backend interface on a z3 Solver. Literals are z3 sentences, so z3
+# sentences can also be added and assumed as they are.
+class Z3Backend(object) :
+
+	# @parser : optional SentenceParser whose node ids may be given to
+	#           sentence
+	def __init__(self, parser=None) :
+		self.solver = z3.Solver()
+		self.parser = parser
+		# The sentence of each choice, by (variable name, value)
+		self.literals = {}
+		self.lastModel = None
+
+	# @value  : True or False for a bool variable, an integer for a unif
+	# @return : the z3 sentence varName == value, built once per choice
+	def literal(self, varName, value) :
+		key = (varName, value)
+		literal = self.literals.get(key)
+		if literal is None :
+			if value is True :
+				literal = z3.Bool(varName)
+			elif value is False :
+				literal = z3.Not(z3.Bool(varName))
+			else :
+				literal = z3.Int(varName) == value
+			self.literals[key] = literal
+		return(literal)
+
+	def negation(self, literal) :
+		return(z3.Not(literal))
+
+	# @return : literals keeping a unif variable within lower..upper
+	def bounds(self, varName, lower, upper) :
+		return([z3.Int(varName) >= lower, z3.Int(varName) <= upper])
+
+	# @sentence : a z3 sentence, a python bool or a node id of the parser
+	# @return   : the sentence as a literal
+	def sentence(self, sentence) :
+		if sentence is True or sentence is False :
+			return(z3.BoolVal(sentence))
+		if IsExpression(sentence) :
+			return(sentence)
+		return(self.parser.expression(sentence))
+
+	# Asserts literals, or lists of them, in the current scope
+	def add(self, *literals) :
+		for literal in literals :
+			if isinstance(literal, (list, tuple)) :
+				self.add(*literal)
+			else :
+				self.solver.add(literal)
+
+	def push(self) :
+		self.solver.push()
+
+	def pop(self, num=1) :
+		if num > 0 :
+			self.solver.pop(num)
+
+	def num_scopes(self) :
+		return(self.solver.num_scopes())
+
+	# @assumptions : literals assumed for this check only
+	# @return      : True if satisfiable
+	def check(self, *assumptions) :
+		self.lastModel = None
+		return(self.solver.check(*assumptions) == z3.sat)
+
+	# @return : the value of a variable, True or False or an integer, in
+	#           the model found by the last check, or None if the model
+	#           doesn't mention it
+	def value(self, varName) :
+		if self.lastModel is None :
+			self.lastModel = self.solver.model()
+		for constant in [z3.Bool(varName), z3.Int(varName)] :
+			value = self.lastModel.eval(constant)
+			if z3.is_true(value) or z3.is_false(value) :
+				return(z3.is_true(value))
+			if z3.is_int_value(value) :
+				return(value.as_long())
+		return(None)
+
+	# Forgets every assertion
+	def reset(self) :
+		self.solver.reset()
+		self.lastModel = None
+
+
+# The backend interface on the pure Python SatSolver, for boolean
+# sentences. Literals are signed SatSolver variables, and each sentence
+# is written as the literal of its ClauseEncoder node, whose defining
+# clauses are added for good since they only constrain the new
+# variables. A literal added outside any scope becomes a unit clause;
+# inside a scope it is kept as an assumption of every check until the
+# scope is popped, so push and pop never add or remove clauses and what
+# the solver learns stays valid. The sampler's scopes only ever grow one
+# partial assignment, which SatSolver keeps between checks, and a check
+# whose assumptions all hold in the last model found is answered from
+# that model without searching.
+class SatBackend(object) :
+
+	# @parser    : optional SentenceParser whose node ids may be given to
+	#              sentence. z3 sentences are interned into it as nodes
+	# @variables : optional dictionary of the variables, which must all
+	#              be boolean. Variables met in z3 sentences are numbered
+	#              as they are met
+	def __init__(self, parser=None, variables=None) :
+		if variables is None :
+			variables = {}
+		if parser is None :
+			parser = SentenceParser(variables)
+		self.parser = parser
+		self.encoder = ClauseEncoder(parser, sorted(variables.keys()))
+		self.solver = SatSolver()
+		self.added = 0
+		# Literals asserted in the open scopes, and how many were asserted
+		# before each scope was pushed
+		self.assumed = []
+		self.scopes = []
+		# Values of the last model found, and how many of the assumed
+		# literals are known to hold in it
+		self.lastModel = None
+		self.agreeing = 0
+
+	# @value  : True or False
+	# @return : the literal of the variable taking the value
+	def literal(self, varName, value) :
+		if value is not True and value is not False :
+			raise NotBoolean(varName + " is not boolean")
+		variable = self.encoder.variable(varName)
+		return(variable if value else -variable)
+
+	def negation(self, literal) :
+		return(-literal)
+
+	def bounds(self, varName, lower, upper) :
+		raise NotBoolean(varName + " is not boolean")
+
+	# @sentence : a node id of the parser, a z3 sentence or a python bool
+	# @return   : the literal equivalent to the sentence, defining it and
+	#             any of its subterms not yet encoded
+	def sentence(self, sentence) :
+		if isinstance(sentence, bool) or IsExpression(sentence) :
+			varNames = set()
+			sentence = ExpressionNode(self.parser, sentence, varNames)
+			for varName in varNames :
+				self.encoder.variable(varName)
+		return(self.encoder.literal(sentence))
+
+	# @return : a literal, writing a z3 sentence as one
+	def asLiteral(self, literal) :
+		if isinstance(literal, bool) or not isinstance(literal, (int, long)) :
+			return(self.sentence(literal))
+		return(literal)
+
+	# Gives the solver the variables and definitions added since last time
+	def flush(self) :
+		if self.encoder.numVars > self.solver.numVars :
+			self.solver.addVariables(self.encoder.numVars - self.solver.numVars)
+		for clause in self.encoder.clauses[self.added:] :
+			self.solver.addClause(clause)
+		self.added = len(self.encoder.clauses)
+
+	# Asserts literals, or lists of them, in the current scope. z3
+	# sentences are written as literals first
+	def add(self, *literals) :
+		for literal in literals :
+			if isinstance(literal, (list, tuple)) :
+				self.add(*literal)
+				continue
+			literal = self.asLiteral(literal)
+			self.flush()
+			if self.scopes :
+				self.assumed.append(literal)
+			else :
+				self.solver.addClause([literal])
+				self.lastModel = None
+
+	def push(self) :
+		self.scopes.append(len(self.assumed))
+
+	def pop(self, num=1) :
+		if num <= 0 :
+			return
+		del self.assumed[self.scopes[-num]:]
+		del self.scopes[-num:]
+		self.agreeing = min(self.agreeing, len(self.assumed))
+
+	def num_scopes(self) :
+		return(len(self.scopes))
+
+	# @assumptions : literals assumed for this check only
+	# @return      : True if satisfiable
+	def check(self, *assumptions) :
+		literals = [self.asLiteral(literal) for literal in assumptions]
+		self.flush()
+		if self.lastModel is not None and self.holds(self.assumed[self.agreeing:]) :
+			self.agreeing = len(self.assumed)
+			if self.holds(literals) :
+				return(True)
+		if self.solver.solve(self.assumed + literals) :
+			self.lastModel = list(self.solver.values)
+			self.agreeing = len(self.assumed)
+			return(True)
+		return(False)
+
+	# @return : true if every literal is true in the last model. Variables
+	#           defined since it was found have no value in it
+	def holds(self, literals) :
+		for literal in literals :
+			variable = abs(literal)
+			if variable >= len(self.lastModel) or self.lastModel[variable] != (literal > 0) :
+				return(False)
+		return(True)
+
+	# @return : the value of a variable in the model found by the last
+	#           check, which must have been satisfiable. Variables the
+	#           solver has never seen are false
+	def value(self, varName) :
+		variable = self.encoder.varIndex.get(varName)
+		if variable is None or variable >= len(self.lastModel) :
+			return(False)
+		return(self.lastModel[variable] is True)
+
+	# Forgets every assertion. The definitions are kept, as they only
+	# constrain their own variables
+	def reset(self) :
+		self.solver = SatSolver(self.encoder.numVars, self.encoder.clauses)
+		self.added = len(self.encoder.clauses)
+		self.assumed = []
+		self.scopes = []
+		self.lastModel = None
+		self.agreeing = 0
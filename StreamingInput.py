@@ -0,0 +1,251 @@
+import collections
+import csv
+import json
+import sys
+import time
+
+import LogicalFunctions as LF
+from Instrumentation import noStats
+from SentenceParser import SentenceParser
+
+
+# Record input format
+#
+# Instead of the four rows of the csv format, a knowledge base can be
+# given as one record per line, each naming its kind and its text:
+#
+#   variable  : a variable declaration, as in the first csv row
+#   knowledge : a background knowledge sentence
+#   query     : a sentence of interest, optionally conditional
+#   update    : a sentence to update on after sampling
+#
+# Either as JSON lines, {"record": "knowledge", "text": "a implies b"},
+# or as a csv file whose header is 'record,text'. Variables must be
+# declared before the sentences which use them. Records are parsed and
+# asserted one at a time, so the raw file is never held in memory.
+
+recordKinds = ['variable', 'knowledge', 'query', 'update']
+
+# How many interned subexpressions a parser keeps before starting afresh
+internLimit = 100000
+
+# @return : true if the file is in the record format rather than the
+#           four-row csv format
+def IsRecordFile(fileName) :
+	if fileName.endswith('.jsonl') :
+		return(True)
+	with open(fileName, 'rb') as recordFile :
+		header = next(csv.reader(recordFile), [])
+	return([field.strip() for field in header] == ['record', 'text'])
+
+# Reads a record file lazily
+# @return : a generator of (line number, kind, text) triples
+def ReadRecords(fileName) :
+	with open(fileName, 'rb') as recordFile :
+		if fileName.endswith('.jsonl') :
+			for lineNumber, line in enumerate(recordFile, 1) :
+				if line.strip() == '' :
+					continue
+				record = json.loads(line)
+				yield((lineNumber, record['record'], record['text']))
+		else :
+			rows = csv.reader(recordFile)
+			next(rows)
+			for lineNumber, row in enumerate(rows, 2) :
+				if not row :
+					continue
+				yield((lineNumber, row[0].strip(), ','.join(row[1:])))
+
+
+# Parse throughput of a streamed input
+streamReport = collections.namedtuple("StreamReport", ['records', 'sentences',
+	'seconds', 'parseSeconds', 'assertSeconds', 'recordsPerSecond', 'sentencesPerSecond'])
+
+# The parsed contents of a record file. solver asserts the background
+# knowledge, including the range of each unif variable.
+# backgroundKnowledge is None unless the sentences were kept.
+streamedInput = collections.namedtuple("StreamedInput", ['variables', 'unfixedVarNames',
+	'solver', 'backgroundKnowledge', 'numSentences', 'statementOfInterest', 'queries',
+	'updatedKnowledgeSentences', 'report'])
+
+# Parses a record file, asserting each knowledge sentence as it is read
+# @fileName      : a .jsonl or record csv file
+# @keepSentences : if true the parsed knowledge base is also returned as
+#                  a list, as needed for unit propagation and fingerprints.
+#                  Otherwise only the solver holds it
+# @return        : a StreamedInput tuple
+def ReadStreamedInput(fileName, keepSentences=True) :
+	start = time.time()
+	parseSeconds = 0.0
+	assertSeconds = 0.0
+	variables = {}
+	parser = SentenceParser(variables)
+	solver = LF.Z3Backend()
+	backgroundKnowledge = [] if keepSentences else None
+	queries = []
+	updatedKnowledgeSentences = None
+	numRecords = 0
+	numSentences = 0
+
+	for lineNumber, kind, text in ReadRecords(fileName) :
+		numRecords += 1
+		if text.strip() == '' :
+			continue
+		if kind not in recordKinds :
+			sys.exit("Unknown record kind <" + kind + "> on line " + str(lineNumber))
+
+		parseStart = time.time()
+		if kind == 'variable' :
+			declared = LF.ParseVariables([text])
+			for varName in declared :
+				if varName in variables :
+					sys.exit(varName + " is declared twice, on line " + str(lineNumber))
+			variables.update(declared)
+			parseSeconds += time.time() - parseStart
+
+			# Bound uniform variables as soon as they are declared
+			for varName in declared :
+				variableList = declared[varName]
+				if variableList[1] == 'unif' :
+					solver.add(variableList[0] > variableList[2]-1)
+					solver.add(variableList[0] < variableList[3]+1)
+			continue
+
+		# Forget shared subexpressions once there are many of them
+		if len(parser.expressions) > internLimit :
+			parser = SentenceParser(variables)
+		numSentences += 1
+
+		if kind == 'query' :
+			queries.append(LF.ParseQuery(text, variables, parser))
+			parseSeconds += time.time() - parseStart
+			continue
+
+		sentence = LF.ParseSentence(text, variables, parser)
+		parseSeconds += time.time() - parseStart
+		if kind == 'knowledge' :
+			assertStart = time.time()
+			solver.add(sentence)
+			assertSeconds += time.time() - assertStart
+			if keepSentences :
+				backgroundKnowledge.append(sentence)
+		else :
+			if updatedKnowledgeSentences is None :
+				updatedKnowledgeSentences = []
+			updatedKnowledgeSentences.append(sentence)
+
+	if not queries :
+		sys.exit(fileName + " has no query record")
+
+	if keepSentences :
+		for varName in variables.keys() :
+			variableList = variables[varName]
+			if variableList[1] == 'unif' :
+				backgroundKnowledge.append(variableList[0] > variableList[2]-1)
+				backgroundKnowledge.append(variableList[0] < variableList[3]+1)
+
+	unfixedVarNames = [varName for varName in variables.keys() if variables[varName][-1]]
+	seconds = time.time() - start
+	report = streamReport(records = numRecords, sentences = numSentences,
+		seconds = seconds, parseSeconds = parseSeconds, assertSeconds = assertSeconds,
+		recordsPerSecond = numRecords / max(seconds, 1e-9),
+		sentencesPerSecond = numSentences / max(seconds, 1e-9))
+
+	return(streamedInput(variables = variables, unfixedVarNames = unfixedVarNames,
+		solver = solver, backgroundKnowledge = backgroundKnowledge,
+		numSentences = numSentences, statementOfInterest = queries[0].sentence,
+		queries = queries, updatedKnowledgeSentences = updatedKnowledgeSentences,
+		report = report))
+
+
+# Counterpart of LF.ParseInputFile which also reads record files. Files
+# in the four-row csv format are passed on to LF.ParseInputFile.
+# @fileName      : a record file or four-row csv file
+# @secondsToRun  : how many seconds to run Demski's algorithm for
+# @numSamples    : optional number of models to stop sampling at
+# @keepSentences : as for ReadStreamedInput. By default the sentences are
+#                  kept, so memory grows with the knowledge base, and
+#                  the file is sampled as LF.SampleParsedInput samples a
+#                  four-row file, with pruning, propagation and the
+#                  backend choice. If false memory stays bounded by what
+#                  the streaming solver itself holds, but every variable
+#                  is sampled, on that z3 solver, without propagation
+# @exportPrefix  : as for LF.ParseInputFile
+# @numWorkers    : as for LF.ParseInputFile. The workers build their own
+#                  solvers, so the sentences must be kept
+# @samplerOptions : further keyword arguments for DemskiPrior. A
+#                  SolverStats given as stats also records how many
+#                  sentences per second were parsed
+# @return        : the same tuple as LF.ParseInputFile
+def StreamInputFile(fileName, secondsToRun, numSamples=None, keepSentences=True,
+                    exportPrefix=None, numWorkers=None, **samplerOptions) :
+	if not IsRecordFile(fileName) :
+		return(LF.ParseInputFile(fileName, secondsToRun, numSamples,
+			exportPrefix = exportPrefix, numWorkers = numWorkers, **samplerOptions))
+	if numWorkers is not None and numWorkers > 1 and not keepSentences :
+		sys.exit("Parallel meta-prior rounds need the knowledge base sentences kept")
+
+	stats = samplerOptions.get('stats', noStats)
+	with stats.phase('parse') :
+		parsed = ReadStreamedInput(fileName, keepSentences)
+	stats.recordParse(parsed.report.records, parsed.report.sentences, parsed.report.seconds)
+	if keepSentences :
+		return(LF.SampleParsedInput(parsed, secondsToRun, numSamples,
+			exportPrefix = exportPrefix, numWorkers = numWorkers, **samplerOptions))
+
+	# Only the streaming solver holds the knowledge base
+	samplerOptions.setdefault('propagate', False)
+	variables = parsed.variables
+	if parsed.unfixedVarNames :
+		variables = LF.approximateUnfixedProbabilities([], variables,
+			parsed.unfixedVarNames, stats = stats, solver = parsed.solver,
+			rng = samplerOptions.get('rng', LF.randomModule),
+			**LF.metaPriorBudget(secondsToRun, numSamples, samplerOptions))
+
+	consistentPaths, initialSOICount, trueVarNames = LF.DemskiPrior([], variables,
+		parsed.statementOfInterest, secondsToRun, numSamples, solver = parsed.solver,
+		**samplerOptions)
+	numInitialModels = len(consistentPaths)
+
+	# Every model already satisfies the background knowledge, so only
+	# the new sentences need checking, once they are known to be
+	# consistent with it
+	updatedSOICount = initialSOICount
+	updatedPaths = None
+	if parsed.updatedKnowledgeSentences is not None :
+		parsed.solver.push()
+		parsed.solver.add(parsed.updatedKnowledgeSentences)
+		if not LF.solverCheck(parsed.solver, stats, 'updateConsistency') :
+			sys.exit("Background knowledge not consistent on updating")
+		parsed.solver.pop()
+		updatedPaths, updatedSOICount = LF.consumptiveUpdate(consistentPaths,
+			parsed.statementOfInterest, parsed.updatedKnowledgeSentences, stats = stats)
+	LF.exportModelSets(exportPrefix, consistentPaths, updatedPaths)
+	if updatedPaths is not None :
+		consistentPaths = updatedPaths
+	return((consistentPaths, numInitialModels,
+		initialSOICount, updatedSOICount, len(consistentPaths)))
+
+
+# Rewrites a four-row csv input file as a record file
+# @csvFileName    : the input in the four-row format
+# @recordFileName : where to write it. A .jsonl name writes JSON lines,
+#                   anything else a record csv
+def ConvertInputFile(csvFileName, recordFileName) :
+	with open(csvFileName, 'rb') as csvFile :
+		rows = list(csv.reader(csvFile, delimiter=','))
+	records = []
+	for kind, row in zip(recordKinds, rows) :
+		for text in row :
+			if text.strip() != '' :
+				records.append((kind, text.strip()))
+
+	with open(recordFileName, 'wb') as recordFile :
+		if recordFileName.endswith('.jsonl') :
+			for kind, text in records :
+				recordFile.write(json.dumps({'record' : kind, 'text' : text}) + '\n')
+		else :
+			recWriter = csv.writer(recordFile)
+			recWriter.writerow(['record', 'text'])
+			for kind, text in records :
+				recWriter.writerow([kind, text])
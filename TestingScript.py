@@ -5,45 +5,613 @@
 # Script for testing the functionality of the logical prior
 # generation algorithms.
 
+from z3 import *
 import csv
-import LogicalFunctions as LF
+import itertools
+import os
+import random
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
 import time
+import LogicalFunctions as LF
+import PriorService as PS
+import StreamingInput as SI
+from ModelCache import ModelCache, KnowledgeBaseFingerprint
+import Benchmark
+import BooleanPrior as BP
+import KnowledgeCompilation as KC
+import json
+import numpy
+from BatchRunner import RunBatch
+from BooleanSat import SatSolver
+from Instrumentation import SolverStats
+from ModelStore import ModelStore
+
+
+# The recursive sentence parser which SentenceParser replaced, kept as a
+# reference for the new parser to be checked against
+def ReferenceParse(words, wordIndex, variables) :
+	connectives = [(["implies", "Implies", "->"], Implies), (["and", "And", "&"], And),
+	               (["or", "Or", "||"], Or), (["Xor", "xor"], Xor),
+	               (["=", "==", "iff"], lambda a, b : a == b),
+	               (["!=", "<>", "=/="], lambda a, b : a != b),
+	               ([">"], lambda a, b : a > b), (["<"], lambda a, b : a < b),
+	               ([">="], lambda a, b : a >= b), (["<="], lambda a, b : a <= b)]
+	while len(words) > wordIndex :
+		word = words[wordIndex]
+		wordIndex += 1
+
+		if word in variables :
+			lastInstance = variables[word][0]
+		elif word in ["not", "Not"] :
+			instance, wordIndex = ReferenceParse(words, wordIndex, variables)
+			return((Not(instance), wordIndex))
+		elif word == "(" :
+			lastInstance, wordIndex = ReferenceParse(words, wordIndex, variables)
+		elif word == ")" :
+			return((lastInstance, wordIndex))
+		elif word == "+" :
+			nextWord = words[wordIndex]
+			wordIndex += 1
+			if nextWord in variables :
+				lastInstance = lastInstance + variables[nextWord][0]
+			else :
+				lastInstance = lastInstance + int(nextWord)
+		else :
+			for operatorWords, build in connectives :
+				if word in operatorWords :
+					instance, wordIndex = ReferenceParse(words, wordIndex, variables)
+					return((build(lastInstance, instance), wordIndex))
+			lastInstance = int(word)
+	return((lastInstance, 0))
+
+# Checks that SentenceParser builds the same z3 term as the recursive
+# parser for every sentence of the example files and for each case
+# of operator precedence and grouping
+# @return : the number of sentences which differ
+def CheckParser(exampleFiles) :
+	cases = []
+	for exampleFile in exampleFiles :
+		with open(exampleFile, 'rb') as inputFile :
+			rows = list(csv.reader(inputFile, delimiter=','))
+		variables = LF.ParseVariables(rows[0])
+		for row in rows[1:] :
+			for text in row :
+				for sentence in re.split(r'(?<!\|)\|(?!\|)|\bgiven\b', text) :
+					if sentence.strip() != '' :
+						cases.append((exampleFile, variables, sentence))
+
+	variables = LF.ParseVariables(['a', 'b', 'c', 'd', 'unif x 0 5', 'unif y 0 5'])
+	for sentence in ['a and b or c', 'a or b and c', 'a implies b implies c',
+	                 'not a and b', '(not a) and b', 'not (a or b) implies c',
+	                 'a xor b iff c', 'a == b != c', 'not not a', '((a)) and ((b or c))',
+	                 '(a and b) or (c and d)', 'a and (b or c) implies not d',
+	                 'x > 2', 'x + 1 == y', 'x + y + 1 <= 4', 'a implies x >= y',
+	                 '(x < 3) and (y > 1)'] :
+		cases.append(('precedence', variables, sentence))
+
+	numDiffering = 0
+	for source, variables, sentence in cases :
+		spaced = sentence.replace('(', ' ( ').replace(')', ' ) ')
+		expected = ReferenceParse(spaced.split(), 0, variables)[0]
+		if not LF.ParseSentence(sentence, variables).eq(expected) :
+			print(source + ": <" + sentence + "> parses differently from the reference parser")
+			numDiffering += 1
+	return(numDiffering)
+
+# Checks SatSolver against brute force on small random CNFs, with and
+# without assumptions, and against z3 on larger random 3-SAT instances
+# around the satisfiability threshold
+# @return : the number of instances where they disagree
+def CheckSatSolver(numInstances=300, seed=1) :
+	rng = random.Random(seed)
+	numDiffering = 0
+	for instance in range(numInstances) :
+		numVars = rng.randint(1, 8)
+		clauses = [[rng.choice([1, -1]) * rng.randint(1, numVars)
+		            for k in range(rng.randint(1, 3))]
+		           for j in range(rng.randint(1, 4 * numVars))]
+		solver = SatSolver(numVars, clauses)
+		for check in range(3) :
+			assumptions = [rng.choice([1, -1]) * variable for variable in
+			               rng.sample(range(1, numVars + 1), rng.randint(0, numVars))]
+			expected = False
+			for values in itertools.product([False, True], repeat = numVars) :
+				holds = lambda literal : values[abs(literal) - 1] == (literal > 0)
+				if all(holds(literal) for literal in assumptions) and \
+				   all(any(holds(literal) for literal in clause) for clause in clauses) :
+					expected = True
+					break
+			if solver.solve(assumptions) != expected :
+				print("SatSolver disagrees with brute force on " + str(clauses) +
+				      " assuming " + str(assumptions))
+				numDiffering += 1
+
+	for instance in range(numInstances // 10) :
+		numVars = 40
+		clauses = [[rng.choice([1, -1]) * variable for variable in rng.sample(range(1, numVars + 1), 3)]
+		           for j in range(int(4.26 * numVars))]
+		z3Vars = [None] + [Bool('v' + str(variable)) for variable in range(1, numVars + 1)]
+		T = Solver()
+		for clause in clauses :
+			T.add(Or([z3Vars[literal] if literal > 0 else Not(z3Vars[-literal]) for literal in clause]))
+		if SatSolver(numVars, clauses).solve() != (T.check() == sat) :
+			print("SatSolver disagrees with z3 on " + str(clauses))
+			numDiffering += 1
+	return(numDiffering)
+
+# Checks that caches sharing a directory see each other's models, and
+# that CachedDemskiPrior hands back only as many models as asked for
+# @return : the number of failed checks
+def CheckModelCache(exampleFile) :
+	failures = 0
+	cacheDir = tempfile.mkdtemp()
+	try :
+		parsed = LF.ReadInputFile(exampleFile)
+		fingerprint = KnowledgeBaseFingerprint(parsed.variables, parsed.backgroundKnowledge)
+		writer, reader = ModelCache(cacheDir), ModelCache(cacheDir)
+		LF.CachedDemskiPrior(writer, fingerprint, parsed.backgroundKnowledge, parsed.variables,
+			parsed.statementOfInterest, 200, rng = random.Random(1))
+		cached = reader.load(fingerprint)
+		if cached is None or len(cached) != 200 :
+			print("A second cache on the directory didn't find the saved models")
+			failures += 1
+		models = LF.CachedDemskiPrior(reader, fingerprint, parsed.backgroundKnowledge,
+			parsed.variables, parsed.statementOfInterest, 50)[0]
+		if len(models) != 50 :
+			print("CachedDemskiPrior returned " + str(len(models)) + " models rather than 50")
+			failures += 1
+		if [name for name in os.listdir(cacheDir) if '.tmp' in name] :
+			print("The model cache left temporary files behind")
+			failures += 1
+	finally :
+		shutil.rmtree(cacheDir)
+	return(failures)
+
+# Checks that a run stopped only by precision also approximates the
+# meta-priors of unfixed variables, and stops once narrow enough
+# @return : the number of failed checks
+def CheckPrecisionBudget(exampleFile, targetWidth=0.05) :
+	result = LF.ParseInputFile(exampleFile, None, targetWidth = targetWidth, rng = random.Random(1))
+	lower, upper = LF.WilsonInterval(result[2], result[1])
+	if upper - lower > targetWidth :
+		print(exampleFile + " stopped with an interval of width " + str(upper - lower))
+		return(1)
+	return(0)
+
+# Checks that the benchmark reads input rows as csv, and measures a
+# problem in a process of its own
+# @return : the number of failed checks
+def CheckBenchmark() :
+	failures = 0
+	inputDir = tempfile.mkdtemp()
+	try :
+		inputName = os.path.join(inputDir, 'quoted.csv')
+		with open(inputName, 'wb') as inputFile :
+			csv.writer(inputFile).writerows([['a .3', 'b'], ['a implies b', ''],
+			                                 ['a and b', 'b'], ['b']])
+		if Benchmark.readExampleRows(inputName) != (['a .3', 'b'], ['a implies b', ''],
+		                                            'a and b', ['b']) :
+			print("Benchmark read " + inputName + " as " + str(Benchmark.readExampleRows(inputName)))
+			failures += 1
+	finally :
+		shutil.rmtree(inputDir)
+
+	declarations, sentences, interest = Benchmark.SyntheticKnowledgeBase(10)
+	result = Benchmark.IsolatedBenchmarkProblem('synthetic-10', declarations, sentences, interest,
+		['v1'], 0.2, seed = 1)
+	if not (result['samples'] > 0 and 0 <= result['probability'] <= 1 and
+	        result['peakMemoryKB'] >= result['startMemoryKB'] > 0) :
+		print("Benchmark measured " + str(result))
+		failures += 1
+	return(failures)
+
+# Checks that importing the modules doesn't load z3, which only the z3
+# engine should pay for
+# @return : the number of failed checks
+def CheckLazyImports(moduleNames) :
+	failures = 0
+	for moduleName in moduleNames :
+		loaded = subprocess.check_output([sys.executable, '-c',
+			'import sys, ' + moduleName + '; print(\'z3\' in sys.modules)']).strip()
+		if loaded != 'False' :
+			print("Importing " + moduleName + " loaded z3")
+			failures += 1
+	return(failures)
+
+# Checks that SolverStats counts every solver check, including those
+# made by parallel workers, whose traces go to files of their own
+# @return : the number of failed checks
+def CheckSolverStats(exampleFile) :
+	failures = 0
+	parsed = LF.ReadInputFile(exampleFile)
+	traceDir = tempfile.mkdtemp()
+	try :
+		traceFile = os.path.join(traceDir, 'trace.jsonl')
+		stats = SolverStats(traceFile)
+		LF.solverCheckCount.clear()
+		LF.ParallelDemskiPrior(parsed.backgroundKnowledge, parsed.variables,
+			parsed.statementOfInterest, None, 2, seed = 1, maxSamples = 50, stats = stats)
+		stats.close()
+		tracedChecks = 0
+		for i in range(2) :
+			with open(LF.workerTraceFile(traceFile, i)) as workerTrace :
+				tracedChecks += sum(1 for line in workerTrace if json.loads(line)['event'] == 'check')
+		totalChecks = sum(stats.checks.values())
+		# The parent's own consistency check isn't recorded in the stats
+		if not (totalChecks == tracedChecks == LF.solverCheckCount['checks'] - 1 > 0) :
+			print("Parallel workers made " + str(LF.solverCheckCount['checks'] - 1) +
+			      " checks, but the stats record " + str(totalChecks) + " and the traces " +
+			      str(tracedChecks))
+			failures += 1
+	finally :
+		shutil.rmtree(traceDir)
+	return(failures)
+
+# A service whose 'block' requests hold the worker until released, so
+# the queue can be filled on purpose
+class BlockingService(PS.PriorService) :
+
+	def __init__(self, *args) :
+		self.blocking = threading.Event()
+		self.release = threading.Event()
+		PS.PriorService.__init__(self, *args)
+
+	def handle(self, action, body) :
+		if action == 'block' :
+			self.blocking.set()
+			self.release.wait()
+			return({})
+		return(PS.PriorService.handle(self, action, body))
+
+# Checks the prior service in process: loading, querying, refusing
+# inconsistent evidence and unparseable queries, turning requests away
+# once the queue is full, and stopping its worker on close
+# @return : the number of failed checks
+def CheckPriorService(exampleFile) :
+	failures = 0
+	service = BlockingService(300, 1)
+	try :
+		expected = [('load', {'name' : 'example', 'file' : exampleFile}, 200),
+		            ('query', {'kb' : 'example', 'queries' : ['car1', 'car1 | pick1']}, 200),
+		            ('query', {'kb' : 'example', 'queries' : ['car1'], 'evidence' : ['reveal2']}, 200),
+		            ('query', {'kb' : 'example', 'queries' : ['car1'], 'evidence' : ['not pick1']}, 400),
+		            ('query', {'kb' : 'example', 'queries' : ['car1 and nonsense']}, 400),
+		            ('query', {'kb' : 'missing', 'queries' : ['car1']}, 404)]
+		for action, body, expectedStatus in expected :
+			status, response = service.submit(action, body)
+			if status != expectedStatus :
+				print("The service answered " + action + " " + json.dumps(body) + " with " +
+				      str(status) + " " + json.dumps(response))
+				failures += 1
+
+		# One request holds the worker and one fills the queue
+		waiting = [threading.Thread(target = service.submit, args = ('block', {}))]
+		waiting[0].start()
+		service.blocking.wait()
+		waiting.append(threading.Thread(target = service.submit, args = ('block', {})))
+		waiting[1].start()
+		while service.requests.qsize() < 1 :
+			time.sleep(0.01)
+		if service.submit('query', {'kb' : 'example', 'queries' : ['car1']})[0] != 503 :
+			print("The service queued a request beyond its queue size")
+			failures += 1
+		service.release.set()
+		for thread in waiting :
+			thread.join()
+	finally :
+		service.release.set()
+		service.close()
+	if service.worker.is_alive() or service.submit('query', {})[0] != 503 :
+		print("The service kept serving after it was closed")
+		failures += 1
+	return(failures)
+
+# Checks that a file without any budget fails its own row rather than
+# the batch
+# @return : the number of failed checks
+def CheckBatchBudgets(exampleFile) :
+	report = RunBatch([(exampleFile, None, 50), (exampleFile, None, None)], numWorkers = 1)
+	if report['succeeded'] != 1 or report['failed'] != [exampleFile] :
+		print("A batch with one unbudgeted file reported " + json.dumps(report))
+		return(1)
+	return(0)
+
+# Checks that a record file keeping its sentences samples the same models
+# as its four-row original, and that the bounded mode samples as many
+# @return : the number of failed checks
+def CheckStreamingInput(exampleFiles, numSamples=300) :
+	failures = 0
+	recordDir = tempfile.mkdtemp()
+	try :
+		for exampleFile in exampleFiles :
+			recordFile = os.path.join(recordDir, os.path.splitext(exampleFile)[0] + '.jsonl')
+			SI.ConvertInputFile(exampleFile, recordFile)
+			fromRows = LF.ParseInputFile(exampleFile, None, numSamples, rng = random.Random(1))
+			fromRecords = SI.StreamInputFile(recordFile, None, numSamples, rng = random.Random(1))
+			if fromRows[1:] != fromRecords[1:] :
+				print(recordFile + " gave " + str(fromRecords[1:]) + " rather than " + str(fromRows[1:]))
+				failures += 1
+			bounded = SI.StreamInputFile(recordFile, None, numSamples, keepSentences = False,
+			                             rng = random.Random(1))
+			if bounded[1] != numSamples :
+				print(recordFile + " sampled " + str(bounded[1]) + " models without its sentences")
+				failures += 1
+	finally :
+		shutil.rmtree(recordDir)
+	return(failures)
 
-# Set-up output file writer
+# Checks the compiled prior against ExampleInput3's prior of B worked
+# out by hand. C is always true. When B is drawn before A its coin gives
+# .5, and when A is drawn first B is forced by A with probability .1 and
+# otherwise gets its coin, .1 + .9 * .5 = .55. Both orders are equally
+# likely, so the prior is .525. Sampling ExampleInput4 should land near
+# its exact prior too
+# @return : the number of failed checks
+def CheckExactPrior() :
+	failures = 0
+	prior, updated, exact = KC.ExactInputFile('ExampleInput3.csv', 1)
+	if not exact or abs(prior - .525) > 1e-9 :
+		print("ExactInputFile gave " + str(prior) + " for ExampleInput3 rather than .525")
+		failures += 1
+	exactPrior = KC.ExactInputFile('ExampleInput4.csv', 1)[0]
+	result = LF.ParseInputFile('ExampleInput4.csv', None, 4000, rng = random.Random(1))
+	if abs(float(result[2]) / result[1] - exactPrior) > 0.03 :
+		print("Sampling ExampleInput4 gave " + str(float(result[2]) / result[1]) +
+		      " but its exact prior is " + str(exactPrior))
+		failures += 1
+	return(failures)
+
+# Checks importance sampling on a sentence of prior .2^6 = 6.4e-5, which
+# plain sampling of 2000 models would almost never see hold
+# @return : the number of failed checks
+def CheckImportanceSampling(numSamples=2000) :
+	variables = LF.ParseVariables(['a' + str(i) + ' .2' for i in range(6)])
+	parser = LF.SentenceParser(variables)
+	knowledgeBase = [LF.ParseSentence('a0 implies (a1 or a2)', variables, parser)]
+	statementOfInterest = LF.ParseSentence('a0 and a1 and a2 and a3 and a4 and a5', variables, parser)
+	exactPrior = KC.ExactDemskiPrior(knowledgeBase, variables, statementOfInterest)
+	models, interestCount, trueVarNames = LF.DemskiPrior(knowledgeBase, variables,
+		statementOfInterest, None, numSamples, importance = True, rng = random.Random(1))
+	estimate = interestCount / len(models)
+	if abs(estimate - exactPrior) > 0.2 * exactPrior :
+		print("Importance sampling estimated " + str(estimate) + " for a prior of " + str(exactPrior))
+		return(1)
+	return(0)
+
+# @return : the variables and knowledge base of an input file, with
+#           every variable declared unfixed
+def UnfixedKnowledgeBase(exampleFile) :
+	variableRow, knowledgeRow, queryRow, updatedRow = LF.ReadInputRows(exampleFile)
+	variables = LF.ParseVariables(['unfixed ' + declaration.split()[0] for declaration in variableRow])
+	parser = LF.SentenceParser(variables)
+	knowledgeBase = [LF.ParseSentence(sentence, variables, parser) for sentence in knowledgeRow
+	                 if sentence.strip() != '']
+	return((variables, knowledgeBase))
+
+# Checks that the sampled meta-prior rounds follow the exact ones of
+# KnowledgeCompilation, with every variable of an input file unfixed
+# @return : the number of failed checks
+def CheckMetaPriorFixpoint(exampleFile, numRounds=3) :
+	variables, knowledgeBase = UnfixedKnowledgeBase(exampleFile)
+	KC.CompiledPrior(knowledgeBase, variables).updateUnfixedProbabilities(variables.keys(),
+		numRounds, 0)
+	exactPriors = dict((varName, LF.metaPrior(variables, varName)) for varName in variables)
+
+	variables, knowledgeBase = UnfixedKnowledgeBase(exampleFile)
+	LF.approximateUnfixedProbabilities(knowledgeBase, variables, variables.keys(), None,
+		4000 * numRounds, maxRounds = numRounds, tolerance = 0, rng = random.Random(1))
+	for varName in variables :
+		if abs(LF.metaPrior(variables, varName) - exactPriors[varName]) > 0.03 :
+			print("The meta-prior of " + varName + " reached " + str(LF.metaPrior(variables, varName)) +
+			      " rather than " + str(exactPriors[varName]))
+			return(1)
+	return(0)
+
+# @return : whether two ModelStores hold the same models in the same order
+def SameModels(first, second) :
+	return(len(first) == len(second) and first.boolNames == second.boolNames and
+	       first.unifNames == second.unifNames and
+	       (first.boolMatrix() == second.boolMatrix()).all() and
+	       (first.unifMatrix() == second.unifMatrix()).all())
+
+# Checks that seeded runs with a sample budget repeat exactly, for a
+# file with unfixed meta-priors and for parallel workers
+# @return : the number of failed checks
+def CheckSeededRuns() :
+	failures = 0
+	runs = [LF.ParseInputFile('ExampleInput2.csv', None, 400, rng = LF.RandomStream(7, 'check'))
+	        for i in range(2)]
+	if not SameModels(runs[0][0], runs[1][0]) or runs[0][1:] != runs[1][1:] :
+		print("Seeded runs of ExampleInput2 differed")
+		failures += 1
+
+	parsed = LF.ReadInputFile('ExampleInput1.csv')
+	runs = [LF.ParallelDemskiPrior(parsed.backgroundKnowledge, parsed.variables,
+	                               parsed.statementOfInterest, None, 2, seed = 7, maxSamples = 100)
+	        for i in range(2)]
+	if not SameModels(runs[0][0], runs[1][0]) or runs[0][1] != runs[1][1] :
+		print("Seeded parallel runs of ExampleInput1 differed")
+		failures += 1
+	return(failures)
+
+# Checks that the trie of checked prefixes changes no model, for both
+# unif and boolean files, while saving solver checks
+# @return : the number of failed checks
+def CheckDecisionTrie(exampleFiles, numSamples=300) :
+	failures = 0
+	for exampleFile in exampleFiles :
+		parsed = LF.ReadInputFile(exampleFile)
+		runs = []
+		for cachePrefixes in [True, False] :
+			stats = SolverStats()
+			models = LF.DemskiPrior(parsed.backgroundKnowledge, parsed.variables,
+				parsed.statementOfInterest, None, numSamples, stats = stats,
+				rng = random.Random(1), cachePrefixes = cachePrefixes)[0]
+			runs.append((models, sum(stats.checks.values())))
+		if not SameModels(runs[0][0], runs[1][0]) :
+			print("The decision trie changed the models of " + exampleFile)
+			failures += 1
+		if runs[0][1] > runs[1][1] :
+			print("The decision trie made more checks on " + exampleFile)
+			failures += 1
+	return(failures)
+
+# Checks that the sat and z3 backends draw the same models from the
+# same seed, for z3 sentences, for parser nodes and with importance
+# sampling, since propagation and the checks agree whichever solver
+# answers them
+# @return : the number of failed checks
+def CheckBackends(exampleFiles, numSamples=300) :
+	failures = 0
+	problems = []
+	for exampleFile in exampleFiles :
+		variableRow, knowledgeRow, interest, updates = Benchmark.readExampleRows(exampleFile)
+		problems.append((exampleFile, variableRow, knowledgeRow, interest))
+	declarations, sentences, interest = Benchmark.SyntheticKnowledgeBase(20)
+	problems.append(('synthetic-20', declarations, sentences, interest))
+
+	for name, declarations, sentences, interest in problems :
+		variables = LF.ParseVariables(declarations)
+		parser = LF.SentenceParser(variables)
+		knowledgeBase = [parser.parse(sentence) for sentence in sentences if sentence.strip() != '']
+		runs = []
+		for backend in ['sat', 'z3'] :
+			for importance in [False, True] :
+				runs.append(LF.DemskiPrior(knowledgeBase, variables, parser.parse(interest), None,
+					numSamples, rng = random.Random(1), backend = backend,
+					importance = importance))
+
+		nodeVariables = LF.ParseDeclarations(declarations)
+		nodeParser = LF.SentenceParser(nodeVariables)
+		knowledgeNodes = [nodeParser.parseNode(sentence) for sentence in sentences
+		                  if sentence.strip() != '']
+		runs.append(LF.DemskiPrior(knowledgeNodes, nodeVariables, nodeParser.parseNode(interest),
+			None, numSamples, rng = random.Random(1), backend = 'sat', parser = nodeParser))
+
+		for first, second in [(0, 2), (1, 3), (0, 4)] :
+			if not SameModels(runs[first][0], runs[second][0]) or \
+			   runs[first][1] != runs[second][1] or \
+			   not (runs[first][0].weightVector() == runs[second][0].weightVector()).all() :
+				print("The backends drew different models for " + name)
+				failures += 1
+
+	# BooleanPrior's files sample as the z3 engine samples them. Every
+	# variable of ExampleInput4 bears on its sentence of interest, so
+	# ParseInputFile samples them all too
+	booleanResult = BP.BooleanInputFile('ExampleInput4.csv', None, numSamples,
+	                                    rng = random.Random(1))
+	result = LF.ParseInputFile('ExampleInput4.csv', None, numSamples, rng = random.Random(1))
+	if not SameModels(booleanResult[0], result[0]) or booleanResult[1:] != result[1:] :
+		print("BooleanPrior sampled ExampleInput4.csv differently from z3")
+		failures += 1
+	return(failures)
+
+# Checks that exported model files map back as the models written, for
+# unif, boolean and weighted models
+# @return : the number of failed checks
+def CheckModelFiles() :
+	failures = 0
+	exportDir = tempfile.mkdtemp()
+	try :
+		prefix = os.path.join(exportDir, 'example1')
+		result = LF.ParseInputFile('ExampleInput1.csv', None, 200, exportPrefix = prefix,
+		                           rng = random.Random(1))
+		stores = [(result[0], prefix + '.updated.models')]
+
+		parsed = LF.ReadInputFile('ExampleInput4.csv')
+		weighted = LF.DemskiPrior(parsed.backgroundKnowledge, parsed.variables,
+			parsed.statementOfInterest, None, 200, importance = True, rng = random.Random(1))[0]
+		weighted.toFile(os.path.join(exportDir, 'weighted.models'))
+		stores.append((weighted, os.path.join(exportDir, 'weighted.models')))
+
+		for store, fileName in stores :
+			mapped = ModelStore.fromFile(fileName)
+			matrix = mapped.unifValues if store.unifNames else mapped.boolBits
+			if not SameModels(store, mapped) or not isinstance(matrix, numpy.memmap) :
+				print(fileName + " didn't map back as the models written")
+				failures += 1
+			if not (store.weightVector() == mapped.weightVector()).all() :
+				print(fileName + " didn't keep its weights")
+				failures += 1
+	finally :
+		shutil.rmtree(exportDir)
+	return(failures)
+
+exampleFiles = ['ExampleInput' + str(k) + '.csv' for k in range(1,5)]
+if CheckParser(exampleFiles) == 0 :
+	print('Parser agrees with the reference parser')
+if CheckSatSolver() == 0 :
+	print('SatSolver agrees with brute force and z3')
+if CheckModelCache('ExampleInput4.csv') == 0 :
+	print('Model cache shares and trims its models')
+if CheckPrecisionBudget('ExampleInput2.csv') == 0 :
+	print('Precision budget covers the meta-prior rounds')
+if CheckBenchmark() == 0 :
+	print('Benchmark reads csv rows and isolates each problem')
+if CheckLazyImports(['LogicalFunctions', 'BooleanPrior', 'StreamingInput', 'QueryBatch',
+                     'KnowledgeCompilation', 'PriorService', 'Benchmark', 'BatchRunner']) == 0 :
+	print('Importing the modules leaves z3 unloaded')
+if CheckSolverStats('ExampleInput1.csv') == 0 :
+	print('SolverStats counts the checks of parallel workers')
+if CheckPriorService('ExampleInput4.csv') == 0 :
+	print('Prior service answers, refuses and closes')
+if CheckBatchBudgets('ExampleInput3.csv') == 0 :
+	print('Batch runner reports files without a budget')
+if CheckStreamingInput(exampleFiles) == 0 :
+	print('Record files sample as their four-row originals do')
+if CheckExactPrior() == 0 :
+	print('Compiled prior agrees with the hand-computed prior')
+if CheckImportanceSampling() == 0 :
+	print('Importance sampling estimates a rare prior')
+if CheckMetaPriorFixpoint('ExampleInput3.csv') == 0 :
+	print('Meta-prior rounds follow the exact fixpoint iteration')
+if CheckSeededRuns() == 0 :
+	print('Seeded runs repeat exactly')
+if CheckDecisionTrie(exampleFiles) == 0 :
+	print('Decision trie keeps the models and saves checks')
+if CheckBackends(exampleFiles) == 0 :
+	print('Sat and z3 backends draw the same seeded models')
+if CheckModelFiles() == 0 :
+	print('Model files map back as written')
+
+# Typical range of each example's probability, and the fewest models it
+# typically generates
+initialLowerBounds   = {'ExampleInput1.csv' : .33, 'ExampleInput2.csv' : .43,
+                        'ExampleInput3.csv' : .46, 'ExampleInput4.csv' : .25}
+initialUpperBounds   = {'ExampleInput1.csv' : .47, 'ExampleInput2.csv' : .57,
+                        'ExampleInput3.csv' : .54, 'ExampleInput4.csv' : .35}
+numModelsLowerBounds = {'ExampleInput1.csv' : 260, 'ExampleInput2.csv' : 260,
+                        'ExampleInput3.csv' : 440, 'ExampleInput4.csv' : 260}
+
+# Run every example file on a shared pool, writing a row per file
+if not os.path.isdir('TestResults') :
+	os.makedirs('TestResults')
 outputFileName = 'TestResults/' + time.strftime('%m%d%H%S', time.gmtime()) + '.csv'
-with open(outputFileName, 'wb') as outputFile:
-
-	resWriter = csv.writer(outputFile, delimiter=' ')
-
-    # Loop through all example files
-	initialLowerBounds  = [0,   .33, .43, .46, .25, .4, 0, 0]
-	initialUpperBounds  = [1, .47, .57, .54, .35, .6, .1, 1]
-	numModelsLowerBounds = [0,   260, 260, 440, 260, 100, 50, 50]
-	for k in range(0,2) :
-		exampleFile = 'ExampleInput' + str(k) + '.csv'
-		result = LF.ParseInputFile(exampleFile, 30)
-		consistentPaths  = result[0]
-		numModels = result[1]
-		initialSOICount  = result[2]
-		updatedSOICount  = result[3]
-		numUpdatedModels = result[4]
-
-		numUpdatedModels = len(consistentPaths)
-		probability = round(float(initialSOICount)/numModels,4)
-		updatedProbability = round(float(updatedSOICount)/numUpdatedModels,4)
-
-		if (probability > initialUpperBounds[k]) :
+RunBatch([(exampleFile, None, None) for exampleFile in exampleFiles], 30,
+         outputFileName = outputFileName)
+
+with open(outputFileName) as outputFile :
+	for result in csv.DictReader(outputFile) :
+		exampleFile = result['file']
+		if result['status'] != 'ok' :
+			print(exampleFile + " failed: " + result['error'])
+			continue
+		numModels = int(result['numModels'])
+		probability = round(float(result['probability']), 4)
+
+		if (probability > initialUpperBounds[exampleFile]) :
 			print(exampleFile + "'s result was too high")
-		elif (probability < initialLowerBounds[k]) :
+		elif (probability < initialLowerBounds[exampleFile]) :
 			print(exampleFile + "'s result was too low")
 
-		if (numModels < numModelsLowerBounds[k]) :
+		if (numModels < numModelsLowerBounds[exampleFile]) :
 			print(exampleFile + "'s generated fewer models than typical")
 			print("Generated: " + str(numModels) + " models")
-			print("Typical is: " + str(numModelsLowerBounds[k]) + "+ models")
-
-		resWriter.writerow([exampleFile,
-			str(numModels), str(probability),
-			str(numUpdatedModels), str(updatedProbability)])
+			print("Typical is: " + str(numModelsLowerBounds[exampleFile]) + "+ models")
 
-	print('Testing done')
+print('Testing done')
@@ -0,0 +1,143 @@
+import collections
+
+from BooleanSat import ClauseEncoder, ExpressionNode, NotBoolean
+from SentenceParser import SentenceParser
+
+
+# Compiles a purely boolean knowledge base to CNF so that implied
+# variables can be found by unit propagation instead of a solver call.
+# The clauses are those ClauseEncoder writes, the encoding the sat
+# backend checks, and z3 sentences are first interned as the nodes they
+# were parsed from, so the variables propagation forces are the same
+# whichever backend checks the choices.
+# @knowledgeBase : a list of z3 instances corresponding to the
+#                  given axiom scheme, or of node ids of parser
+# @variables     : the dictionary of variables from ParseVariables
+# @parser        : optional SentenceParser the knowledge base was
+#                  parsed into as nodes
+# @return        : a triple of the number of variables, the clauses
+#                  (lists of signed integer literals) and a dictionary
+#                  from variable names to their integer index, or None
+#                  if the knowledge base contains non-boolean variables
+def CompileCNF(knowledgeBase, variables, parser=None) :
+	for varName in variables.keys() :
+		if variables[varName][1] != 'bool' :
+			return(None)
+
+	try :
+		if parser is None :
+			parser = SentenceParser(variables)
+			knowledgeBase = [ExpressionNode(parser, sentence) for sentence in knowledgeBase]
+		encoder = ClauseEncoder(parser, sorted(variables.keys()))
+		for nodeId in knowledgeBase :
+			encoder.assertNode(nodeId)
+	except NotBoolean :
+		return(None)
+	return((encoder.numVars, encoder.clauses, encoder.varIndex))
+
+
+# Assignment trail over a set of clauses using two watched literals per
+# clause. Literals are signed integers, variable indices start at 1.
+class PropagationTrail(object) :
+
+	def __init__(self, numVars, clauses) :
+		self.values = [None] * (numVars + 1)
+		self.trail = []
+		self.levels = []
+		self.clauses = []
+		self.watches = collections.defaultdict(list)
+		self.inconsistent = False
+
+		units = []
+		for clause in clauses :
+			clause = list(set(clause))
+			if any(-literal in clause for literal in clause) :
+				continue
+			if len(clause) == 0 :
+				self.inconsistent = True
+			elif len(clause) == 1 :
+				units.append(clause[0])
+			else :
+				self.watches[clause[0]].append(len(self.clauses))
+				self.watches[clause[1]].append(len(self.clauses))
+				self.clauses.append(clause)
+
+		for literal in units :
+			if not self.assign(literal) :
+				self.inconsistent = True
+
+	# @return : True, False or None (unassigned) for a literal
+	def literalValue(self, literal) :
+		value = self.values[abs(literal)]
+		if value is None or literal > 0 :
+			return(value)
+		return(not value)
+
+	# @return : the value of the variable with the given index
+	def value(self, varIndex) :
+		return(self.values[varIndex])
+
+	# Marks the current trail position so that pop() can undo to it
+	def push(self) :
+		self.levels.append(len(self.trail))
+
+	# Undoes every assignment made since the matching push()
+	def pop(self) :
+		mark = self.levels.pop()
+		while len(self.trail) > mark :
+			self.values[abs(self.trail.pop())] = None
+
+	# Undoes every level, leaving only the consequences of unit clauses
+	def reset(self) :
+		while self.levels :
+			self.pop()
+
+	# Sets a literal true and propagates its consequences
+	# @return : False if propagation reached a conflict, in which case
+	#           the trail must be popped by the caller
+	def assign(self, literal) :
+		current = self.literalValue(literal)
+		if current is not None :
+			return(current)
+
+		propagateFrom = len(self.trail)
+		self.values[abs(literal)] = literal > 0
+		self.trail.append(literal)
+
+		while propagateFrom < len(self.trail) :
+			falseLiteral = -self.trail[propagateFrom]
+			propagateFrom += 1
+
+			watching = self.watches[falseLiteral]
+			stillWatching = []
+			for position in range(len(watching)) :
+				clauseIndex = watching[position]
+				clause = self.clauses[clauseIndex]
+				if clause[0] == falseLiteral :
+					clause[0], clause[1] = clause[1], clause[0]
+
+				if self.literalValue(clause[0]) is True :
+					stillWatching.append(clauseIndex)
+					continue
+
+				# Move the watch to any literal which isn't false
+				moved = False
+				for k in range(2, len(clause)) :
+					if self.literalValue(clause[k]) is not False :
+						clause[1], clause[k] = clause[k], clause[1]
+						self.watches[clause[1]].append(clauseIndex)
+						moved = True
+						break
+				if moved :
+					continue
+
+				stillWatching.append(clauseIndex)
+				if self.literalValue(clause[0]) is False :
+					self.watches[falseLiteral] = stillWatching + watching[position+1:]
+					return(False)
+				self.values[abs(clause[0])] = clause[0] > 0
+				self.trail.append(clause[0])
+
+			self.watches[falseLiteral] = stillWatching
+
+		return(True)
@@ -0,0 +1,194 @@
+from LazyZ3 import z3
+import numpy
+
+
+# Raised when a sentence can't be evaluated directly over a ModelStore,
+# because it mentions a variable the store has no column for or uses an
+# unsupported operator. Callers fall back on the solver.
+class NotVectorizable(Exception) :
+	pass
+
+
+# Operators which combine the arrays of their children elementwise, by
+# the names SentenceParser gives them
+_naryOps = {
+	'and' : numpy.logical_and,
+	'or'  : numpy.logical_or,
+	'xor' : numpy.logical_xor,
+	'add' : numpy.add,
+	'mul' : numpy.multiply,
+}
+_binaryOps = {
+	'implies' : lambda a, b : numpy.logical_or(numpy.logical_not(a), b),
+	'eq'      : numpy.equal,
+	'ne'      : numpy.not_equal,
+	'lt'      : numpy.less,
+	'le'      : numpy.less_equal,
+	'gt'      : numpy.greater,
+	'ge'      : numpy.greater_equal,
+	'sub'     : numpy.subtract,
+}
+_unaryOps = {
+	'not'    : numpy.logical_not,
+	'uminus' : numpy.negative,
+}
+
+# The name of each z3 operator kind, filled in when a z3 sentence is
+# first compiled so that importing this module doesn't load z3
+_z3Operators = {}
+
+def z3Operator(kind) :
+	if not _z3Operators :
+		_z3Operators.update([(z3.Z3_OP_AND, 'and'), (z3.Z3_OP_OR, 'or'), (z3.Z3_OP_XOR, 'xor'),
+			(z3.Z3_OP_ADD, 'add'), (z3.Z3_OP_MUL, 'mul'), (z3.Z3_OP_IMPLIES, 'implies'),
+			(z3.Z3_OP_EQ, 'eq'), (z3.Z3_OP_DISTINCT, 'ne'), (z3.Z3_OP_LT, 'lt'),
+			(z3.Z3_OP_LE, 'le'), (z3.Z3_OP_GT, 'gt'), (z3.Z3_OP_GE, 'ge'),
+			(z3.Z3_OP_SUB, 'sub'), (z3.Z3_OP_NOT, 'not'), (z3.Z3_OP_UMINUS, 'uminus'),
+			(z3.Z3_OP_ITE, 'ite')])
+	return(_z3Operators.get(kind))
+
+
+# A sentence compiled to a straight-line program of NumPy operations
+# over the columns of a ModelStore. Each step is keyed by the z3 id or
+# parser node of its subexpression, so sentences compiled against the
+# same store can share one memo and evaluate common subexpressions only
+# once.
+class VectorizedSentence(object) :
+
+	# @sentence : a z3 sentence, a node id of parser, or a python bool
+	# @store    : the ModelStore whose columns the sentence refers to
+	# @parser   : optional SentenceParser whose node the sentence is
+	def __init__(self, sentence, store, parser=None) :
+		self.steps = []
+		if sentence is True or sentence is False :
+			self.rootId = ('const', sentence)
+			self.steps.append((self.rootId, 'const', sentence))
+			return
+		if parser is not None :
+			self.rootId = self.compileNode(parser, sentence, store)
+			return
+		compiled = set()
+		self.rootId = self.compile(sentence, store, compiled)
+
+	# A node's children have smaller ids than it, so the nodes below it
+	# are compiled in id order
+	def compileNode(self, parser, nodeId, store) :
+		needed = set()
+		stack = [nodeId]
+		while stack :
+			top = stack.pop()
+			if top in needed :
+				continue
+			needed.add(top)
+			if parser.keys[top][0] not in ['var', 'int', 'const'] :
+				stack.extend(parser.keys[top][1:])
+
+		for top in sorted(needed) :
+			key = parser.keys[top]
+			op = key[0]
+			if op in ['int', 'const'] :
+				self.steps.append((('node', top), 'const', key[1]))
+			elif op == 'var' :
+				if key[1] in store.boolIndex :
+					self.steps.append((('node', top), 'bool', store.boolIndex[key[1]]))
+				elif key[1] in store.unifIndex :
+					self.steps.append((('node', top), 'unif', store.unifIndex[key[1]]))
+				else :
+					raise NotVectorizable(key[1] + " is not assigned in the stored models")
+			elif op in _naryOps or op in _binaryOps or op in _unaryOps :
+				self.steps.append((('node', top), op, [('node', child) for child in key[1:]]))
+			else :
+				raise NotVectorizable("can't vectorize " + op)
+		return(('node', nodeId))
+
+	def compile(self, expr, store, compiled) :
+		exprId = expr.get_id()
+		if exprId in compiled :
+			return(exprId)
+
+		if z3.is_int_value(expr) :
+			self.steps.append((exprId, 'const', expr.as_long()))
+		elif z3.is_true(expr) or z3.is_false(expr) :
+			self.steps.append((exprId, 'const', z3.is_true(expr)))
+		elif z3.is_const(expr) :
+			name = str(expr)
+			if z3.is_bool(expr) and name in store.boolIndex :
+				self.steps.append((exprId, 'bool', store.boolIndex[name]))
+			elif z3.is_int(expr) and name in store.unifIndex :
+				self.steps.append((exprId, 'unif', store.unifIndex[name]))
+			else :
+				raise NotVectorizable(name + " is not assigned in the stored models")
+		else :
+			op = z3Operator(expr.decl().kind())
+			childIds = [self.compile(child, store, compiled) for child in expr.children()]
+			if op in _naryOps or (op in _binaryOps and len(childIds) == 2) or \
+			   (op in _unaryOps and len(childIds) == 1) or (op == 'ite' and len(childIds) == 3) :
+				self.steps.append((exprId, op, childIds))
+			else :
+				raise NotVectorizable("can't vectorize " + str(expr))
+
+		compiled.add(exprId)
+		return(exprId)
+
+	# @store : a ModelStore with the columns the sentence was compiled for
+	# @memo  : optional dictionary of already evaluated subexpressions,
+	#          shared between sentences evaluated over the same store
+	# @return: a boolean array with the truth of the sentence in each model
+	def evaluate(self, store, memo=None) :
+		if memo is None :
+			memo = {}
+		if 'boolMatrix' not in memo :
+			memo['boolMatrix'] = store.boolMatrix()
+		boolMatrix = memo['boolMatrix']
+		unifMatrix = store.unifMatrix()
+		numModels = len(store)
+
+		for stepId, op, argument in self.steps :
+			if stepId in memo :
+				continue
+			if op == 'const' :
+				value = numpy.full(numModels, argument)
+			elif op == 'bool' :
+				value = boolMatrix[:, argument]
+			elif op == 'unif' :
+				value = unifMatrix[:, argument]
+			elif op in _naryOps :
+				value = memo[argument[0]]
+				for childId in argument[1:] :
+					value = _naryOps[op](value, memo[childId])
+			elif op in _binaryOps :
+				value = _binaryOps[op](memo[argument[0]], memo[argument[1]])
+			elif op in _unaryOps :
+				value = _unaryOps[op](memo[argument[0]])
+			else :
+				value = numpy.where(memo[argument[0]], memo[argument[1]], memo[argument[2]])
+			memo[stepId] = value
+
+		return(numpy.asarray(memo[self.rootId], dtype=bool))
+
+
+# Evaluates a sentence in every model of a store
+# @parser : optional SentenceParser whose node the sentence is
+# @return : a boolean array, or None if the sentence can't be vectorized
+#           and must be checked with the solver instead
+def EvaluateSentence(sentence, store, memo=None, parser=None) :
+	try :
+		return(VectorizedSentence(sentence, store, parser).evaluate(store, memo))
+	except NotVectorizable :
+		return(None)
+
+
+# Evaluates the conjunction of several sentences in every model of a store
+# @parser : optional SentenceParser whose nodes the sentences are
+# @return : a boolean array, or None if any sentence can't be vectorized
+def EvaluateAll(sentences, store, memo=None, parser=None) :
+	if memo is None :
+		memo = {}
+	try :
+		compiled = [VectorizedSentence(sentence, store, parser) for sentence in sentences]
+	except NotVectorizable :
+		return(None)
+	result = numpy.ones(len(store), dtype=bool)
+	for sentence in compiled :
+		result &= sentence.evaluate(store, memo)
+	return(result)